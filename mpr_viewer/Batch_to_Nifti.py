@@ -0,0 +1,248 @@
+""" Converts many DICOM series, MHA and HDF5 images to NIFTI with a pool of warm worker processes.
+
+Jobs come from a JSON manifest or from a watched directory. Each worker imports itk, pydicom and
+h5py once, when it starts, and then runs the conversion functions of DICOM_to_Nifti.py and
+MHA_and_HDF5_to_Nifti.py for every job it is handed, skipping inputs unchanged since a cached
+conversion. Per-job timings and failures are written to a JSON summary.
+"""
+import os
+import json
+import time
+import signal
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+
+from Conversion_Cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_GB
+
+
+class BashColours:
+    RESET       = "\033[0m"              # Reset
+    BLACK       = "\033[30m"             # Black
+    RED         = "\033[31m"             # Red
+    GREEN       = "\033[32m"             # Green
+    BLUE        = "\033[34m"             # Blue
+    BOLDBLACK   = "\033[1m\033[30m"      # Bold Black
+    BOLDRED     = "\033[1m\033[31m"      # Bold Red
+    BOLDGREEN   = "\033[1m\033[32m"      # Bold Green
+    BOLDBLUE    = "\033[1m\033[34m"      # Bold Blue
+
+
+def get_input_type(input_path):
+    """Returns "dicom" for directories, "mha" or "h5" for files with those extensions, None otherwise.
+    """
+    if os.path.isdir(input_path):
+        return "dicom"
+    extension = os.path.splitext(input_path)[-1][1:].lower()
+    if extension in ("mha", "h5"):
+        return extension
+    return None
+
+
+def get_output_filename(input_path, output_dir):
+    """NIFTI filename of an input: its base name, without extension, in output_dir.
+    """
+    name = os.path.basename(os.path.normpath(input_path))
+    if not os.path.isdir(input_path):
+        name = os.path.splitext(name)[0]
+    return os.path.join(output_dir, name + ".nii.gz")
+
+
+def init_worker():
+    """Imports the heavy modules once per worker process, so jobs do not pay for them.
+    Ctrl-C is left to the main process, which lets running jobs finish.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import itk
+    import pydicom
+    import h5py
+    itk.ImageFileWriter, itk.NiftiImageIO  # itk loads its submodules lazily
+    import DICOM_to_Nifti
+    import MHA_and_HDF5_to_Nifti
+
+
+def run_job(job):
+    """Runs one conversion job (a dictionary with "input", "output" and optional conversion
+    options) in a worker process, and returns its summary entry.
+    """
+    import numpy as np
+    import DICOM_to_Nifti
+    import MHA_and_HDF5_to_Nifti
+    from Conversion_Cache import ConversionCache
+
+    cache = None
+    if job.get("cache_dir") is not None:
+        cache = ConversionCache(job["cache_dir"], int(job.get("cache_size", DEFAULT_CACHE_SIZE_GB) * 2**30))
+
+    summary = {"input": job["input"], "output": job["output"], "type": get_input_type(job["input"]),
+               "pid": os.getpid(), "started": time.time()}
+    tic = time.time()
+    try:
+        if summary["type"] == "dicom":
+            if job.get("split_series", False):
+                study_dict = DICOM_to_Nifti.ReadDICOMStudy(job["input"], only_read_header=True,
+                    workers=job.get("workers"), series_filter=job.get("series_uid"))
+                summary["series"] = []
+                for seriesKey, header_series_dict in study_dict.items():
+                    output_filename = DICOM_to_Nifti.GetSeriesNiftiFileName(job["output"], seriesKey)
+                    DICOM_to_Nifti.ExportDICOMSeries(header_series_dict, output_filename,
+                        slab_size=job.get("slab_size"), workers=job.get("workers"), cache=cache, 
+                        decoder=job.get("decoder"))
+                    summary["series"].append(output_filename)
+            else:
+                header_series_dict = DICOM_to_Nifti.ReadDICOMSeries(job["input"], only_read_header=True,
+                    workers=job.get("workers"))
+                DICOM_to_Nifti.ExportDICOMSeries(header_series_dict, job["output"],
+                    slab_size=job.get("slab_size"), workers=job.get("workers"), cache=cache, 
+                    decoder=job.get("decoder"))
+        elif summary["type"] == "mha":
+            MHA_and_HDF5_to_Nifti.mha_to_nifti(job["input"], job["output"], verbose=job.get("verbose", False), 
+                cache=cache, workers=job.get("workers"))
+        elif summary["type"] == "h5":
+            MHA_and_HDF5_to_Nifti.stream_h5_to_nifti(job["input"], job.get("h5key", "data"), job["output"],
+                np.array([1.0, 1.0, 1.0], dtype=np.float64), slab_size=job.get("slab_size"),
+                bool_multimask_to_int=job.get("bool_multimask_to_int", False),
+                label_overlap_policy=job.get("multimask_labels"),
+                workers=job.get("workers"), verbose=job.get("verbose", False), cache=cache)
+        else:
+            raise Exception("\"{}\" is neither a DICOM directory nor an \"h5\" or \"mha\" file!".format(job["input"]))
+        if not os.path.isfile(job["output"]) and "series" not in summary:
+            raise Exception("\"{}\" was not written!".format(job["output"]))
+        summary["status"] = "ok"
+    except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = "{}: {}".format(type(e).__name__, e)
+        summary["traceback"] = traceback.format_exc()
+    summary["seconds"] = round(time.time() - tic, 3)
+    return summary
+
+
+def read_manifest(manifest_file, output_dir, defaults=None):
+    """Reads the JSON manifest: a list of jobs, each either an input path or a dictionary with
+    "input" and optional "output" and conversion options. Missing outputs go to output_dir and
+    missing options are taken from defaults.
+    """
+    with open(manifest_file, "r") as file:
+        manifest = json.load(file)
+    jobs = []
+    for job in manifest:
+        if isinstance(job, str):
+            job = {"input": job}
+        job = dict(defaults or {}, **job)
+        job.setdefault("output", get_output_filename(job["input"], output_dir))
+        jobs.append(job)
+    return jobs
+
+
+def scan_watched_directory(watch_dir, output_dir, seen, settle_seconds=30.0, defaults=None):
+    """Returns the jobs for the DICOM directories, MHA and HDF5 files in watch_dir that are not in
+    seen and have not been modified for settle_seconds (so half-copied inputs are left alone).
+    Their options are taken from defaults.
+    """
+    jobs = []
+    now = time.time()
+    for name in sorted(os.listdir(watch_dir)):
+        input_path = os.path.join(watch_dir, name)
+        if input_path in seen or get_input_type(input_path) is None:
+            continue
+        if os.path.isdir(input_path):
+            mtimes = [os.path.getmtime(os.path.join(root, f)) for root, dirs, files in os.walk(input_path) for f in files]
+            mtime = max(mtimes, default=os.path.getmtime(input_path))
+        else:
+            mtime = os.path.getmtime(input_path)
+        if now - mtime < settle_seconds:
+            continue
+        seen.add(input_path)
+        jobs.append(dict(defaults or {}, input=input_path, output=get_output_filename(input_path, output_dir)))
+    return jobs
+
+
+def write_summary(summary_file, results, tic):
+    """Writes the per-job results and the totals to the JSON summary file.
+    """
+    summary = {
+        "jobs":         results,
+        "total":        len(results),
+        "ok":           sum(1 for r in results if r["status"] == "ok"),
+        "failed":       sum(1 for r in results if r["status"] == "failed"),
+        "wall_seconds": round(time.time() - tic, 3),
+        "job_seconds":  round(sum(r["seconds"] for r in results), 3),
+    }
+    with open(summary_file, "w") as file:
+        json.dump(summary, file, indent=4)
+
+
+def report(result):
+    if result["status"] == "ok":
+        print("{}OK{}     {} -> {} ({}{}{} s)".format(BashColours.BOLDGREEN, BashColours.RESET,
+            result["input"], result["output"], BashColours.BOLDGREEN, result["seconds"], BashColours.RESET))
+    else:
+        print("{}FAILED{} {} ({}{}{})".format(BashColours.BOLDRED, BashColours.RESET,
+            result["input"], BashColours.BOLDRED, result["error"], BashColours.RESET))
+
+
+if __name__ == "__main__":
+    # Parse arguments:
+    parser = argparse.ArgumentParser(description='Batch DICOM/MHA/HDF5 to NIFTI Convertor')
+    #
+    input_args = parser.add_argument_group('Inputs (one is required)')
+    input_args.add_argument("-m", "--manifest", "--MANIFEST", help="JSON list of jobs", default=None)
+    input_args.add_argument("--watch", "--WATCH", help="Directory to watch for DICOM directories, MHA and HDF5 files", default=None)
+    #
+    optional_args = parser.add_argument_group('Optional Arguments')
+    optional_args.add_argument("-o", "--output-dir", "--OUTPUT-DIR", help="Directory of the NIFTI files of jobs without an output", default=".")
+    optional_args.add_argument("-p", "--processes", "--PROCESSES", help="Number of worker processes (default: number of CPUs)", type=int, default=None)
+    optional_args.add_argument("-s", "--summary", "--SUMMARY", help="JSON summary of the jobs", default="./batch_summary.json")
+    optional_args.add_argument("--poll-interval", help="Seconds between scans of the watched directory", type=float, default=10.0)
+    optional_args.add_argument("--settle", help="Seconds a watched input must be left unmodified before it is converted", type=float, default=30.0)
+    optional_args.add_argument("--no-cache", "--NO-CACHE", 
+        help="Convert even if an input is unchanged since a cached conversion.", 
+        action="store_true", default=False)
+    optional_args.add_argument("--cache-dir", "--CACHE-DIR", 
+        help="Directory of the conversion cache (default: $NIFTI_CACHE_DIR or ~/.cache/nifti_conversion)", 
+        default=DEFAULT_CACHE_DIR)
+    optional_args.add_argument("--cache-size", "--CACHE-SIZE", 
+        help="Size of the conversion cache in GB, least recently used entries are evicted beyond it", 
+        type=float, default=DEFAULT_CACHE_SIZE_GB)
+    args = parser.parse_args()
+
+    if (args.manifest is None) == (args.watch is None):
+        raise Exception("{}Exactly one of --manifest and --watch is required!{}".format(BashColours.BOLDRED, BashColours.RESET))
+    os.makedirs(args.output_dir, exist_ok=True)
+    job_defaults = {} if args.no_cache else {"cache_dir": args.cache_dir, "cache_size": args.cache_size}
+
+    tic = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=init_worker) as executor:
+        if args.manifest is not None:
+            futures = [executor.submit(run_job, job) for job in read_manifest(args.manifest, args.output_dir, job_defaults)]
+            for future in futures:
+                results.append(future.result())
+                report(results[-1])
+            write_summary(args.summary, results, tic)
+        else:
+            print("Watching {}{}{} (Ctrl-C to stop)...".format(BashColours.BOLDBLUE, args.watch, BashColours.RESET))
+            seen = set()
+            pending = set()
+            try:
+                while True:
+                    for job in scan_watched_directory(args.watch, args.output_dir, seen, args.settle, job_defaults):
+                        pending.add(executor.submit(run_job, job))
+                    done, pending = wait(pending, timeout=args.poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results.append(future.result())
+                        report(results[-1])
+                    if done:
+                        write_summary(args.summary, results, tic)
+                    elif not pending:
+                        time.sleep(args.poll_interval)
+            except KeyboardInterrupt:
+                print("Stopping, waiting for {} running job(s)...".format(len(pending)))
+                for future in pending:
+                    results.append(future.result())
+                    report(results[-1])
+                write_summary(args.summary, results, tic)
+
+    print("{} jobs, {}{}{} failed ({}{}{} s)".format(len(results),
+        BashColours.BOLDRED, sum(1 for r in results if r["status"] == "failed"), BashColours.RESET,
+        BashColours.BOLDGREEN, round(time.time() - tic, 3), BashColours.RESET))
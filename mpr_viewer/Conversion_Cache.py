@@ -0,0 +1,150 @@
+""" On-disk cache of converted NIFTI files, keyed by a fingerprint of the input and the conversion options.
+
+Each entry is a directory named after the key, holding the output files of one conversion and a
+meta.json with their sizes and modification times (checked on every hit, so an entry whose files
+were modified through a hard link is dropped) and the time of its last use (for LRU eviction).
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+CACHE_FORMAT_VERSION = 2
+DEFAULT_CACHE_DIR = os.environ.get("NIFTI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nifti_conversion"))
+DEFAULT_CACHE_SIZE_GB = 20.0
+
+
+def get_cache_key(fingerprint, options):
+    """SHA-256 of the input fingerprint and the conversion options (both JSON serialisable).
+    """
+    payload = json.dumps({"version": CACHE_FORMAT_VERSION, "fingerprint": fingerprint, "options": options},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_file_stats(filenames):
+    """Sorted (filename, size, mtime_ns) of the files, a cheap fingerprint of unchanged inputs.
+    """
+    stats = []
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        stats.append((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns))
+    return stats
+
+
+class ConversionCache:
+    """Size-bounded, least recently used cache of conversion outputs.
+
+    On a hit the cached files are hard linked (copied across file systems) to the requested
+    outputs. On a miss, convert into the temporary outputs given by store(), which moves them into
+    the cache and then links them to the requested outputs as well.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=int(DEFAULT_CACHE_SIZE_GB * 2**30)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_meta(self, key):
+        try:
+            with open(os.path.join(self._entry_dir(key), "meta.json"), "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, key, meta):
+        meta_file = os.path.join(self._entry_dir(key), "meta.json")
+        with open(meta_file + ".tmp", "w") as file:
+            json.dump(meta, file, indent=4)
+        os.replace(meta_file + ".tmp", meta_file)
+
+    def _is_intact(self, key, meta):
+        for entry in meta["files"]:
+            try:
+                stat = os.stat(os.path.join(self._entry_dir(key), entry["name"]))
+            except OSError:
+                return False
+            if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+                return False
+        return True
+
+    def fetch(self, key, output_filenames):
+        """Links the cached files of key to output_filenames. Returns False on a miss.
+        """
+        meta = self._read_meta(key)
+        if meta is None or len(meta["files"]) != len(output_filenames):
+            return False
+        if not self._is_intact(key, meta):
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            return False
+        for entry, output_filename in zip(meta["files"], output_filenames):
+            _link_or_copy(os.path.join(self._entry_dir(key), entry["name"]), output_filename)
+        meta["last_used"] = time.time()
+        self._write_meta(key, meta)
+        return True
+
+    @contextmanager
+    def store(self, key, output_filenames):
+        """Yields temporary filenames (same base names as output_filenames) to convert into. When
+        the block succeeds, they become the cache entry of key and are linked to output_filenames.
+        """
+        temp_dir = tempfile.mkdtemp(prefix=".incoming-", dir=self.cache_dir)
+        try:
+            temp_filenames = [os.path.join(temp_dir, os.path.basename(f)) for f in output_filenames]
+            yield temp_filenames
+            files = []
+            for temp_filename in temp_filenames:
+                if not os.path.isfile(temp_filename):
+                    raise Exception("\"{}\" was not written!".format(temp_filename))
+                stat = os.stat(temp_filename)
+                files.append({"name": os.path.basename(temp_filename), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+            with open(os.path.join(temp_dir, "meta.json"), "w") as file:
+                json.dump({"files": files, "created": time.time(), "last_used": time.time()}, file, indent=4)
+            try:
+                os.rename(temp_dir, self._entry_dir(key))
+            except OSError:
+                pass  # Stored meanwhile by another conversion
+            if not self.fetch(key, output_filenames):
+                for temp_filename, output_filename in zip(temp_filenames, output_filenames):
+                    _link_or_copy(temp_filename, output_filename)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total_bytes = 0
+        for key in os.listdir(self.cache_dir):
+            meta = self._read_meta(key)
+            if meta is None:
+                continue
+            size = sum(entry["size"] for entry in meta["files"])
+            entries.append((meta["last_used"], size, key))
+            total_bytes += size
+        for last_used, size, key in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_bytes -= size
+
+
+def _link_or_copy(src, dest):
+    """Hard links src to dest, or copies it if they are on different file systems. dest is
+    replaced rather than written to, so a file it was linked to is never modified.
+    """
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+    temp_dest = "{}.{}.tmp".format(dest, os.getpid())
+    try:
+        os.link(src, temp_dest)
+    except OSError:
+        shutil.copyfile(src, temp_dest)
+    os.replace(temp_dest, dest)
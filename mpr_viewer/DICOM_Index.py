@@ -0,0 +1,197 @@
+""" Builds and queries an SQLite index of the DICOM series in an archive.
+
+The index holds one row per file (path, size, modification time and series) and one row per
+series with the fields of GetImageMetaData (IMAGE_METADATA_FIELDS). Updates only read the headers
+of files that are new or whose size or modification time changed, and drop the files that are
+gone. DICOM_to_Nifti.py converts the series selected from the index (--index, --where) without
+walking the archive.
+"""
+import os
+import time
+import sqlite3
+import argparse
+
+from DICOM_to_Nifti import (BashColours, IMAGE_METADATA_FIELDS, GetImageMetaData, GetSeriesKey, GetTagAsStr, 
+                            ReadDICOMHeaders, IsMultiFrame, GetDICOMFrames)
+
+
+SERIES_KEY_FIELDS = ("PatientID", "StudyInstanceUID", "SeriesInstanceUID")
+SERIES_COLUMN_TYPES = {"NumberOfSlices": "INTEGER", "SliceThickness": "REAL"}  # TEXT otherwise
+
+
+def OpenDICOMIndex(indexFile):
+    """
+    Args:
+        indexFile (str): Path of the SQLite index, created if it does not exist.
+
+    Returns:
+        sqlite3.Connection to the index.
+    """
+    connection = sqlite3.connect(indexFile)
+    connection.execute("""CREATE TABLE IF NOT EXISTS files (
+        Path TEXT PRIMARY KEY, Size INTEGER, MTimeNs INTEGER,
+        PatientID TEXT, StudyInstanceUID TEXT, SeriesInstanceUID TEXT, SOPInstanceUID TEXT, NumberOfFrames INTEGER)""")
+    connection.execute("CREATE INDEX IF NOT EXISTS files_series ON files (PatientID, StudyInstanceUID, SeriesInstanceUID)")
+    columns = ", ".join("{} {}".format(field, SERIES_COLUMN_TYPES.get(field, "TEXT")) for field in IMAGE_METADATA_FIELDS)
+    connection.execute("CREATE TABLE IF NOT EXISTS series ({}, PRIMARY KEY ({}))".format(columns, ", ".join(SERIES_KEY_FIELDS)))
+    return connection
+
+
+def _GetSeriesRow(dataset):
+    row = dict(zip(IMAGE_METADATA_FIELDS, GetImageMetaData({0: dataset})))
+    if IsMultiFrame(dataset):  # Geometry is in the functional groups
+        frame = GetDICOMFrames(dataset, frame_indices=[0])[0]
+        row["SliceThickness"] = frame.SliceThickness
+        row["PixelSpacing"] = list(frame.PixelSpacing or [])
+        row["ImageOrientationPatient"] = frame.get("ImageOrientationPatient", "")
+    try:
+        row["SliceThickness"] = float(row["SliceThickness"])
+    except (TypeError, ValueError):
+        row["SliceThickness"] = None
+    row["PixelSpacing"] = "\\".join(str(v) for v in row["PixelSpacing"])
+    return [row[field] if field in SERIES_COLUMN_TYPES else str(row[field]) for field in IMAGE_METADATA_FIELDS]
+
+
+def UpdateDICOMIndex(archiveDir, indexFile, workers=None):
+    """
+    Args:
+        archiveDir (str): Directory of the archive; the files of the index under it are updated.
+        indexFile (str):  Path of the SQLite index.
+        workers (int):    Number of header reader threads. Default (None) lets the thread pool decide.
+
+    Returns:
+        Tuple (int, int, int): Numbers of new or modified, removed and unchanged files.
+    """
+    archiveDir = os.path.abspath(archiveDir)
+    connection = OpenDICOMIndex(indexFile)
+
+    ## Stat the archive and compare with the index:
+    fileStats = {}
+    for root, dirs, files in os.walk(archiveDir):
+        for file in files:
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            fileStats[path] = (stat.st_size, stat.st_mtime_ns)
+    indexed = {path: (size, mtimeNs) for path, size, mtimeNs in connection.execute("SELECT Path, Size, MTimeNs FROM files")
+               if path.startswith(archiveDir + os.sep)}
+    changed = [path for path, stat in fileStats.items() if indexed.get(path) != stat]
+    removed = [path for path in indexed if path not in fileStats]
+
+    ## Header-only reads of the new and modified files (multi-frame files stay whole):
+    headers = dict(ReadDICOMHeaders(changed, workers=workers, expand_frames=False))
+
+    with connection:
+        affectedSeries = {}
+        for path in changed + removed:
+            row = connection.execute("SELECT PatientID, StudyInstanceUID, SeriesInstanceUID FROM files WHERE Path = ?", (path,)).fetchone()
+            if row is not None and row[2] is not None:
+                affectedSeries.setdefault(tuple(row), None)
+            connection.execute("DELETE FROM files WHERE Path = ?", (path,))
+        for path in changed:
+            dataset = headers.get(path)
+            if dataset is None:  # Not DICOM; kept so it is not read again until it changes
+                connection.execute("INSERT INTO files VALUES (?, ?, ?, NULL, NULL, NULL, NULL, 0)", (path,) + fileStats[path])
+                continue
+            seriesKey = GetSeriesKey(dataset)
+            connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (path,) + fileStats[path] + seriesKey +
+                (GetTagAsStr(dataset, 0x0008,0x0018), int(dataset.get("NumberOfFrames", 1) or 1)))
+            affectedSeries[seriesKey] = dataset
+
+        ## Refresh the series rows: metadata from a new header, slice counts from the files table
+        keyCondition = " AND ".join("{} = ?".format(field) for field in SERIES_KEY_FIELDS)
+        for seriesKey, dataset in affectedSeries.items():
+            numberOfSlices = connection.execute("SELECT SUM(NumberOfFrames) FROM files WHERE " + keyCondition, seriesKey).fetchone()[0]
+            if not numberOfSlices:
+                connection.execute("DELETE FROM series WHERE " + keyCondition, seriesKey)
+            elif dataset is not None:
+                row = _GetSeriesRow(dataset)
+                row[IMAGE_METADATA_FIELDS.index("NumberOfSlices")] = numberOfSlices
+                connection.execute("INSERT OR REPLACE INTO series VALUES ({})".format(", ".join("?" * len(row))), row)
+            else:
+                connection.execute("UPDATE series SET NumberOfSlices = ? WHERE " + keyCondition, (numberOfSlices,) + seriesKey)
+    connection.close()
+    return len(changed), len(removed), len(fileStats) - len(changed)
+
+
+def QueryDICOMIndex(indexFile, where=None, columns=IMAGE_METADATA_FIELDS):
+    """
+    Args:
+        indexFile (str): Path of the SQLite index.
+        where (str):     SQL condition on the series columns (IMAGE_METADATA_FIELDS), e.g.
+                         "Manufacturer LIKE 'SIEMENS%' AND SliceThickness <= 1.0". Default (None) selects every series.
+        columns (tuple): Columns to return.
+
+    Returns:
+        A list of tuples, one per selected series, ordered by the series key.
+    """
+    connection = OpenDICOMIndex(indexFile)
+    query = "SELECT {} FROM series".format(", ".join(columns))
+    if where:
+        query += " WHERE " + where
+    query += " ORDER BY " + ", ".join(SERIES_KEY_FIELDS)
+    rows = connection.execute(query).fetchall()
+    connection.close()
+    return rows
+
+
+def SelectSeriesFiles(indexFile, where=None, series_filter=None):
+    """
+    Args:
+        indexFile (str):      Path of the SQLite index.
+        where (str):          SQL condition on the series columns, see QueryDICOMIndex.
+        series_filter (list): SeriesInstanceUIDs to keep. Default (None) keeps every selected series.
+
+    Returns:
+        A dictionary with (PatientID, StudyInstanceUID, SeriesInstanceUID) keys and the sorted list of the
+        series' files as value.
+    """
+    seriesFiles = {}
+    connection = OpenDICOMIndex(indexFile)
+    keyCondition = " AND ".join("{} = ?".format(field) for field in SERIES_KEY_FIELDS)
+    for seriesKey in QueryDICOMIndex(indexFile, where, SERIES_KEY_FIELDS):
+        if series_filter is not None and seriesKey[2] not in series_filter:
+            continue
+        seriesFiles[seriesKey] = [path for (path,) in
+            connection.execute("SELECT Path FROM files WHERE " + keyCondition + " ORDER BY Path", seriesKey)]
+    connection.close()
+    return seriesFiles
+
+
+if __name__ == "__main__":
+    # Parse arguments:
+    parser = argparse.ArgumentParser(description='DICOM Archive Indexer')
+    #
+    required_args = parser.add_argument_group('Required Arguments')
+    required_args.add_argument("-i", "--index", "--INDEX", help="SQLite index file (created if missing)", required=True)
+    #
+    optional_args = parser.add_argument_group('Optional Arguments')
+    optional_args.add_argument("-a", "--archive", "--ARCHIVE",
+        help="Directory of DICOM files to add to (or update in) the index. May be repeated.",
+        action="append", default=[])
+    optional_args.add_argument("-q", "--where", "--WHERE",
+        help="List the series matching this SQL condition on the series columns, e.g. \"SliceThickness <= 1.0\"",
+        default=None)
+    optional_args.add_argument("-c", "--columns", "--COLUMNS",
+        help="Comma separated columns to list (default: SeriesInstanceUID, NumberOfSlices, SliceThickness, Manufacturer, SeriesDescription)",
+        default="SeriesInstanceUID,NumberOfSlices,SliceThickness,Manufacturer,SeriesDescription")
+    optional_args.add_argument("-w", "--workers", "--WORKERS",
+        help="Number of threads reading DICOM headers (default: chosen by the thread pool)",
+        type=int, default=None)
+    args = parser.parse_args()
+
+    for archiveDir in args.archive:
+        print("Indexing {}{}{}...".format(BashColours.BOLDBLUE, archiveDir, BashColours.RESET))
+        tic = time.time()
+        changedFiles, removedFiles, unchangedFiles = UpdateDICOMIndex(archiveDir, args.index, workers=args.workers)
+        toc = time.time()
+        print("{} new or modified, {} removed, {} unchanged files ({}{}{} s.)".format(
+            changedFiles, removedFiles, unchangedFiles, BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
+
+    columns = tuple(column.strip() for column in args.columns.split(","))
+    rows = QueryDICOMIndex(args.index, args.where, columns)
+    if args.where is not None:
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join("" if value is None else str(value) for value in row))
+    print("{}{}{} series{}".format(BashColours.BOLDGREEN, len(rows), BashColours.RESET,
+        "" if args.where is None else " matching \"{}\"".format(args.where)))
@@ -4,14 +4,16 @@
 import os
 import json
 import time
+from itertools import repeat
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
-from scipy import stats
-import pydicom
-import pandas as pd
-import itk
 import argparse
 
+from Nifti_Writer import NiftiSlabWriter, write_nifti
+from Conversion_Cache import ConversionCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_GB, get_cache_key, get_file_stats
+
 
 
 
@@ -74,6 +76,29 @@ def GetTagAsJSON(_GTds, _GTtagHex1, _GTtagHex2):
         return _GTtempJSON
 
 
+IMAGE_METADATA_FIELDS = (
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "PatientName",
+    "StudyID",
+    "StudyDescription",
+    "SeriesDescription",
+    "NumberOfSlices",
+    "SliceThickness",
+    "PixelSpacing",
+    "AcquisitionDate",
+    "AcquisitionDateTime",
+    "InstitutionName",
+    "InstitutionCode",
+    "Manufacturer",
+    "ManufacturerModelName",
+    "WindowCenter",
+    "WindowWidth",
+    "ImageOrientationPatient",
+)
+
+
 def GetImageMetaData(dicom_series, parse_JSON=False):
     """
     Args:
@@ -81,7 +106,7 @@ def GetImageMetaData(dicom_series, parse_JSON=False):
         parse_JSON   (bool): Whether or not the JSON block should be parsed. Default is False. 
 
     Returns:
-        a list of metadata
+        a list of metadata, labelled by IMAGE_METADATA_FIELDS (followed by the JSON block if parsed)
     """
     currentDS = next(iter(dicom_series.values()), None)
     if currentDS is None:
@@ -137,166 +162,840 @@ def GetImageMetaData(dicom_series, parse_JSON=False):
     return tempList
 
 
-def GetImageVolume(dicom_series, spacing_from_image_position=False):
+def GetVolumeDataType(datasets):
+    """
+    Args:
+        datasets (iterable): The slices (PyDicom.dataset) of the series.
+
+    Returns:
+        numpy.dtype: int16 if the rescale slope and intercept of every slice are integral and every 
+        rescaled value of their stored pixel ranges fits in int16, float32 otherwise.
+    """
+    int16_info = np.iinfo(np.int16)
+    checked = set()
+    for dataset in datasets:
+        slope     = float(dataset.RescaleSlope    )
+        intercept = float(dataset.RescaleIntercept)
+        bits_stored = int(dataset.BitsStored)
+        signed = int(dataset.PixelRepresentation) == 1
+        if (slope, intercept, bits_stored, signed) in checked:
+            continue
+        checked.add((slope, intercept, bits_stored, signed))
+        if not (slope.is_integer() and intercept.is_integer()):
+            return np.dtype(np.float32)
+        if signed:
+            stored_range = (-2**(bits_stored - 1), 2**(bits_stored - 1) - 1)
+        else:
+            stored_range = (0, 2**bits_stored - 1)
+        rescaled_range = [v * slope + intercept for v in stored_range]
+        if not all(int16_info.min <= v <= int16_info.max for v in rescaled_range + [slope, intercept]):
+            return np.dtype(np.float32)
+    return np.dtype(np.int16)
+
+
+def GetImageVolume(dicom_series, spacing_from_image_position=False, dtype=None):
     """
     Args:
         dicom_series (dict):                A dictionary with slice_z as the key and dataset as value. 
-        spacing_from_image_position (bool): Set to true to use the z component of the image positions for z-spacing.
+        spacing_from_image_position (bool): Set to true to use the image positions (see GetSeriesGeometry) for z-spacing.
+        dtype (numpy.dtype):                Data type of the volume. Default (None) picks it with GetVolumeDataType.
+                                            Each slice is rescaled with its own RescaleSlope and RescaleIntercept.
 
     Returns:
         Tuple ((numpy_array),(float,float,float)): Returns a tuple of a 3D Numpy array containing
-        the pixel values and a list of spacing values.
+        the pixel values and a list of (x, y, z) spacing values.
     """
 
-    ## Get dimensions and spacings from the first slice:
+    ## Get dimensions and spacings from the first slice (PixelSpacing is row spacing, column spacing):
     a_slice = next(iter(dicom_series),None)
     if a_slice is None:
         raise Exception('Empty dataset dictionary!')
     tempDS = dicom_series[a_slice]
-    dimX = int(tempDS.Rows)
-    dimY = int(tempDS.Columns)
+    dimX = int(tempDS.Columns)
+    dimY = int(tempDS.Rows)
     dimZ = len(dicom_series)
-    spacing = [float(i) for i in tempDS.PixelSpacing]
+    spacing = [float(tempDS.PixelSpacing[1]), float(tempDS.PixelSpacing[0])]
     spacing.append(float(tempDS.SliceThickness))
 
-    slope     = float(tempDS.RescaleSlope    )
-    intercept = float(tempDS.RescaleIntercept)
+    if dtype is None:
+        dtype = GetVolumeDataType(dicom_series.values())
 
-    ## Initialize the numpy array
-    temp_z_coords=[]
-    image_3d_array = np.zeros((dimZ,dimY,dimX),dtype=float)
+    ## Decode every slice straight into the preallocated volume and rescale it in place:
+    image_3d_array = np.empty((dimZ,dimY,dimX),dtype=dtype)
     for idx,slice_z in enumerate(sorted(dicom_series,reverse=False),start=0):
-        temp_imagePositionPatient = GetTagAsList(dicom_series[slice_z], 0x0020,0x0032, _length=3)
-        temp_z_coords.append(float(temp_imagePositionPatient[2]))
-    
+        slope     = float(dicom_series[slice_z].RescaleSlope    )
+        intercept = float(dicom_series[slice_z].RescaleIntercept)
+        if np.issubdtype(dtype, np.integer):
+            if not (slope.is_integer() and intercept.is_integer()):
+                raise Exception('Slice %s has a non-integral rescale (slope %g, intercept %g) for the %s volume!' %(
+                    idx+1, slope, intercept, np.dtype(dtype).name))
+            slope, intercept = int(slope), int(intercept)
         try:
-            tempSliceNumpyArray = dicom_series[slice_z].pixel_array.astype('float32')
+            tempSliceNumpyArray = getattr(dicom_series[slice_z], "frame_pixels", None)
+            if tempSliceNumpyArray is None:
+                tempSliceNumpyArray = dicom_series[slice_z].pixel_array
         except NotImplementedError as e:
-            raise Exception('Compressed DICOM')
+            raise Exception('No decoder for the compressed (%s) pixel data of slice %s, see ReadDICOMPixels!' %(
+                GetTransferSyntaxName(dicom_series[slice_z]), idx+1))
         except Exception as e:
             raise Exception('Unexpected Exception while extracting pixel array of slice %s' %(idx+1))
-        image_3d_array[idx,:,:] = np.add(np.multiply(tempSliceNumpyArray, slope), intercept)
+        tempSlice = image_3d_array[idx,:,:]
+        np.copyto(tempSlice, tempSliceNumpyArray, casting='unsafe')
+        if slope != 1:
+            np.multiply(tempSlice, slope, out=tempSlice)
+        if intercept != 0:
+            np.add(tempSlice, intercept, out=tempSlice)
 
-    if spacing_from_image_position:
-        temp_z_spacing_list = [(x - y) for x, y in zip(temp_z_coords,temp_z_coords[1:])]
-        temp_z_coords = None
-        temp_z_spacing = stats.mode(temp_z_spacing_list)
-        temp_z_spacing_list = None
-        spacing[2] = float(temp_z_spacing[0]) #np.asscalar(temp_z_spacing[0])
+    if spacing_from_image_position and dimZ > 1:
+        spacing[2] = GetSeriesGeometry(dicom_series)["spacing"][2]
 
     return image_3d_array, spacing
 
 
-def ReadDICOMSeries(srcDir, only_read_header=False):    
+def _ReadDICOMFile(filename, only_read_header):
+    """
+    Args:
+        filename (str):          Path to the DICOM file.
+        only_read_header (bool): Stop before the pixel data and defer reading large elements.
+                                 Otherwise the pixel data is read, but not decoded (see _DecodeDICOMDataset).
+
+    Returns:
+        Tuple (PyDicom.dataset, Exception): The dataset (None on failure) and the raised exception (None on success).
+    """
+    import pydicom  # Deferred, so --help and argument errors do not pay for it
+    try:
+        if only_read_header:
+            dataset = pydicom.dcmread(filename, stop_before_pixels=True, defer_size="1 KB")
+        else:
+            dataset = pydicom.dcmread(filename, defer_size="16 MB")  # Large (multi-frame) pixel data is mapped, see GetMultiFramePixels
+    except Exception as e:
+        return None, e
+    return dataset, None
+
+
+def IsCompressed(dataset):
+    """
+    Args:
+        dataset (PyDicom.dataset): A DICOM slice.
+
+    Returns:
+        True if the pixel data of the slice is in a compressed (encapsulated) transfer syntax.
+    """
+    file_meta = getattr(dataset, "file_meta", None)
+    transferSyntax = getattr(file_meta, "TransferSyntaxUID", None)
+    return transferSyntax is not None and transferSyntax.is_compressed
+
+
+def GetTransferSyntaxName(dataset):
+    """
+    Args:
+        dataset (PyDicom.dataset): A DICOM slice.
+
+    Returns:
+        The name of the transfer syntax of the slice (or "unknown transfer syntax"), for error messages.
+    """
+    file_meta = getattr(dataset, "file_meta", None)
+    transferSyntax = getattr(file_meta, "TransferSyntaxUID", None)
+    return "unknown transfer syntax" if transferSyntax is None else transferSyntax.name
+
+
+def _DecodeDICOMDataset(dataset, decoder=None):
+    """
+    Args:
+        dataset (PyDicom.dataset): A DICOM slice, with its pixel data read.
+        decoder (str):             pydicom decoding plugin (pydicom >= 3, e.g. "pylibjpeg", "gdcm", "pillow") or
+                                   pixel data handler (pydicom 2) for compressed slices. Default (None) lets pydicom pick.
+
+    Returns:
+        Tuple (PyDicom.dataset, float, Exception): The dataset, its pixel data decompressed in place and decoded
+        (multi-frame files are only decompressed), the decoding time in seconds and the raised exception (None on success).
+    """
+    import pydicom
+    tic = time.time()
+    try:
+        if IsCompressed(dataset):
+            if int(pydicom.__version__.split(".")[0]) >= 3:
+                dataset.decompress(decoding_plugin=decoder or "", generate_instance_uid=False)
+            else:
+                dataset.decompress(handler_name=decoder or "")
+        if not IsMultiFrame(dataset):
+            dataset.pixel_array  # Decode now, the array is cached on the dataset (frames are views, see GetDICOMFrames)
+    except Exception as e:
+        return dataset, time.time() - tic, e
+    return dataset, time.time() - tic, None
+
+
+def ReadDICOMHeaders(filenames, workers=None, expand_frames=True):
+    """
+    Args:
+        filenames (list):     DICOM files to read.
+        workers (int):        Number of reader threads. Default (None) lets the thread pool decide.
+        expand_frames (bool): Replace multi-frame files by one frame dataset per frame (see GetDICOMFrames).
+
+    Returns:
+        A list of (filename, PyDicom.dataset) tuples in the order of filenames. Pixel data is not read, and
+        files that fail to read are reported and skipped.
+    """
+    headers = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, (dataset, e) in zip(filenames, 
+                executor.map(lambda f: _ReadDICOMFile(f, True), filenames)):
+            if dataset is None:
+                print("\tERROR while reading \"", filename, "\": ", e)
+                print("\tSkipping..."                                  )
+                continue
+            if expand_frames and IsMultiFrame(dataset):
+                headers += [(filename, frame) for frame in GetDICOMFrames(dataset)]
+            else:
+                headers.append((filename, dataset))
+    return headers
+
+
+def ScanDICOMHeaders(srcDir, workers=None):
+    """
+    Args:
+        srcDir (str):  A directory to be searched for dicom images
+        workers (int): Number of reader threads. Default (None) lets the thread pool decide.
+
+    Returns:
+        A list of (filename, PyDicom.dataset) tuples in directory walk order, with one frame dataset per frame
+        of a multi-frame file (see GetDICOMFrames). Pixel data is not read.
+    """
+    filenames = [os.path.join(root, file) for root, dirs, files in os.walk(srcDir) for file in files]
+    return ReadDICOMHeaders(filenames, workers=workers)
+
+
+def IsMultiFrame(dataset):
+    return int(dataset.get("NumberOfFrames", 1) or 1) > 1
+
+
+def GetFunctionalGroupValue(dataset, frameIndex, sequenceKeyword, keyword, default=None, top_level=True):
+    """
+    Args:
+        dataset (PyDicom.dataset): A multi-frame DICOM object.
+        frameIndex (int):          Index of the frame.
+        sequenceKeyword (str):     Functional group macro, e.g. "PlanePositionSequence".
+        keyword (str):             Attribute within it, e.g. "ImagePositionPatient".
+        default:                   Returned if neither the functional groups nor (with top_level) the dataset have it.
+        top_level (bool):          Fall back to the top level of the dataset.
+
+    Returns:
+        The value from the per-frame functional groups of the frame, else from the shared ones, else from the
+        top level of the dataset, else default.
+    """
+    for groupsKeyword, groupIndex in (("PerFrameFunctionalGroupsSequence", frameIndex), ("SharedFunctionalGroupsSequence", 0)):
+        groups = dataset.get(groupsKeyword)
+        if groups is None or len(groups) <= groupIndex:
+            continue
+        sequence = groups[groupIndex].get(sequenceKeyword)
+        if sequence is not None and len(sequence) > 0 and keyword in sequence[0]:
+            return sequence[0][keyword].value
+    return dataset.get(keyword, default) if top_level else default
+
+
+def GetMultiFramePixels(dataset):
+    """
+    Args:
+        dataset (PyDicom.dataset): A multi-frame DICOM object, with its pixel data read, deferred or decompressed.
+
+    Returns:
+        numpy.ndarray: The (frames, rows, columns) pixels. Native single-sample pixel data is not copied: deferred
+        pixel data is memory mapped from the file, loaded pixel data wrapped. Anything else (e.g. signed data with
+        unused high bits) is decoded by pydicom.
+    """
+    frames, rows, columns = int(dataset.NumberOfFrames), int(dataset.Rows), int(dataset.Columns)
+    bitsAllocated = int(dataset.BitsAllocated)
+    signed = int(dataset.PixelRepresentation) == 1
+    if (not IsCompressed(dataset) and int(dataset.get("SamplesPerPixel", 1)) == 1 and bitsAllocated in (8, 16, 32)
+            and (not signed or int(dataset.BitsStored) == bitsAllocated)):
+        byteOrder = ">" if dataset.file_meta.get("TransferSyntaxUID") == "1.2.840.10008.1.2.2" else "<"  # Explicit VR Big Endian
+        dtype = np.dtype("{}{}{}".format(byteOrder, "i" if signed else "u", bitsAllocated // 8))
+        import pydicom
+        if int(pydicom.__version__.split(".")[0]) >= 3:
+            element = dataset.get_item("PixelData", keep_deferred=True)
+        else:
+            element = dataset.get_item("PixelData")  # Deferred elements are kept raw
+        if element.value is None and getattr(element, "value_tell", None) is not None:
+            return np.memmap(dataset.filename, dtype=dtype, mode="r", offset=element.value_tell, shape=(frames, rows, columns))
+        return np.frombuffer(dataset.PixelData, dtype=dtype, count=frames * rows * columns).reshape(frames, rows, columns)
+    return dataset.pixel_array.reshape(frames, rows, columns)
+
+
+def GetDICOMFrames(dataset, with_pixels=False, frame_indices=None):
+    """
+    Args:
+        dataset (PyDicom.dataset): A multi-frame DICOM object (e.g. Enhanced CT/MR).
+        with_pixels (bool):        Attach each frame's pixels (a view, see GetMultiFramePixels) as frame_pixels.
+        frame_indices (list):      Indices of the frames to return. Default (None) returns them all.
+
+    Returns:
+        A list of frame datasets, one per frame index, carrying the attributes of a single-frame slice (position,
+        orientation, spacing, rescale) from the functional groups, with filename and frame_index set.
+        Frames without a position of their own are placed SpacingBetweenSlices (or SliceThickness) apart, along
+        the normal from the top-level ImagePositionPatient or, without one, by SliceLocation.
+    """
+    import pydicom
+    pixels = GetMultiFramePixels(dataset) if with_pixels else None
+    imageOrientationPatient = GetFunctionalGroupValue(dataset, 0, "PlaneOrientationSequence", "ImageOrientationPatient")
+    frames = []
+    if frame_indices is None:
+        frame_indices = range(int(dataset.NumberOfFrames))
+    for frameIndex in frame_indices:
+        frame = pydicom.Dataset()
+        frame.file_meta = dataset.file_meta
+        for keyword in ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "Modality",
+                        "Rows", "Columns", "SamplesPerPixel", "PhotometricInterpretation",
+                        "BitsAllocated", "BitsStored", "HighBit", "PixelRepresentation"):
+            if keyword in dataset:
+                frame[keyword] = dataset[keyword]
+        frame.PixelSpacing     = GetFunctionalGroupValue(dataset, frameIndex, "PixelMeasuresSequence", "PixelSpacing")
+        frame.SliceThickness   = GetFunctionalGroupValue(dataset, frameIndex, "PixelMeasuresSequence", "SliceThickness", 1.0)
+        frame.RescaleSlope     = GetFunctionalGroupValue(dataset, frameIndex, "PixelValueTransformationSequence", "RescaleSlope", 1.0)
+        frame.RescaleIntercept = GetFunctionalGroupValue(dataset, frameIndex, "PixelValueTransformationSequence", "RescaleIntercept", 0.0)
+        orientation = GetFunctionalGroupValue(dataset, frameIndex, "PlaneOrientationSequence", "ImageOrientationPatient", imageOrientationPatient)
+        position    = GetFunctionalGroupValue(dataset, frameIndex, "PlanePositionSequence", "ImagePositionPatient", top_level=False)
+        step = float(dataset.get("SpacingBetweenSlices", frame.SliceThickness))
+        if orientation is not None:
+            frame.ImageOrientationPatient = orientation
+            if position is None and "ImagePositionPatient" in dataset:
+                normal = np.cross(np.array(orientation[:3], dtype=np.float64), np.array(orientation[3:], dtype=np.float64))
+                position = [float(v) for v in np.array(dataset.ImagePositionPatient, dtype=np.float64) + frameIndex * step * normal]
+        if position is not None:
+            frame.ImagePositionPatient = position
+        else:
+            frame.SliceLocation = frameIndex * step
+        frame.filename = dataset.filename
+        frame.frame_index = frameIndex
+        if pixels is not None:
+            frame.frame_pixels = pixels[frameIndex]
+        frames.append(frame)
+    return frames
+
+
+def GetPixelSource(dataset):
+    """
+    Args:
+        dataset (PyDicom.dataset): A (header-only) slice or frame dataset.
+
+    Returns:
+        Its filename or, for a frame of a multi-frame file, the (filename, frame index) tuple ReadDICOMPixels takes.
+    """
+    frameIndex = getattr(dataset, "frame_index", None)
+    return dataset.filename if frameIndex is None else (dataset.filename, frameIndex)
+
+
+SLICE_POSITION_TOLERANCE = 1e-3  # mm; closer slices are duplicates, relative spacing deviations beyond it are reported
+
+
+def GetSliceOrientation(dataset):
+    """
+    Args:
+        dataset (PyDicom.dataset): A DICOM slice.
+
+    Returns:
+        numpy.ndarray: The (3, 3) matrix of the row direction, column direction and slice normal (as rows),
+        in patient (LPS) coordinates, or None if the slice has no ImageOrientationPatient.
+    """
+    imageOrientationPatient = GetTagAsList(dataset, 0x0020,0x0037, _length=6)
+    if "" in imageOrientationPatient:
+        return None
+    rowDirection, columnDirection = np.array(imageOrientationPatient, dtype=np.float64).reshape(2, 3)
+    return np.array([rowDirection, columnDirection, np.cross(rowDirection, columnDirection)])
+
+
+def GetSlicePositions(datasets):
+    """
+    Args:
+        datasets (list): DICOM slices (PyDicom.dataset) of one series.
+
+    Returns:
+        numpy.ndarray: The position of every slice along the slice normal of the first one (the projection of
+        its ImagePositionPatient), or its SliceLocation if the series lacks ImagePositionPatient/ImageOrientationPatient.
+    """
+    orientation = GetSliceOrientation(datasets[0]) if len(datasets) > 0 else None
+    imagePositions = [GetTagAsList(ds, 0x0020,0x0032, _length=3) for ds in datasets]
+    if orientation is None or any("" in position for position in imagePositions):
+        return np.array([GetTagAsFloat(ds, 0x0020,0x1041) for ds in datasets], dtype=np.float64)
+    return np.array(imagePositions, dtype=np.float64) @ orientation[2]
+
+
+def IndexDICOMSlices(headers):
+    """
+    Args:
+        headers (list): (filename, PyDicom.dataset) tuples of one series.
+
+    Returns:
+        A dictionary with the slice position (float, see GetSlicePositions) as the key and (filename, dataset) as
+        value. Of several slices at the same position only the first is kept, and the others are reported.
+    """
+    positions = GetSlicePositions([dataset for filename, dataset in headers])
+    order = np.argsort(positions, kind="stable")
+    sliceIndex = {}
+    lastPosition = None
+    for idx in order:
+        filename, dataset = headers[idx]
+        if lastPosition is not None and positions[idx] - lastPosition < SLICE_POSITION_TOLERANCE:
+            print("{}WARNING:{} \"{}\" duplicates the slice position {} of \"{}\". Skipping...".format(
+                BashColours.BOLDRED, BashColours.RESET, filename, lastPosition, sliceIndex[lastPosition][0]))
+            continue
+        lastPosition = float(positions[idx])
+        sliceIndex[lastPosition] = (filename, dataset)
+    return sliceIndex
+
+
+def GetSeriesGeometry(dicom_series):
+    """
+    Args:
+        dicom_series (dict): A dictionary with the slice position as the key and a (header-only) dataset as value.
+
+    Returns:
+        A dictionary describing the volume in the orientation WriteNumpyToNifti writes it (slices and rows
+        flipped), in ITK's LPS convention:
+            "spacing"   ([float]*3):     x (column), y (row) and z (slice) spacing; z from the slice positions.
+            "origin"    (numpy.ndarray): Position of the first voxel written.
+            "direction" (numpy.ndarray): (3, 3) matrix with the x, y and z axes as columns.
+            "warnings"  ([str]):         Gaps, non-uniform spacing, inconsistent orientations and gantry tilt.
+    """
+    sliceKeys = sorted(dicom_series)
+    datasets = [dicom_series[sliceKey] for sliceKey in sliceKeys]
+    tempDS = datasets[0]
+    spacing = [float(tempDS.PixelSpacing[1]), float(tempDS.PixelSpacing[0]), float(tempDS.SliceThickness)]
+    warnings = []
+
+    orientation = GetSliceOrientation(tempDS)
+    imagePositions = [GetTagAsList(ds, 0x0020,0x0032, _length=3) for ds in datasets]
+    if orientation is None or any("" in position for position in imagePositions):
+        warnings.append("No ImagePositionPatient/ImageOrientationPatient, the origin and direction are unknown")
+        return {"spacing": spacing, "origin": np.zeros(3), "direction": np.eye(3), "warnings": warnings}
+    imagePositions = np.array(imagePositions, dtype=np.float64)
+    positions = imagePositions @ orientation[2]
+
+    orientations = np.array([GetTagAsList(ds, 0x0020,0x0037, _length=6) for ds in datasets[1:]] or np.zeros((0, 6)), dtype=np.float64)
+    if np.any(np.abs(orientations - orientation[:2].ravel()) > SLICE_POSITION_TOLERANCE):
+        warnings.append("The slices do not share one ImageOrientationPatient")
+
+    if len(positions) > 1:
+        steps = np.diff(positions)
+        spacing[2] = float(np.median(steps))
+        gaps = np.nonzero(steps > 1.5 * spacing[2])[0]
+        if len(gaps) > 0:
+            warnings.append("{} gap(s) in the slice positions, after slice(s) {}".format(len(gaps), ", ".join(str(g) for g in gaps)))
+        elif np.max(np.abs(steps - spacing[2])) > SLICE_POSITION_TOLERANCE * max(1.0, spacing[2]):
+            warnings.append("Non-uniform slice spacing ({:.4f} to {:.4f} mm), using the median {:.4f} mm".format(
+                steps.min(), steps.max(), spacing[2]))
+        inPlaneOffsets = imagePositions - np.outer(positions, orientation[2])
+        if np.max(np.abs(inPlaneOffsets - inPlaneOffsets[0])) > SLICE_POSITION_TOLERANCE * max(1.0, spacing[2]):
+            warnings.append("The slices are sheared (gantry tilt), the volume is not resampled")
+
+    ## WriteNumpyToNifti flips the slices and the rows: x runs along the rows (+row direction), y up the
+    ## columns (-column direction) from the last row, and z down the normal (-normal) from the last slice.
+    rows = int(tempDS.Rows)
+    origin = imagePositions[-1] + (rows - 1) * spacing[1] * orientation[1]
+    direction = np.column_stack([orientation[0], -orientation[1], -orientation[2]])
+    return {"spacing": spacing, "origin": origin, "direction": direction, "warnings": warnings}
+
+
+def GetSeriesKey(dataset):
+    """
+    Args:
+        dataset (PyDicom.dataset): A DICOM slice.
+
+    Returns:
+        Tuple (str,str,str): (PatientID, StudyInstanceUID, SeriesInstanceUID) of the slice.
+    """
+    return (GetTagAsStr(dataset,0x0010,0x0020),
+            GetTagAsStr(dataset,0x0020,0x000D),
+            GetTagAsStr(dataset,0x0020,0x000E))
+
+
+def ReadDICOMSeries(srcDir, only_read_header=False, workers=None):    
     """
     Args:
         srcDir (str):            A directory to be searched for dicom images 
         only_read_header (bool): Only read the header!
+        workers (int):           Number of reader threads. Default (None) lets the thread pool decide.
 
     Returns:
         A dictionary with slice_z (float) keys and PyDicom.dataset as value.
     """
-    dicomFilesDict = {}
+    ## Header-only pass: validate the UIDs and build the slice index
+    headers = []
 
     patientID            = None
     studyInstanceUID     = None
     seriesInstanceUID    = None
 
-    for root,dirs,files in os.walk(srcDir):
-        for file in files:
-            try:
-                #print(os.path.join(root,file))
-                dataset = pydicom.read_file(os.path.join(root,file), stop_before_pixels=only_read_header)
-            except Exception as e:
-                print("\tERROR while reading \"", os.path.join(root,file), "\": ", e)      
-                print("\tSkipping..."                                                  )
-                continue
-        
-            if patientID is None:
-                patientID         = GetTagAsStr(dataset,0x0010,0x0020)
-                studyInstanceUID  = GetTagAsStr(dataset,0x0020,0x000D)
-                seriesInstanceUID = GetTagAsStr(dataset,0x0020,0x000E)
-            else: 
-                if patientID != GetTagAsStr(dataset,0x0010,0x0020):
-                    raise Exception('Series contains multiple PatientIDs!')
-                if studyInstanceUID != GetTagAsStr(dataset,0x0020,0x000D):
-                    raise Exception('Series contains multiple StudyInstanceUIDs!')
-                if seriesInstanceUID != GetTagAsStr(dataset,0x0020,0x000E):
-                    raise Exception('Series contains multiple SeriesInstanceUIDs!')
-            
-            sliceLocation        = GetTagAsFloat(dataset, 0x0020,0x1041)
-            imagePositionPatient = GetTagAsList(dataset, 0x0020,0x0032, _length=3)           
-            if imagePositionPatient[2] != "" and imagePositionPatient[2] != sliceLocation:
-                sliceZ = float(imagePositionPatient[2])
+    for filename, dataset in ScanDICOMHeaders(srcDir, workers=workers):
+        if patientID is None:
+            patientID, studyInstanceUID, seriesInstanceUID = GetSeriesKey(dataset)
+        else: 
+            if patientID != GetTagAsStr(dataset,0x0010,0x0020):
+                raise Exception('Series contains multiple PatientIDs!')
+            if studyInstanceUID != GetTagAsStr(dataset,0x0020,0x000D):
+                raise Exception('Series contains multiple StudyInstanceUIDs!')
+            if seriesInstanceUID != GetTagAsStr(dataset,0x0020,0x000E):
+                raise Exception('Series contains multiple SeriesInstanceUIDs!')
+    
+        headers.append((filename, dataset))
+    sliceIndex = IndexDICOMSlices(headers)
+
+    if only_read_header:
+        return {sliceZ: dataset for sliceZ, (filename, dataset) in sliceIndex.items()}
+
+    ## Pixel pass: read and decode only the accepted slices
+    return ReadDICOMPixels({sliceZ: GetPixelSource(dataset) for sliceZ, (filename, dataset) in sliceIndex.items()}, workers=workers)
+
+
+def ReadDICOMStudy(srcDir, only_read_header=False, workers=None, series_filter=None):
+    """
+    Args:
+        srcDir (str):            A directory to be searched for dicom images 
+        only_read_header (bool): Only read the header!
+        workers (int):           Number of reader threads. Default (None) lets the thread pool decide.
+        series_filter (list):    SeriesInstanceUIDs to keep. Default (None) keeps every series.
+
+    Returns:
+        A dictionary with (PatientID, StudyInstanceUID, SeriesInstanceUID) keys and, as value, the
+        series dictionary (slice_z keys and PyDicom.dataset values) that GetImageVolume consumes.
+    """
+    ## Single header-only pass, grouping slices by series
+    seriesIndex = {}
+    for filename, dataset in ScanDICOMHeaders(srcDir, workers=workers):
+        seriesKey = GetSeriesKey(dataset)
+        if series_filter is not None and seriesKey[2] not in series_filter:
+            continue
+        seriesIndex.setdefault(seriesKey, []).append((filename, dataset))
+    seriesIndex = {seriesKey: IndexDICOMSlices(headers) for seriesKey, headers in seriesIndex.items()}
+
+    if only_read_header:
+        return {seriesKey: {sliceZ: dataset for sliceZ, (filename, dataset) in sliceIndex.items()}
+                for seriesKey, sliceIndex in seriesIndex.items()}
+
+    ## Pixel pass: read and decode only the accepted slices
+    return {seriesKey: ReadDICOMPixels({sliceZ: GetPixelSource(dataset) for sliceZ, (filename, dataset) in sliceIndex.items()}, workers=workers)
+            for seriesKey, sliceIndex in seriesIndex.items()}
+
+
+def ReadDICOMPixels(slice_files, workers=None, decoder=None, decode_times=None, process_pool=None, dataset_cache=None):
+    """
+    Args:
+        slice_files (dict):  A dictionary with slice_z as the key and, as value, the DICOM filename or, for a frame
+                             of a multi-frame file, the (filename, frame index) tuple (see GetPixelSource).
+        workers (int):       Number of reader and decoder threads (and processes, for compressed files).
+                             Default (None) lets the pools decide.
+        decoder (str):       Decoding plugin for compressed files, see _DecodeDICOMDataset.
+        decode_times (dict): If given, the decoding time (s) of each file is stored in it, keyed by filename.
+        process_pool (concurrent.futures.ProcessPoolExecutor): Pool decoding the compressed files. Default (None)
+                             starts one for this call if there are several compressed files and workers is not 1.
+        dataset_cache (dict): If given, decoded multi-frame files are kept in it (keyed by filename) and reused, so
+                             slabs of the same file do not read and decode it again.
+
+    Returns:
+        A dictionary with slice_z (float) keys and PyDicom.dataset, with decoded pixel data, as value.
+        Frames of multi-frame files are frame datasets (see GetDICOMFrames) whose pixels are views of the file's.
+    """
+    ## Every file is read and decoded once, however many of its frames are slices.
+    filenames = list(dict.fromkeys(source[0] if isinstance(source, tuple) else source for source in slice_files.values()))
+    dicomFilesDict = {}
+    if dataset_cache is not None:
+        dicomFilesDict = {filename: dataset_cache[filename] for filename in filenames if filename in dataset_cache}
+        filenames = [filename for filename in filenames if filename not in dicomFilesDict]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, (dataset, e) in zip(filenames, 
+                executor.map(lambda f: _ReadDICOMFile(f, False), filenames)):
+            if dataset is None:
+                raise Exception('Failed to read the pixel data of \"%s\": %s' %(filename, e))
+            dicomFilesDict[filename] = dataset
+
+        ## Uncompressed files decode in threads (NumPy copies), compressed ones in processes, as
+        ## JPEG and JPEG 2000 decoders hold the GIL. Results are keyed by filename, so the order of
+        ## completion does not matter.
+        uncompressed = [filename for filename in filenames if not IsCompressed(dicomFilesDict[filename])]
+        compressed   = [filename for filename in filenames if     IsCompressed(dicomFilesDict[filename])]
+        results = list(zip(uncompressed, executor.map(lambda f: _DecodeDICOMDataset(dicomFilesDict[f], decoder), uncompressed)))
+        if len(compressed) > 0:
+            if process_pool is None and (len(compressed) == 1 or workers == 1):
+                decoded = executor.map(lambda f: _DecodeDICOMDataset(dicomFilesDict[f], decoder), compressed)
+                results += list(zip(compressed, decoded))
             else:
-                sliceZ = sliceLocation
-        
-            #print(sliceZ)
-            dicomFilesDict[sliceZ] = dataset
-    return dicomFilesDict
-
-
-def WriteNumpyToNifti(np_array, spacing, outputImageFileName):
-    # number_of_dimensions = 3
-    # pixelType = itk.ctype("float")
-    # imageType = itk.Image[ pixelType, number_of_dimensions ]
-
-    np_array = np.flip(np_array,axis=0)
-    np_array = np.flip(np_array,axis=1)
-    outputImage = itk.GetImageFromArray(np_array.astype(np.float32)) 
-    outputImage.SetSpacing(spacing) 
-    outputImage.SetOrigin((0.,0.,0.)) 
-
-    # imageCastFilter = itk.CastImageFilter[ outputImage, imageType ].New()
-    # imageCastFilter.SetInput(outputImage)
-    # 
-    imageWriter = itk.ImageFileWriter[outputImage].New()
-    imageWriter.SetImageIO(itk.NiftiImageIO.New())
-    imageWriter.SetFileName(outputImageFileName)
-    imageWriter.SetInput(outputImage)  #imageCastFilter.GetOutput())
+                with (ProcessPoolExecutor(max_workers=workers) if process_pool is None else nullcontext(process_pool)) as pool:
+                    decoded = pool.map(_DecodeDICOMDataset, [dicomFilesDict[f] for f in compressed], repeat(decoder))
+                    results += list(zip(compressed, decoded))
+
+    for filename, (dataset, seconds, e) in results:
+        if e is not None:
+            raise Exception('Failed to decode the %s pixel data of \"%s\": %s (install a decoder such as pylibjpeg or python-gdcm, or pick one with --decoder)' %(
+                GetTransferSyntaxName(dataset), filename, e))
+        dicomFilesDict[filename] = dataset
+        if decode_times is not None:
+            decode_times[filename] = seconds
+        if dataset_cache is not None and IsMultiFrame(dataset):
+            dataset_cache[filename] = dataset
+
+    frameIndices = {}
+    for source in slice_files.values():
+        if isinstance(source, tuple):
+            frameIndices.setdefault(source[0], []).append(source[1])
+    frameDicts = {filename: dict(zip(indices, GetDICOMFrames(dicomFilesDict[filename], with_pixels=True, frame_indices=indices)))
+                  for filename, indices in frameIndices.items()}
+    return {sliceZ: frameDicts[source[0]][source[1]] if isinstance(source, tuple) else dicomFilesDict[source]
+            for sliceZ, source in slice_files.items()}
+
+
+def PrintDecodeTimeHistogram(decode_times, bins=8):
+    """
+    Args:
+        decode_times (dict): Decoding time (s) of each file, as filled by ReadDICOMPixels.
+        bins (int):          Number of histogram bins.
+    """
+    if len(decode_times) == 0:
+        return
+    times_ms = 1000.0 * np.array(list(decode_times.values()))
+    counts, edges = np.histogram(times_ms, bins=bins)
+    print("Decoding time per file ({} files, median {}{:.2f}{} ms, max {:.2f} ms):".format(
+        len(times_ms), BashColours.BOLDGREEN, np.median(times_ms), BashColours.RESET, times_ms.max()))
+    for count, low, high in zip(counts, edges, edges[1:]):
+        print("\t{:9.2f} - {:9.2f} ms {:6d} {}".format(low, high, count, "#" * int(round(40 * count / counts.max()))))
+
+
+def WriteNumpyToNifti(np_array, spacing, outputImageFileName, workers=None, origin=(0.0, 0.0, 0.0), direction=None):
+    """
+    Args:
+        np_array (numpy.ndarray):  The (z, y, x) volume, as assembled by GetImageVolume.
+        spacing (list):            Voxel spacing (x, y, z) in mm.
+        outputImageFileName (str): Output NIFTI filename.
+        workers (int):             Number of gzip compressor threads. Default (None) uses one per CPU.
+        origin (list):             LPS position of the first voxel written (see GetSeriesGeometry).
+        direction (numpy.ndarray): (3, 3) matrix of the written x, y and z axes as columns. Default (None) is identity.
+    """
+    ## Both flips are views, copied one slab at a time by the writer.
+    ## int16 and float32 volumes keep their data type, anything else is written as float32.
+    dtype = np_array.dtype if np_array.dtype in (np.int16, np.float32) else np.float32
     try:
-        imageWriter.Update()
+        write_nifti(outputImageFileName, np_array[::-1, ::-1], spacing, origin=origin, direction=direction, 
+            dtype=dtype, compress_threads=workers)
     except Exception as e:
         print(BashColours.BOLDRED, "ERROR writing to the ", BashColours.BOLDBLACK, outputImageFileName, BashColours.BOLDRED, " file!", BashColours.RESET)
         print(e)
+        raise  # Not to be cached (or reported) as converted
+
+
+def GetSeriesNiftiFileName(outputImageFileName, seriesKey):
+    """
+    Args:
+        outputImageFileName (str): The NIFTI filename given on the command line.
+        seriesKey (tuple):         (PatientID, StudyInstanceUID, SeriesInstanceUID) of the series.
+
+    Returns:
+        The NIFTI filename of the series, with its SeriesInstanceUID inserted before the extension.
+    """
+    if outputImageFileName.endswith(".nii.gz"):
+        stem, extension = outputImageFileName[:-len(".nii.gz")], ".nii.gz"
+    else:
+        stem, extension = os.path.splitext(outputImageFileName)
+    return "{}_{}{}".format(stem, seriesKey[2], extension)
+
+
+def StreamDICOMSeriesToNifti(dicom_series, outputImageFileName, slab_size=64, workers=None, decoder=None, decode_times=None):
+    """
+    Args:
+        dicom_series (dict):       A dictionary with slice_z as the key and a header-only dataset as value.
+        outputImageFileName (str): Output NIFTI filename.
+        slab_size (int):           Number of slices decoded and held in memory at a time.
+        workers (int):             Number of decoder and gzip compressor threads. Default (None) lets the thread pools decide.
+        decoder (str):             Decoding plugin for compressed slices, see _DecodeDICOMDataset.
+        decode_times (dict):       If given, filled with the decoding time of each file, see ReadDICOMPixels.
+    """
+    a_slice = next(iter(dicom_series),None)
+    if a_slice is None:
+        raise Exception('Empty dataset dictionary!')
+    tempDS = dicom_series[a_slice]
+    geometry = GetSeriesGeometry(dicom_series)
+    dtype = GetVolumeDataType(dicom_series.values())  # Of every slab
+    shape = (len(dicom_series), int(tempDS.Rows), int(tempDS.Columns))
+
+    ## Same orientation as WriteNumpyToNifti: the z flip is done by feeding the slabs from the
+    ## last slice to the first, the y flip by the writer.
+    ## Compressed slices are decoded by one process pool for all the slabs, multi-frame files once.
+    slices = sorted(dicom_series, reverse=True)
+    multiFrameCache = {}
+    with NiftiSlabWriter(outputImageFileName, shape, dtype, geometry["spacing"], geometry["origin"], geometry["direction"], 
+                         flip_y=True, compress_threads=workers) as writer, \
+         (ProcessPoolExecutor(max_workers=workers) if IsCompressed(tempDS) and workers != 1 else nullcontext()) as processPool:
+        for idx in range(0, len(slices), slab_size):
+            slab_files = {sliceZ: GetPixelSource(dicom_series[sliceZ]) for sliceZ in slices[idx:idx + slab_size]}
+            slab_series = ReadDICOMPixels(slab_files, workers=workers, decoder=decoder, 
+                decode_times=decode_times, process_pool=processPool, dataset_cache=multiFrameCache)
+            slab_array, _ = GetImageVolume(slab_series, dtype=dtype)
+            writer.write_slab(slab_array[::-1])
+
+
+def GetDICOMSeriesFingerprint(dicom_series):
+    """
+    Args:
+        dicom_series (dict): A dictionary with slice_z as the key and a (header-only) dataset as value.
+
+    Returns:
+        A JSON serialisable fingerprint of the series: its SeriesInstanceUID, the set of SOPInstanceUIDs
+        and the sizes and modification times of its files.
+    """
+    datasets = list(dicom_series.values())
+    return {"SeriesInstanceUID": GetTagAsStr(datasets[0], 0x0020,0x000E),
+            "SOPInstanceUIDs":   sorted(set(GetTagAsStr(ds, 0x0008,0x0018) for ds in datasets)),
+            "files":             get_file_stats(set(ds.filename for ds in datasets))}
+
+
+def ExportDICOMSeries(dicom_series, outputImageFileName, dry_run=False, slab_size=None, workers=None, cache=None, 
+                      decoder=None, verbose=False):
+    """
+    Args:
+        dicom_series (dict):       A dictionary with slice_z as the key and a header-only dataset as value.
+        outputImageFileName (str): Output NIFTI filename.
+        dry_run (bool):            If True, lists the slices instead of writing the NIFTI file.
+        slab_size (int):           If given, streams the volume to the NIFTI file this many slices at a time.
+        workers (int):             Number of decoder and gzip compressor threads. Default (None) lets the thread pools decide.
+        cache (ConversionCache):   If given, an unchanged series is linked from the cache instead of converted.
+        decoder (str):             Decoding plugin for compressed slices, see _DecodeDICOMDataset.
+        verbose (bool):            If True, prints a histogram of the decoding time per file.
+    """
+    if os.path.isfile(outputImageFileName):
+        print("{}WARNING:{} {}{}{} already exists! It will be overwritten.".format(
+            BashColours.BOLDRED, BashColours.RESET, 
+            BashColours.BOLDBLUE, outputImageFileName, BashColours.RESET))
+
+    if cache is not None and not dry_run:
+        options = {"converter": "DICOM_to_Nifti"}
+        if decoder is not None:
+            options["decoder"] = decoder  # Lossy decoders need not agree to the last bit
+        key = get_cache_key(GetDICOMSeriesFingerprint(dicom_series), options)
+        if cache.fetch(key, [outputImageFileName]):
+            print("Cache hit, linked IMAGE to {}{}{}".format(BashColours.BOLDBLUE, outputImageFileName, BashColours.RESET))
+            return
+        with cache.store(key, [outputImageFileName]) as (tempImageFileName,):
+            ExportDICOMSeries(dicom_series, tempImageFileName, slab_size=slab_size, workers=workers, 
+                decoder=decoder, verbose=verbose)
+        return
+
+    geometry = GetSeriesGeometry(dicom_series)
+    for warning in geometry["warnings"]:
+        print("{}WARNING:{} {}".format(BashColours.BOLDRED, BashColours.RESET, warning))
+    decode_times = {} if verbose else None
+
+    if slab_size is not None and not dry_run:
+        print("Streaming IMAGE to {}{}{} ({} slices per slab)...".format(
+            BashColours.BOLDBLUE, outputImageFileName, BashColours.RESET, slab_size))
+        tic = time.time()
+        StreamDICOMSeriesToNifti(dicom_series, outputImageFileName, slab_size=slab_size, workers=workers, 
+            decoder=decoder, decode_times=decode_times)
+        toc = time.time()
+        print("Done ({}{}{} s.)".format(BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
+        if verbose:
+            PrintDecodeTimeHistogram(decode_times)
+        return
+
+    if not dry_run:
+        image_series_dict = ReadDICOMPixels({sliceZ: GetPixelSource(ds) for sliceZ, ds in dicom_series.items()}, 
+            workers=workers, decoder=decoder, decode_times=decode_times)
+        if verbose:
+            PrintDecodeTimeHistogram(decode_times)
+        image_data_array, _ = GetImageVolume(image_series_dict)
+        print("Writing IMAGE to {}{}{}...".format(BashColours.BOLDBLUE, outputImageFileName, BashColours.RESET))
+        tic = time.time()
+        WriteNumpyToNifti(image_data_array, geometry["spacing"], outputImageFileName, workers=workers, 
+            origin=geometry["origin"], direction=geometry["direction"])
+        toc = time.time()
+        print("Done ({}{}{} s.)".format(BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
+    else:
+        # The headers are all a dry run lists, so no pixel data is read:
+        print("*** DRY RUN ***")
+        print("Spacing:   {}".format(", ".join("{:.4f}".format(v) for v in geometry["spacing"])))
+        print("Origin:    {}".format(", ".join("{:.4f}".format(v) for v in geometry["origin"])))
+        print("Direction: {}".format(", ".join("{:.4f}".format(v) for v in geometry["direction"].ravel())))
+        print("Slices:")
+        print(f"\t{'Z-Location'}\t{'SliceLocation'}\t{'SliceThickness'}")
+        for key in sorted(dicom_series.keys(), reverse=True):
+            ds = dicom_series[key]
+            print(f"\t{key}\t{GetTagAsStr(ds,0x0020,0x1041)}\t{ds.SliceThickness}")
 
 
 if __name__ == "__main__":
     # Parse arguments:
     parser = argparse.ArgumentParser(description='DICOM to NIFTI Convertor')
     #
-    required_args = parser.add_argument_group('Required Arguments')
-    required_args.add_argument("-d", "--dicom", "--DICOM", help="Directory Containing DICOM Images", required=True)
+    required_args = parser.add_argument_group('Required Arguments (one of)')
+    source_args = required_args.add_mutually_exclusive_group(required=True)
+    source_args.add_argument("-d", "--dicom", "--DICOM", help="Directory Containing DICOM Images", default=None)
+    source_args.add_argument("--index", "--INDEX", 
+        help="Convert the series selected from this DICOM_Index.py index (with --where) instead of scanning a directory.", 
+        default=None)
     #
     optional_args = parser.add_argument_group('Optional Arguments')
     optional_args.add_argument("-n", "--nifti", "--NIFTI", help="Output NIFTI filename", default="./output.nii.gz")
     optional_args.add_argument("--dry-run", "--Dry-Run", "--DRY-RUN", 
         help="If provided, skips exporting to nifti.", 
         action="store_true", default=False)
+    optional_args.add_argument("-w", "--workers", "--WORKERS", 
+        help="Number of threads reading and decoding DICOM files and compressing the NIFTI file (default: chosen by the thread pool)", 
+        type=int, default=None)
+    optional_args.add_argument("--split-series", "--SPLIT-SERIES", 
+        help="Convert every series in the directory to its own NIFTI file (named after its SeriesInstanceUID).", 
+        action="store_true", default=False)
+    optional_args.add_argument("-s", "--series-uid", "--SERIES-UID", 
+        help="Only convert this SeriesInstanceUID (may be repeated). Implies --split-series.", 
+        action="append", default=None)
+    optional_args.add_argument("--slab-size", "--SLAB-SIZE", 
+        help="Stream the volume to the NIFTI file this many slices at a time, bounding memory (default: whole volume).", 
+        type=int, default=None)
+    optional_args.add_argument("--where", "--WHERE", 
+        help="SQL condition selecting series from the index, e.g. \"Manufacturer LIKE 'GE%%' AND SliceThickness <= 1.0\"", 
+        default=None)
+    optional_args.add_argument("--decoder", "--DECODER", 
+        help="pydicom decoding plugin for compressed slices, e.g. pylibjpeg, gdcm or pillow (default: the first one installed)", 
+        default=None)
+    optional_args.add_argument("--no-cache", "--NO-CACHE", 
+        help="Convert even if the series is unchanged since a cached conversion.", 
+        action="store_true", default=False)
+    optional_args.add_argument("--cache-dir", "--CACHE-DIR", 
+        help="Directory of the conversion cache (default: $NIFTI_CACHE_DIR or ~/.cache/nifti_conversion)", 
+        default=DEFAULT_CACHE_DIR)
+    optional_args.add_argument("--cache-size", "--CACHE-SIZE", 
+        help="Size of the conversion cache in GB, least recently used entries are evicted beyond it", 
+        type=float, default=DEFAULT_CACHE_SIZE_GB)
+    optional_args.add_argument("-v", "--verbose", "--VERBOSE", 
+        help="Print a histogram of the decoding time per file.", 
+        action="store_true", default=False)
     args = parser.parse_args()
 
-    # Read DICOM files:
-    image_series_dict = ReadDICOMSeries(args.dicom, only_read_header=False)
-
-    # Write image to NIFTI:
-    if os.path.isfile(args.nifti):
-        print("{}WARNING:{} {}{}{} already exists! It will be overwritten.".format(
-            BashColours.BOLDRED, BashColours.RESET, 
-            BashColours.BOLDBLUE, args.nifti, BashColours.RESET))
-    image_series_dict_keys = sorted(image_series_dict.keys())
-    image_data_array, spacing = GetImageVolume(image_series_dict)
-
-    if not args.dry_run:
-        print("Writing IMAGE to {}{}{}...".format(BashColours.BOLDBLUE, args.nifti, BashColours.RESET))
-        tic = time.time()
-        WriteNumpyToNifti(image_data_array, spacing, args.nifti)
-        toc = time.time()
-        print("Done ({}{}{} s.)".format(BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
+    cache = None if args.no_cache else ConversionCache(args.cache_dir, int(args.cache_size * 2**30))
+
+    if args.index is not None:
+        # Read the headers of the selected series only, the archive is not walked:
+        from DICOM_Index import SelectSeriesFiles
+        study_dict = {}
+        for seriesKey, filenames in SelectSeriesFiles(args.index, where=args.where, series_filter=args.series_uid).items():
+            sliceIndex = IndexDICOMSlices(ReadDICOMHeaders(filenames, workers=args.workers))
+            study_dict[seriesKey] = {sliceZ: dataset for sliceZ, (filename, dataset) in sliceIndex.items()}
+        if len(study_dict) == 0:
+            raise Exception('No DICOM series in \"%s\" matches \"%s\"!' %(args.index, args.where))
+    elif args.split_series or args.series_uid is not None:
+        # Read every series in a single header pass:
+        study_dict = ReadDICOMStudy(args.dicom, only_read_header=True, workers=args.workers, series_filter=args.series_uid)
+        if len(study_dict) == 0:
+            raise Exception('No matching DICOM series found in \"%s\"!' %(args.dicom))
+
+    if args.index is not None or args.split_series or args.series_uid is not None:
+        # Convert the series one by one:
+        for seriesKey, header_series_dict in study_dict.items():
+            print("Series {}{}{} ({} slices)".format(
+                BashColours.BOLDBLUE, seriesKey[2], BashColours.RESET, len(header_series_dict)))
+            ExportDICOMSeries(header_series_dict, GetSeriesNiftiFileName(args.nifti, seriesKey), 
+                dry_run=args.dry_run, slab_size=args.slab_size, workers=args.workers, cache=cache, 
+                decoder=args.decoder, verbose=args.verbose)
     else:
-        print("*** DRY RUN ***")
-        print("Slices:")
-        print(f"\t{'Z-Location'}\t{'SliceLocation'}\t{'SliceThickness'}")
-        for key in sorted(image_series_dict.keys(), reverse=True):
-            ds = image_series_dict[key]
-            print(f"\t{key}\t{ds.SliceLocation}\t{ds.SliceThickness}")
+        # Read DICOM headers:
+        header_series_dict = ReadDICOMSeries(args.dicom, only_read_header=True, workers=args.workers)
 
+        # Decode the slices and write the image to NIFTI:
+        ExportDICOMSeries(header_series_dict, args.nifti, 
+            dry_run=args.dry_run, slab_size=args.slab_size, workers=args.workers, cache=cache, 
+            decoder=args.decoder, verbose=args.verbose)
@@ -3,12 +3,15 @@
 import os
 import json
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import h5py
-import itk
 import argparse
 
+from Nifti_Writer import NiftiSlabWriter, get_label_sidecar_filename, nifti_data_type, write_nifti
+from Conversion_Cache import ConversionCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_GB, get_cache_key, get_file_stats
+
 
 class BashColours:
     RESET       = "\033[0m"              # Reset
@@ -22,75 +25,323 @@ class BashColours:
     BOLDBLUE    = "\033[1m\033[34m"      # Bold Blue 
 
 
-def get_h5_image(h5_file, key):
+def get_h5_slab_size(dataset, slab_size=None, slab_bytes=64 * 2**20):
+    """Returns the number of slices (first axis) to read at a time, as a multiple of the dataset's
+    chunk height so that every chunk is read and decompressed exactly once. Without slab_size, the
+    slab is sized to about slab_bytes.
+    """
+    chunk_slices = dataset.chunks[0] if dataset.chunks is not None else 1
+    if slab_size is None:
+        slice_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+        slab_size = max(1, slab_bytes // max(1, slice_bytes * chunk_slices)) * chunk_slices
+    else:
+        slab_size = max(1, round(slab_size / chunk_slices)) * chunk_slices
+    return max(1, min(slab_size, dataset.shape[0]))
+
+
+def iterate_h5_slabs(dataset, slab_size, reverse=False):
+    """Iterates over an h5 dataset slab_size slices at a time, reading each slab into the same
+    buffer (consume a slab before asking for the next). With reverse, the slabs, and the slices
+    within each slab, come from the last slice to the first.
+    """
+    buffer = np.empty((min(slab_size, dataset.shape[0]),) + dataset.shape[1:], dtype=dataset.dtype)
+    starts = range(0, dataset.shape[0], slab_size)
+    for start in (reversed(starts) if reverse else starts):
+        stop = min(start + slab_size, dataset.shape[0])
+        slab = buffer[:stop - start]
+        dataset.read_direct(slab, source_sel=np.s_[start:stop], dest_sel=np.s_[0:stop - start])
+        yield slab[::-1] if reverse else slab
+
+
+def get_h5_image(h5_file, key, bool_multimask_to_int=False, slab_size=None):
     """Reads h5 file of the image and returns the contents as a numpy file.
+    With bool_multimask_to_int, the multimask is collapsed slab by slab while reading.
     """
+    import h5py
     with h5py.File(h5_file, "r") as file:
         if key not in file:
             raise Exception("\"{}\" is not one of the keys ({})!".format(key, file.keys()))
-        image_data = file[key][:]
+        dataset = file[key]
+        if not bool_multimask_to_int:
+            image_data = np.empty(dataset.shape, dtype=dataset.dtype)
+            dataset.read_direct(image_data)
+            return image_data
+
+        image_data = np.empty(dataset.shape[:-1], dtype=get_multimask_int_type(dataset.shape[-1]))
+        start = 0
+        for slab in iterate_h5_slabs(dataset, get_h5_slab_size(dataset, slab_size)):
+            convert_multimask_bool_to_int(slab, out=image_data[start:start + slab.shape[0]])
+            start += slab.shape[0]
 
     return image_data
 
 
-def convert_multimask_bool_to_int(boolian_multimask_array):
+def get_h5_image_specs(h5_file, key):
+    """Returns the shape and data type of the h5 image without reading it.
+    """
+    import h5py
+    with h5py.File(h5_file, "r") as file:
+        if key not in file:
+            raise Exception("\"{}\" is not one of the keys ({})!".format(key, file.keys()))
+        return file[key].shape, file[key].dtype
+
+
+def get_multimask_int_type(number_of_masks):
+    """Smallest unsigned integer type that holds the sum of number_of_masks boolean masks.
+    """
+    return np.min_scalar_type(number_of_masks)
+
+
+def convert_multimask_bool_to_int(boolian_multimask_array, out=None):
     """converts a NumPy array of multimask bool to a mask of
-    integers. 
+    integers, of the smallest type that holds the number of masks. 
+    """
+    return boolian_multimask_array.sum(
+        axis=-1, dtype=get_multimask_int_type(boolian_multimask_array.shape[-1]), out=out)
+
+
+LABEL_OVERLAP_POLICIES = ("first", "last", "bitmask", "error")
+
+
+def get_label_int_type(number_of_masks, overlap_policy="last"):
+    """Smallest unsigned integer type of the label map of number_of_masks masks: one bit
+    per mask for "bitmask", label ids 1..number_of_masks otherwise.
     """
-    return boolian_multimask_array.sum(axis=-1)
+    if overlap_policy == "bitmask":
+        for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+            if number_of_masks <= np.iinfo(dtype).bits:
+                return np.dtype(dtype)
+        raise Exception("Can not bit-pack {} masks!".format(number_of_masks))
+    return np.min_scalar_type(number_of_masks)
+
 
+def _encode_multimask_part(boolian_multimask_array, overlap_policy, out):
+    """Encodes one part of a slab into out (see encode_multimask_labels).
+    """
+    number_of_masks = boolian_multimask_array.shape[-1]
+    if overlap_policy == "bitmask":
+        out[...] = 0
+        for k in range(number_of_masks):
+            out[boolian_multimask_array[..., k]] |= out.dtype.type(1 << k)
+        return
+    if overlap_policy == "error":
+        if (boolian_multimask_array.sum(axis=-1, dtype=get_multimask_int_type(number_of_masks)) > 1).any():
+            raise Exception("Masks overlap, which the \"error\" overlap policy does not allow!")
+    if overlap_policy == "last":
+        np.subtract(number_of_masks, np.argmax(boolian_multimask_array[..., ::-1], axis=-1), out=out, casting="unsafe")
+    else:
+        np.add(np.argmax(boolian_multimask_array, axis=-1), 1, out=out, casting="unsafe")
+    out[~boolian_multimask_array.any(axis=-1)] = 0
+
+
+def encode_multimask_labels(boolian_multimask_array, overlap_policy="last", out=None, executor=None, parts=1):
+    """Encodes a NumPy array of multimask bool (masks on the last axis) as a label map where
+    mask k is label k + 1 and 0 is background. Where masks overlap, the "first" or the "last"
+    mask wins, "bitmask" sets bit k for mask k, and "error" raises. With an executor, the slab
+    is split into parts along its first axis, encoded in parallel.
+    """
+    if overlap_policy not in LABEL_OVERLAP_POLICIES:
+        raise Exception("\"{}\" is not one of the overlap policies {}!".format(overlap_policy, LABEL_OVERLAP_POLICIES))
+    if out is None:
+        out = np.empty(boolian_multimask_array.shape[:-1], 
+            dtype=get_label_int_type(boolian_multimask_array.shape[-1], overlap_policy))
+    if executor is None or parts < 2 or boolian_multimask_array.shape[0] < 2:
+        _encode_multimask_part(boolian_multimask_array, overlap_policy, out)
+        return out
 
-def mha_to_nifti(mha_src_file, nifti_dest_file, verbose=False):
+    bounds = np.linspace(0, boolian_multimask_array.shape[0], parts + 1).astype(int)
+    futures = [executor.submit(_encode_multimask_part, 
+                               boolian_multimask_array[start:stop], overlap_policy, out[start:stop])
+               for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    for future in futures:
+        future.result()
+    return out
+
+
+def get_h5_channel_names(dataset):
+    """Names of the masks of a multimask h5 dataset, from its "channel_names", "labels" or
+    "names" attribute, or "channel_<k>" if it has none.
+    """
+    number_of_masks = dataset.shape[-1]
+    for attribute in ("channel_names", "labels", "names"):
+        if attribute in dataset.attrs:
+            names = [n.decode() if isinstance(n, bytes) else str(n) for n in np.atleast_1d(dataset.attrs[attribute])]
+            if len(names) == number_of_masks:
+                return names
+    return ["channel_{}".format(k) for k in range(number_of_masks)]
+
+
+def write_label_sidecar(nifti_dest_file, channel_names, overlap_policy):
+    """Writes the JSON sidecar (next to the NIFTI file, with a .json extension) mapping
+    label ids to the h5 channel names, and returns its filename.
+    """
+    if overlap_policy == "bitmask":
+        labels = {str(1 << k): name for k, name in enumerate(channel_names)}
+    else:
+        labels = {str(k + 1): name for k, name in enumerate(channel_names)}
+    sidecar_file = get_label_sidecar_filename(nifti_dest_file)
+    with open(sidecar_file, "w") as file:
+        json.dump({"labels": labels, "overlap_policy": overlap_policy}, file, indent=4)
+    return sidecar_file
+
+
+def get_h5_fingerprint(h5_file, key, slab_size=None):
+    """Fingerprint of an h5 dataset: its shape, data type, attributes and the SHA-256 of its content.
+    """
+    import h5py
+    digest = hashlib.sha256()
+    with h5py.File(h5_file, "r") as file:
+        if key not in file:
+            raise Exception("\"{}\" is not one of the keys ({})!".format(key, file.keys()))
+        dataset = file[key]
+        for slab in iterate_h5_slabs(dataset, get_h5_slab_size(dataset, slab_size)):
+            digest.update(memoryview(slab).cast("B"))
+        return {"shape":  dataset.shape,
+                "dtype":  str(dataset.dtype),
+                "attrs":  {name: np.asarray(value).tolist() for name, value in dataset.attrs.items()},
+                "sha256": digest.hexdigest()}
+
+
+def mha_to_nifti(mha_src_file, nifti_dest_file, verbose=False, cache=None, workers=None):
     """Reads MHA image and writs it as a NIFTI file.
+    With a cache, an unchanged MHA file (same size and modification time) is linked from it.
     """
-    ## Read MHA image:
+    if cache is not None:
+        cache_key = get_cache_key(get_file_stats([mha_src_file]), {"converter": "mha_to_nifti"})
+        if cache.fetch(cache_key, [nifti_dest_file]):
+            if verbose:
+                print("Cache hit, linked IMAGE to {}{}{}".format(BashColours.BOLDBLUE, nifti_dest_file, BashColours.RESET))
+            return
+        with cache.store(cache_key, [nifti_dest_file]) as (temp_dest_file,):
+            mha_to_nifti(mha_src_file, temp_dest_file, verbose=verbose, workers=workers)
+        return
+
+    ## Read MHA image (itk is only imported here, as it takes seconds):
+    import itk
     tic = time.time()
     itk_image = itk.imread(mha_src_file)
     toc = time.time()
-    if args.verbose:
+    if verbose:
         print("Read MHA image in {}{}{} s.".format(BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
         print("ITK image specs:\n", itk_image)
 
-    ## Write itk image as NIFTI:
-    if args.verbose:
+    ## Write itk image as NIFTI, straight from its buffer (ITK's writer for vector and non-3D images):
+    if verbose:
         print("Writing IMAGE to {}{}{}...".format(BashColours.BOLDBLUE, nifti_dest_file, BashColours.RESET))
-    imageWriter = itk.ImageFileWriter[itk_image].New()
-    imageWriter.SetImageIO(itk.NiftiImageIO.New())
-    imageWriter.SetFileName(nifti_dest_file)
-    imageWriter.SetInput(itk_image)  
     try:
-        imageWriter.Update()
+        if itk_image.GetImageDimension() == 3 and itk_image.GetNumberOfComponentsPerPixel() == 1:
+            write_nifti(nifti_dest_file, itk.GetArrayViewFromImage(itk_image), itk_image.GetSpacing(), 
+                origin=itk_image.GetOrigin(), direction=itk.array_from_matrix(itk_image.GetDirection()), 
+                compress_threads=workers)
+        else:
+            imageWriter = itk.ImageFileWriter[itk_image].New()
+            imageWriter.SetImageIO(itk.NiftiImageIO.New())
+            imageWriter.SetFileName(nifti_dest_file)
+            imageWriter.SetInput(itk_image)  
+            imageWriter.Update()
     except Exception as e:
         print("{}ERROR writing to the {}{}{}file!{}".format(
             BashColours.BOLDRED, BashColours.BOLDBLACK, nifti_dest_file, BashColours.BOLDRED, BashColours.RESET))
         print(e)
+        raise  # Not to be cached (or reported) as converted
     toc = time.time()
-    if args.verbose:
+    if verbose:
         print("Done! ({}{}{} s)".format(BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
 
 
-def WriteNumpyToNifti(np_array, spacing, output_filename):
-    """Writs NumPy array to NIFTI. 
+def WriteNumpyToNifti(np_array, spacing, output_filename, workers=None):
+    """Writs NumPy array to NIFTI (as float32). 3D arrays are written straight from their buffer,
+    others (2D, or 4D vector and multichannel images) by ITK, their spacing cut or padded with ones.
     """
-    np_array = np.flip(np_array,axis=0)
-    np_array = np.flip(np_array,axis=1)
-    outputImage = itk.GetImageFromArray(np_array.astype(np.float32)) 
-    outputImage.SetSpacing(spacing) 
-    outputImage.SetOrigin((0.0, 0.0, 0.0)) 
-
-    # imageCastFilter = itk.CastImageFilter[ outputImage, imageType ].New()
-    # imageCastFilter.SetInput(outputImage)
-    # 
-    imageWriter = itk.ImageFileWriter[outputImage].New()
-    imageWriter.SetImageIO(itk.NiftiImageIO.New())
-    imageWriter.SetFileName(output_filename)
-    imageWriter.SetInput(outputImage)  #imageCastFilter.GetOutput())
     try:
-        imageWriter.Update()
+        if np_array.ndim == 3:
+            write_nifti(output_filename, np_array[::-1, ::-1], spacing, dtype=np.float32, compress_threads=workers)
+        else:
+            import itk
+            outputImage = itk.GetImageFromArray(np.ascontiguousarray(np_array[::-1, ::-1], dtype=np.float32))
+            dimension = outputImage.GetImageDimension()
+            spacing = [float(s) for s in spacing][:dimension]
+            outputImage.SetSpacing(spacing + [1.0] * (dimension - len(spacing)))
+            outputImage.SetOrigin([0.0] * dimension)
+            imageWriter = itk.ImageFileWriter[outputImage].New()
+            imageWriter.SetImageIO(itk.NiftiImageIO.New())
+            imageWriter.SetFileName(output_filename)
+            imageWriter.SetInput(outputImage)
+            imageWriter.Update()
     except Exception as e:
         print("{}ERROR writing to the {}{}{}file!{}".format(
             BashColours.BOLDRED, BashColours.BOLDBLACK, output_filename, BashColours.BOLDRED, BashColours.RESET))
         print(e)
+        raise  # Not to be cached (or reported) as converted
+
+
+def stream_h5_to_nifti(h5_file, key, nifti_dest_file, spacing, slab_size=None, bool_multimask_to_int=False, 
+                       label_overlap_policy=None, workers=None, verbose=False, cache=None):
+    """Streams the h5 image to NIFTI along its chunk layout, in the orientation of WriteNumpyToNifti:
+    the z flip comes from reading the slabs backwards, the y flip from the writer. Multimasks are
+    summed (bool_multimask_to_int) or encoded as a label map (label_overlap_policy, which also writes
+    the JSON sidecar) slab by slab, so memory stays bounded by the slab size. Images that are not 3D
+    (2D, or 4D vector and multichannel ones) are read whole and written by WriteNumpyToNifti. With a
+    cache, an unchanged dataset (same checksum) converted with the same options is linked from it.
+    """
+    if cache is not None:
+        options = {"converter": "stream_h5_to_nifti", "spacing": [float(s) for s in spacing],
+                   "bool_multimask_to_int": bool_multimask_to_int, "label_overlap_policy": label_overlap_policy}
+        cache_key = get_cache_key(get_h5_fingerprint(h5_file, key, slab_size), options)
+        outputs = [nifti_dest_file]
+        if label_overlap_policy is not None:
+            outputs.append(get_label_sidecar_filename(nifti_dest_file))
+        if cache.fetch(cache_key, outputs):
+            if verbose:
+                print("Cache hit, linked IMAGE to {}{}{}".format(BashColours.BOLDBLUE, nifti_dest_file, BashColours.RESET))
+            return
+        with cache.store(cache_key, outputs) as temp_outputs:
+            stream_h5_to_nifti(h5_file, key, temp_outputs[0], spacing, slab_size=slab_size, 
+                bool_multimask_to_int=bool_multimask_to_int, label_overlap_policy=label_overlap_policy, 
+                workers=workers, verbose=verbose)
+        return
+
+    import h5py
+    with h5py.File(h5_file, "r") as file:
+        if key not in file:
+            raise Exception("\"{}\" is not one of the keys ({})!".format(key, file.keys()))
+        dataset = file[key]
+        multimask = label_overlap_policy is not None or bool_multimask_to_int
+        if len(dataset.shape) != (4 if multimask else 3):
+            if multimask:
+                raise Exception("A multimask must be a 4D (z, y, x, mask) dataset, \"{}\" is {}D!".format(
+                    key, len(dataset.shape)))
+            if verbose:
+                print("H5 image specs: ", dataset.shape, dataset.dtype, "-> NIFTI (not 3D, written whole by ITK)")
+            WriteNumpyToNifti(dataset[()], spacing, nifti_dest_file, workers=workers)
+            return
+        slab_size = get_h5_slab_size(dataset, slab_size)
+        if label_overlap_policy is not None:
+            shape, dtype = dataset.shape[:-1], get_label_int_type(dataset.shape[-1], label_overlap_policy)
+            slab_out = np.empty((slab_size,) + shape[1:], dtype=dtype)
+        elif bool_multimask_to_int:
+            shape, dtype = dataset.shape[:-1], get_multimask_int_type(dataset.shape[-1])
+            slab_out = np.empty((slab_size,) + shape[1:], dtype=dtype)
+        else:
+            shape, dtype = dataset.shape, nifti_data_type(dataset.dtype)
+        if verbose:
+            print("H5 image specs: ", dataset.shape, dataset.dtype, "chunks:", dataset.chunks, 
+                  "-> NIFTI", shape, dtype, "({} slices per slab)".format(slab_size))
+
+        with NiftiSlabWriter(nifti_dest_file, shape, dtype, spacing, flip_y=True, compress_threads=workers) as writer, \
+             ThreadPoolExecutor(max_workers=workers) as executor:
+            for slab in iterate_h5_slabs(dataset, slab_size, reverse=True):
+                if label_overlap_policy is not None:
+                    slab = encode_multimask_labels(slab, label_overlap_policy, 
+                        out=slab_out[:slab.shape[0]], executor=executor, parts=workers or os.cpu_count() or 1)
+                elif bool_multimask_to_int:
+                    slab = convert_multimask_bool_to_int(slab, out=slab_out[:slab.shape[0]])
+                writer.write_slab(slab)
+
+        if label_overlap_policy is not None:
+            sidecar_file = write_label_sidecar(nifti_dest_file, get_h5_channel_names(dataset), label_overlap_policy)
+            if verbose:
+                print("Wrote label names to {}{}{}".format(BashColours.BOLDBLUE, sidecar_file, BashColours.RESET))
 
 
 if __name__ == "__main__":
@@ -104,9 +355,30 @@ if __name__ == "__main__":
     optional_args.add_argument("-n", "--nifti", "--NIFTI", help="Output NIFTI filename", default="./output.nii.gz")
     optional_args.add_argument("-k", "--h5key", "--H5-KEY", help="The key to use for the H5 file content", default="data")
     optional_args.add_argument("--bool-multimask-to-int", action="store_true", default=False)
+    optional_args.add_argument("--multimask-labels", "--MULTIMASK-LABELS", 
+        help="Encode a bool multimask as a label map (mask k -> label k+1) with this overlap policy, "
+             "and write a JSON sidecar of the label names.", 
+        choices=LABEL_OVERLAP_POLICIES, default=None)
+    optional_args.add_argument("-w", "--workers", "--WORKERS", 
+        help="Number of threads encoding each slab of a multimask and compressing the NIFTI file (default: chosen by the thread pool)", 
+        type=int, default=None)
+    optional_args.add_argument("--slab-size", 
+        help="Slices of the h5 image read and written at a time, rounded to its chunk height (default: about 64 MB).", 
+        type=int, default=None)
+    optional_args.add_argument("--no-cache", "--NO-CACHE", 
+        help="Convert even if the input is unchanged since a cached conversion.", 
+        action="store_true", default=False)
+    optional_args.add_argument("--cache-dir", "--CACHE-DIR", 
+        help="Directory of the conversion cache (default: $NIFTI_CACHE_DIR or ~/.cache/nifti_conversion)", 
+        default=DEFAULT_CACHE_DIR)
+    optional_args.add_argument("--cache-size", "--CACHE-SIZE", 
+        help="Size of the conversion cache in GB, least recently used entries are evicted beyond it", 
+        type=float, default=DEFAULT_CACHE_SIZE_GB)
     optional_args.add_argument("-v", "--verbose", action="store_true", default=False)
     args = parser.parse_args()
 
+    cache = None if args.no_cache else ConversionCache(args.cache_dir, int(args.cache_size * 2**30))
+
     # Check if IMAGE already exists:
     if not os.path.isfile(args.image):
         raise Exception("{}Input image \"{}\" is not a file!{}".format(
@@ -120,21 +392,15 @@ if __name__ == "__main__":
 
     input_image_extension = os.path.splitext(args.image)[-1][1:]
     if  input_image_extension == "mha":
-        mha_to_nifti(args.image, args.nifti, verbose=args.verbose)
+        mha_to_nifti(args.image, args.nifti, verbose=args.verbose, cache=cache, workers=args.workers)
     elif input_image_extension == "h5":
         spacing = np.array([1.0, 1.0, 1.0], dtype=np.float64)
-        image_data_array = get_h5_image(args.image, args.h5key)
-        if args.verbose:
-            print("Loaded array specs: ", image_data_array.shape, image_data_array.dtype)
-        if args.bool_multimask_to_int:
-            image_data_array = convert_multimask_bool_to_int(image_data_array).astype(np.float64)
-            if args.verbose:
-                print("Converted array specs: ", image_data_array.shape, image_data_array.dtype)
-
         if args.verbose:
-            print("Writing IMAGE to {}{}{}...".format(BashColours.BOLDBLUE, args.nifti, BashColours.RESET))
+            print("Streaming IMAGE to {}{}{}...".format(BashColours.BOLDBLUE, args.nifti, BashColours.RESET))
         tic = time.time()
-        WriteNumpyToNifti(image_data_array, spacing, args.nifti)
+        stream_h5_to_nifti(args.image, args.h5key, args.nifti, spacing, slab_size=args.slab_size, 
+            bool_multimask_to_int=args.bool_multimask_to_int, label_overlap_policy=args.multimask_labels, 
+            workers=args.workers, verbose=args.verbose, cache=cache)
         toc = time.time()
         if args.verbose:
             print("Done! ({}{}{} s)".format(BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET))
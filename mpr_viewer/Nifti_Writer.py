@@ -0,0 +1,346 @@
+""" Writes NIFTI-1 and NIFTI-2 files slab by slab, so a volume never has to be in memory as a whole.
+
+The header is built from the spacing, origin and direction of the image, as ITK's NiftiImageIO
+would write it, and the voxels are written straight from the array buffers. ".gz" files are
+compressed by a pool of threads (zlib releases the GIL) into a multi-member gzip stream, which
+every gzip reader decompresses as one file.
+"""
+import os
+import gzip
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+NIFTI1_HEADER_FORMAT = "<i10s18sihcb8h3f4h8f3fhcB4f2i80s24s2h6f4f4f4f16s4s"
+NIFTI1_HEADER_SIZE   = 348
+NIFTI1_VOX_OFFSET    = NIFTI1_HEADER_SIZE + 4  # Header plus the (empty) extension flag
+NIFTI1_MAX_DIM       = 32767                   # dim[] is int16 in NIFTI-1
+
+NIFTI2_HEADER_FORMAT = "<i8s2h8q3d8dq6d2q80s24s2i6d4d4d4d3i16sc15s"
+NIFTI2_HEADER_SIZE   = 540
+NIFTI2_VOX_OFFSET    = NIFTI2_HEADER_SIZE + 4
+
+NIFTI_DATATYPES = {
+    np.dtype(np.uint8):   2,
+    np.dtype(np.int16):   4,
+    np.dtype(np.int32):   8,
+    np.dtype(np.float32): 16,
+    np.dtype(np.float64): 64,
+    np.dtype(np.int8):    256,
+    np.dtype(np.uint16):  512,
+    np.dtype(np.uint32):  768,
+    np.dtype(np.int64):   1024,
+    np.dtype(np.uint64):  1280,
+}
+
+# LPS (ITK, DICOM) to RAS (NIFTI): negate x and y
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+
+GZIP_MEMBER_BYTES = 4 * 2**20
+
+
+def nifti_data_type(dtype):
+    """Returns the data type a NumPy dtype is written as: itself if NIFTI supports it,
+    uint8 for booleans and float32 for anything else.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        return np.dtype(np.uint8)
+    if dtype in NIFTI_DATATYPES:
+        return dtype
+    return np.dtype(np.float32)
+
+
+def get_label_sidecar_filename(nifti_dest_file):
+    """The JSON sidecar of a NIFTI file: same name, with a .json extension.
+    """
+    if nifti_dest_file.endswith(".nii.gz"):
+        return nifti_dest_file[:-len(".nii.gz")] + ".json"
+    return os.path.splitext(nifti_dest_file)[0] + ".json"
+
+
+def nifti_quaternion(rotation):
+    """Quaternion (b, c, d) and qfac of a 3x3 rotation, following nifti_mat44_to_quatern.
+    """
+    r = np.array(rotation, dtype=np.float64)
+    r /= np.linalg.norm(r, axis=0)
+    qfac = 1.0
+    if np.linalg.det(r) < 0:
+        qfac = -1.0
+        r[:, 2] = -r[:, 2]
+    a = r[0, 0] + r[1, 1] + r[2, 2] + 1.0
+    if a > 0.5:
+        a = 0.5 * np.sqrt(a)
+        b = 0.25 * (r[2, 1] - r[1, 2]) / a
+        c = 0.25 * (r[0, 2] - r[2, 0]) / a
+        d = 0.25 * (r[1, 0] - r[0, 1]) / a
+    else:
+        xd = 1.0 + r[0, 0] - (r[1, 1] + r[2, 2])
+        yd = 1.0 + r[1, 1] - (r[0, 0] + r[2, 2])
+        zd = 1.0 + r[2, 2] - (r[0, 0] + r[1, 1])
+        if xd > 1.0:
+            b = 0.5 * np.sqrt(xd)
+            c = 0.25 * (r[0, 1] + r[1, 0]) / b
+            d = 0.25 * (r[0, 2] + r[2, 0]) / b
+            a = 0.25 * (r[2, 1] - r[1, 2]) / b
+        elif yd > 1.0:
+            c = 0.5 * np.sqrt(yd)
+            b = 0.25 * (r[0, 1] + r[1, 0]) / c
+            d = 0.25 * (r[1, 2] + r[2, 1]) / c
+            a = 0.25 * (r[0, 2] - r[2, 0]) / c
+        else:
+            d = 0.5 * np.sqrt(zd)
+            b = 0.25 * (r[0, 2] + r[2, 0]) / d
+            c = 0.25 * (r[1, 2] + r[2, 1]) / d
+            a = 0.25 * (r[1, 0] - r[0, 1]) / d
+        if a < 0.0:
+            b, c, d = -b, -c, -d
+    return (float(b), float(c), float(d)), qfac
+
+
+def nifti_geometry(spacing, origin=(0.0, 0.0, 0.0), direction=None):
+    """The qform (quaternion, qfac, offset) and the sform rows of an image given in ITK's LPS
+    convention, with direction the 3x3 matrix whose columns are the x, y and z axes.
+    """
+    spacing = np.array([float(s) for s in spacing], dtype=np.float64)
+    direction = np.eye(3) if direction is None else np.array(direction, dtype=np.float64)
+    rotation = LPS_TO_RAS @ direction
+    offset = LPS_TO_RAS @ np.array([float(o) for o in origin], dtype=np.float64)
+    quaternion, qfac = nifti_quaternion(rotation)
+    srows = np.hstack([rotation * spacing, offset[:, np.newaxis]])
+    return quaternion, qfac, offset, srows
+
+
+def make_nifti1_header(shape, dtype, spacing, origin=(0.0, 0.0, 0.0), scl_slope=1.0, scl_inter=0.0, direction=None):
+    """Packs a single-file (n+1) NIFTI-1 header, followed by an empty extension flag.
+
+    The volume is given in NumPy (z, y, x) order and the geometry in ITK's LPS convention; the
+    header stores it in RAS, as ITK's NiftiImageIO does.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in NIFTI_DATATYPES:
+        raise Exception("Data type \"{}\" can not be written to NIFTI!".format(dtype))
+    if max(shape) > NIFTI1_MAX_DIM:
+        raise Exception("Shape {} does not fit in a NIFTI-1 header, use NIFTI-2!".format(shape))
+    dim_z, dim_y, dim_x = shape
+    sx, sy, sz = [float(s) for s in spacing]
+    quaternion, qfac, offset, srows = nifti_geometry(spacing, origin, direction)
+    header = struct.pack(NIFTI1_HEADER_FORMAT,
+        NIFTI1_HEADER_SIZE,
+        b"", b"", 0, 0, b"r", 0,                                       # Unused ANALYZE fields, dim_info
+        3, dim_x, dim_y, dim_z, 1, 1, 1, 1,                            # dim
+        0.0, 0.0, 0.0,                                                 # intent_p1,2,3
+        0, NIFTI_DATATYPES[dtype], dtype.itemsize * 8, 0,              # intent_code, datatype, bitpix, slice_start
+        qfac, sx, sy, sz, 0.0, 0.0, 0.0, 0.0,                          # pixdim
+        float(NIFTI1_VOX_OFFSET),                                      # vox_offset
+        float(scl_slope), float(scl_inter),                            # scl_slope, scl_inter
+        0, b"\x00", 10,                                                # slice_end, slice_code, xyzt_units (mm, s)
+        0.0, 0.0, 0.0, 0.0,                                            # cal_max, cal_min, slice_duration, toffset
+        0, 0,                                                          # glmax, glmin
+        b"", b"",                                                      # descrip, aux_file
+        1, 1,                                                          # qform_code, sform_code (scanner)
+        *quaternion, *offset,                                          # quatern_b,c,d, qoffset_x,y,z
+        *srows[0], *srows[1], *srows[2],                               # srow_x, srow_y, srow_z
+        b"", b"n+1\x00")
+    return header + b"\x00\x00\x00\x00"
+
+
+def make_nifti2_header(shape, dtype, spacing, origin=(0.0, 0.0, 0.0), scl_slope=1.0, scl_inter=0.0, direction=None):
+    """Packs a single-file (n+2) NIFTI-2 header, followed by an empty extension flag.
+    Same geometry as make_nifti1_header, with 64 bit dimensions and double precision fields.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in NIFTI_DATATYPES:
+        raise Exception("Data type \"{}\" can not be written to NIFTI!".format(dtype))
+    dim_z, dim_y, dim_x = shape
+    sx, sy, sz = [float(s) for s in spacing]
+    quaternion, qfac, offset, srows = nifti_geometry(spacing, origin, direction)
+    header = struct.pack(NIFTI2_HEADER_FORMAT,
+        NIFTI2_HEADER_SIZE,
+        b"n+2\x00\r\n\x1a\n",                                          # magic
+        NIFTI_DATATYPES[dtype], dtype.itemsize * 8,                    # datatype, bitpix
+        3, dim_x, dim_y, dim_z, 1, 1, 1, 1,                            # dim
+        0.0, 0.0, 0.0,                                                 # intent_p1,2,3
+        qfac, sx, sy, sz, 0.0, 0.0, 0.0, 0.0,                          # pixdim
+        NIFTI2_VOX_OFFSET,                                             # vox_offset
+        float(scl_slope), float(scl_inter),                            # scl_slope, scl_inter
+        0.0, 0.0, 0.0, 0.0,                                            # cal_max, cal_min, slice_duration, toffset
+        0, 0,                                                          # slice_start, slice_end
+        b"", b"",                                                      # descrip, aux_file
+        1, 1,                                                          # qform_code, sform_code (scanner)
+        *quaternion, *offset,                                          # quatern_b,c,d, qoffset_x,y,z
+        *srows[0], *srows[1], *srows[2],                               # srow_x, srow_y, srow_z
+        0, 10, 0,                                                      # slice_code, xyzt_units (mm, s), intent_code
+        b"", b"\x00", b"")                                             # intent_name, dim_info, unused_str
+    return header + b"\x00\x00\x00\x00"
+
+
+def _compress_gzip_member(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)  # 31: gzip wrapper
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipFile:
+    """Write-only gzip file compressed by a pool of threads.
+
+    Written data is cut into members of member_bytes, each compressed to a complete gzip member
+    on its own; members are written in order as they finish, with at most two per thread pending.
+    """
+    def __init__(self, filename, compresslevel=6, threads=None, member_bytes=GZIP_MEMBER_BYTES):
+        self.compresslevel = compresslevel
+        self.member_bytes = member_bytes
+        self.threads = threads or os.cpu_count() or 1
+        self._file = open(filename, "wb")
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def _submit(self, data):
+        self._pending.append(self._executor.submit(_compress_gzip_member, data, self.compresslevel))
+        while len(self._pending) > 2 * self.threads:
+            self._file.write(self._pending.popleft().result())
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        if len(self._buffer) > 0:
+            fill = min(self.member_bytes - len(self._buffer), len(data))
+            self._buffer += data[:fill]
+            data = data[fill:]
+            if len(self._buffer) < self.member_bytes:
+                return
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        # Whole members straight from the caller's buffer, which is copied once by bytes():
+        while len(data) >= self.member_bytes:
+            self._submit(bytes(data[:self.member_bytes]))
+            data = data[self.member_bytes:]
+        self._buffer += data
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if len(self._buffer) > 0 or len(self._pending) == 0:
+                self._submit(bytes(self._buffer))
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+
+    def abort(self):
+        """Closes the file without writing the buffered and pending members.
+        """
+        self._pending.clear()
+        self._buffer = bytearray()
+        self._executor.shutdown(cancel_futures=True)
+        self._file.close()
+
+
+class NiftiSlabWriter:
+    """Appends slabs of a (z, y, x) volume to a NIFTI file as they are produced.
+
+    Slabs are written in file order, so flipping the volume along z is done by feeding the slabs
+    (and the slices within them) from the last to the first. With flip_y the rows of each slab are
+    written bottom-up; only the slab being written is ever copied. NIFTI-2 is used when version is
+    2, or when it is None and a dimension does not fit in NIFTI-1. ".gz" files are compressed with
+    compress_threads threads (default: one per CPU, 1 uses the gzip module).
+
+    The slabs are written to a temporary file next to filename, which replaces filename only when
+    all slices were written; on an error it is removed, so filename is never a truncated volume.
+    """
+    def __init__(self, filename, shape, dtype, spacing, origin=(0.0, 0.0, 0.0), direction=None,
+                 flip_y=False, scl_slope=1.0, scl_inter=0.0, compress=None, version=None, compress_threads=None):
+        self.filename = filename
+        self.temp_filename = "{}.{}.part".format(filename, os.getpid())
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.flip_y = flip_y
+        self.slices_written = 0
+        if compress is None:
+            compress = filename.endswith(".gz")
+        if version is None:
+            version = 1 if max(self.shape) <= NIFTI1_MAX_DIM else 2
+        #
+        make_header = make_nifti1_header if version == 1 else make_nifti2_header
+        header = make_header(self.shape, self.dtype, spacing, origin, scl_slope, scl_inter, direction)
+        if not compress:
+            self._file = open(self.temp_filename, "wb")
+        elif compress_threads == 1:
+            self._file = gzip.open(self.temp_filename, "wb", compresslevel=6)
+        else:
+            self._file = ParallelGzipFile(self.temp_filename, compresslevel=6, threads=compress_threads)
+        try:
+            self._file.write(header)
+        except BaseException:
+            self.abort()
+            raise
+
+    def write_slab(self, slab):
+        """Appends a 2D slice or a 3D slab (z, y, x) to the file.
+        """
+        if slab.ndim == 2:
+            slab = slab[np.newaxis]
+        if slab.shape[1:] != self.shape[1:]:
+            raise Exception("Slab shape {} does not match the volume shape {}!".format(slab.shape, self.shape))
+        if self.slices_written + slab.shape[0] > self.shape[0]:
+            raise Exception("Writing {} more slices than the {} of the volume!".format(
+                self.slices_written + slab.shape[0] - self.shape[0], self.shape[0]))
+        if self.flip_y:
+            slab = slab[:, ::-1]
+        slab = np.ascontiguousarray(slab, dtype=self.dtype.newbyteorder("<"))
+        self._file.write(memoryview(slab).cast("B"))
+        self.slices_written += slab.shape[0]
+
+    def close(self):
+        """Flushes the file and moves it to filename; raises if not all slices were written.
+        """
+        if self.slices_written != self.shape[0]:
+            self.abort()
+            raise Exception("Only {} of {} slices were written to \"{}\"!".format(
+                self.slices_written, self.shape[0], self.filename))
+        try:
+            self._file.close()
+        except BaseException:
+            self.abort()
+            raise
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        """Closes the file, dropping the members still to be compressed, and removes it; filename is
+        left untouched.
+        """
+        try:
+            if isinstance(self._file, ParallelGzipFile):
+                self._file.abort()
+            else:
+                self._file.close()
+        finally:
+            if os.path.exists(self.temp_filename):
+                os.remove(self.temp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_nifti(filename, np_array, spacing, origin=(0.0, 0.0, 0.0), direction=None, dtype=None,
+                flip_y=False, version=None, compress_threads=None, slab_size=16):
+    """Writes a (z, y, x) array to NIFTI, slab_size slices at a time: a C-contiguous array in the
+    output data type is written from its own buffer, anything else (views, other data types) is
+    copied one slab at a time.
+    """
+    dtype = nifti_data_type(np_array.dtype) if dtype is None else np.dtype(dtype)
+    with NiftiSlabWriter(filename, np_array.shape, dtype, spacing, origin, direction, flip_y=flip_y,
+                         version=version, compress_threads=compress_threads) as writer:
+        for idx in range(0, np_array.shape[0], slab_size):
+            writer.write_slab(np_array[idx:idx + slab_size])
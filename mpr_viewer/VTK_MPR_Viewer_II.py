@@ -4,12 +4,77 @@
 import sys
 import os.path
 import json
+import time
+import gzip
+import struct
+import threading
+from collections import deque
 
 import numpy as np
 import vtk
 import vtk.util.numpy_support as vtk_numpy_support
 import argparse
 
+from Nifti_Writer import NIFTI1_HEADER_FORMAT, NIFTI1_HEADER_SIZE, NIFTI2_HEADER_FORMAT, NIFTI2_HEADER_SIZE, NIFTI_DATATYPES, \
+    get_label_sidecar_filename
+
+
+NRRD_TYPES = {
+    "signed char": np.int8, "int8": np.int8, "int8_t": np.int8,
+    "uchar": np.uint8, "unsigned char": np.uint8, "uint8": np.uint8, "uint8_t": np.uint8,
+    "short": np.int16, "short int": np.int16, "signed short": np.int16, "signed short int": np.int16,
+    "int16": np.int16, "int16_t": np.int16,
+    "ushort": np.uint16, "unsigned short": np.uint16, "unsigned short int": np.uint16, 
+    "uint16": np.uint16, "uint16_t": np.uint16,
+    "int": np.int32, "signed int": np.int32, "int32": np.int32, "int32_t": np.int32,
+    "uint": np.uint32, "unsigned int": np.uint32, "uint32": np.uint32, "uint32_t": np.uint32,
+    "longlong": np.int64, "long long": np.int64, "int64": np.int64, "int64_t": np.int64,
+    "ulonglong": np.uint64, "unsigned long long": np.uint64, "uint64": np.uint64, "uint64_t": np.uint64,
+    "float": np.float32, "double": np.float64,
+}
+
+MASK_SLAB_VOXELS = 2**24
+LOADER_SLAB_BYTES = 64 * 2**20
+
+DEFAULT_MASK_ALPHA = 0.85
+DEFAULT_MASK_COLOURS = [
+    [ 1.0, 0.0, 0.0, DEFAULT_MASK_ALPHA],  #  1 - Red 
+    [ 0.0, 1.0, 0.0, DEFAULT_MASK_ALPHA],  #  2 - Green
+    [ 0.0, 0.0, 1.0, DEFAULT_MASK_ALPHA],  #  3 - Blue  
+    [ 1.0, 1.0, 0.0, DEFAULT_MASK_ALPHA],  #  4 - Yellow 
+    [ 1.0, 0.0, 1.0, DEFAULT_MASK_ALPHA],  #  5 - Magenta  
+    [ 0.0, 1.0, 1.0, DEFAULT_MASK_ALPHA],  #  6 - Cyan 
+    [ 0.6, 0.6, 1.0, DEFAULT_MASK_ALPHA],  #  7 - Light Purple 
+    [ 1.0, 0.4, 0.0, DEFAULT_MASK_ALPHA],  #  8 - Orange 
+    [ 0.0, 0.0, 0.5, DEFAULT_MASK_ALPHA],  #  9 - Navy 
+    [ 0.5, 0.0, 0.0, DEFAULT_MASK_ALPHA],  # 10 - Dark Red
+    [ 0.0, 0.5, 0.0, DEFAULT_MASK_ALPHA],  # 11 - Dark Green
+    [ 1.0, 0.8, 0.6, DEFAULT_MASK_ALPHA],  # 12 - Khaky
+    [ 1.0, 0.6, 0.8, DEFAULT_MASK_ALPHA],  # 13 - Pink 
+]
+
+PYRAMID_LEVELS = 2                       # 2x and 4x downsampled
+INTERACTIVE_RENDER_SECONDS = 1.0 / 30.0  # Coarser levels are shown while rendering is slower
+REFINE_DELAY_MS = 200                    # Full resolution is rendered once interaction pauses that long
+RENDER_INTERVAL_MS = 16                  # Requested renders are coalesced into at most one per view per frame
+CINE_FPS = 15.0                          # Frame rate of cine playback
+CINE_PREFETCH_SLICES = 8                 # Slices prepared ahead of cine playback
+
+# Viewports (xmin, ymin, xmax, ymax) of the X, Y and Z views (and the 3D view) in the "single" layout:
+SINGLE_LAYOUT_VIEWPORTS = ((0.0, 0.0, 1.0 / 3.0, 1.0), (1.0 / 3.0, 0.0, 2.0 / 3.0, 1.0), (2.0 / 3.0, 0.0, 1.0, 1.0))
+SINGLE_LAYOUT_3D_VIEWPORTS = ((0.0, 0.5, 0.5, 1.0), (0.5, 0.5, 1.0, 1.0), (0.0, 0.0, 0.5, 0.5), (0.5, 0.0, 1.0, 0.5))
+
+# In-plane axes and normal (columns) of the X, Y and Z views:
+VIEW_AXES = (((0.0, 0.0, 1.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)),
+             ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (0.0, 1.0, 0.0)),
+             ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)))
+OBLIQUE_ROTATION_DEGREES = 5.0           # Rotation of the oblique planes per key press
+SLAB_MODES = (None, "max", "min", "mean")  # Thick-slab projections, cycled by the "m" key
+SLAB_THICKNESS_STEP_MM = 2.0             # Change of the slab thickness per key press
+VOLUME_MAX_OPACITY = 0.2                 # Opacity of the volume at the top of the window
+VOLUME_INTERACTIVE_UPDATE_RATE = 10.0    # Frames per second the volume is sampled for while interacting
+VOLUME_STILL_UPDATE_RATE = 0.001         # Full quality otherwise
+
 
 class bashColours:
     RESET       = "\033[0m"              # Reset
@@ -24,6 +89,25 @@ class bashColours:
     RST         = "\x1B[0m"              # RESET
 
 
+def make_mask_lookup_table(colours_List):
+    """Lookup table of the mask labels: label 0 is transparent, and label k has the k-th (RGBA)
+    colour, or colours are given as (label, R, G, B, A). None for other colour formats.
+    """
+    maskLookUpTable = vtk.vtkLookupTable()
+    maskLookUpTable.SetNumberOfTableValues(len(colours_List) + 1)
+    maskLookUpTable.SetRange(0.0, float(1 + len(colours_List)))
+    maskLookUpTable.SetTableValue(0 , 0.0, 0.0, 0.0, 0.0);
+    if len(colours_List[0]) == 4:
+        for idx , c in enumerate(colours_List):
+            maskLookUpTable.SetTableValue(idx + 1, c[0], c[1], c[2], c[3])
+    elif len(colours_List[0]) == 5:
+        for c in colours_List:
+            maskLookUpTable.SetTableValue(c[0], c[1], c[2], c[3], c[4])
+    else:
+        return None
+    return maskLookUpTable
+
+
 class TextProp:
     def __init__(self,im,actrPosTuple=(0.01,0.975)):
         self.imageViewer = im
@@ -48,10 +132,10 @@ class TextProp:
         #
         self.sliceTextActor = vtk.vtkActor2D()
         self.sliceTextActor.SetMapper(self.sliceTextMapper);
-        self.sliceTextActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedDisplay()
+        self.sliceTextActor.GetPositionCoordinate().SetCoordinateSystemToNormalizedViewport()
         self.sliceTextActor.GetPositionCoordinate().SetValue(actrPosTuple[0],actrPosTuple[1])
         #
-        self.imageViewer.GetRenderer().AddActor2D(self.sliceTextActor)
+        self.imageViewer.GetRenderer().AddViewProp(self.sliceTextActor)
 
     def UpdateTextProp(self,msg,render=False):
         self.sliceTextMapper.SetInput(msg)
@@ -155,6 +239,8 @@ class CustomInteractorManager:
         #
         self.initial_event_position = None
         self._cursor_move_step = 1
+        self._image_viewers = None
+        self._drag_in_3d = False
 
     def set_image_viewer(self, mpr, imViewer):
         self.threePlaneView = mpr
@@ -162,13 +248,31 @@ class CustomInteractorManager:
         #
         self.imageViewer.GetInteractorStyle().RemoveAllObservers()
 
+    def set_image_viewers(self, mpr, imViewers):
+        ## One interactor for the views of a single window; events go to the view under the mouse:
+        self.set_image_viewer(mpr, imViewers[0])
+        for imViewer in imViewers[1:]:
+            imViewer.GetInteractorStyle().RemoveAllObservers()
+        self._image_viewers = {imViewer.GetRenderer(): imViewer for imViewer in imViewers}
+
+    def _select_image_viewer(self, iren):
+        ## The view under the mouse, None in the 3D view:
+        if self._image_viewers is None:
+            return
+        self.imageViewer = self._image_viewers.get(iren.FindPokedRenderer(*iren.GetEventPosition()))
+        if self.imageViewer is not None:
+            self.initialize()
+
     def initialize(self):
         self.minSlice = self.imageViewer.GetSliceMin()
         self.maxSlice = self.imageViewer.GetSliceMax()
 
     def KeyPress(self, obj, event):
         key = obj.GetKeySym()
-        if key == "Up":
+        self._select_image_viewer(obj)
+        if self.imageViewer is None:  # 3D view
+            pass
+        elif key == "Up":
             self.threePlaneView.dispatch_arrow_key_update(
                 self.imageViewer, (0, self._cursor_move_step))
         elif key == "Down":
@@ -185,7 +289,10 @@ class CustomInteractorManager:
 
     def KeyRelease(self, obj, event):
         key = obj.GetKeySym()
-        if key == "r" or key == "R":
+        self._select_image_viewer(obj)
+        if self.imageViewer is None and key in ("period", "comma", "h", "H"):  # 3D view
+            pass
+        elif key == "r" or key == "R":
             self.threePlaneView.dispatch_window_level_reset(True, True)
         elif key == "w" or key == "W":
             self.threePlaneView.dispatch_window_level_reset(True, False)
@@ -210,9 +317,27 @@ class CustomInteractorManager:
                 self.threePlaneView.dispatch_slice_update(self.imageViewer, slice)
         elif key == "h" or key == "H":
             print("Camera: ", self.imageViewer.GetRenderer().GetActiveCamera()) 
+        elif key == "p" or key == "P":
+            print("Rendering: ", json.dumps(self.threePlaneView.get_render_statistics(), indent=4))
+        elif key == "bracketleft" and self.imageViewer is not None:  # Rotate the other planes
+            self.threePlaneView.rotate_oblique_planes(self.imageViewer, OBLIQUE_ROTATION_DEGREES)
+        elif key == "bracketright" and self.imageViewer is not None:
+            self.threePlaneView.rotate_oblique_planes(self.imageViewer, -OBLIQUE_ROTATION_DEGREES)
+        elif key == "o" or key == "O":  # Back to the axis-aligned planes
+            self.threePlaneView.reset_oblique_planes()
+        elif key == "m" or key == "M":  # Slab projection: off, max, min, mean
+            self.threePlaneView.cycle_slab_mode()
+        elif key == "equal" or key == "plus":
+            self.threePlaneView.change_slab_thickness(SLAB_THICKNESS_STEP_MM)
+        elif key == "minus":
+            self.threePlaneView.change_slab_thickness(-SLAB_THICKNESS_STEP_MM)
+        elif key == "space" and self.imageViewer is not None:  # Cine playback of the view on/off
+            self.threePlaneView.toggle_cine(self.imageViewer)
 
     def LeftButtonPress(self, obj, event):
         if self.initial_event_position is None:
+            self._select_image_viewer(obj)
+            self._drag_in_3d = self._image_viewers is not None and self.imageViewer is None
             self.initial_event_position = obj.GetEventPosition()
 
     def LeftButtonRelease(self, obj, event):
@@ -223,29 +348,461 @@ class CustomInteractorManager:
     def MouseMove(self, obj, event):
         current_event_position = obj.GetEventPosition()
         # print(f" -> {current_event_position}")
-        if(self.initial_event_position is not None):
+        if(self.initial_event_position is not None and self._drag_in_3d):
+            self.threePlaneView.dispatch_rotate_3d(
+                current_event_position,
+                obj.GetLastEventPosition())
+        elif(self.initial_event_position is not None):
             self.threePlaneView.dispatch_window_level_event(
                 current_event_position,
                 self.initial_event_position)
         else:
-            self.threePlaneView.dispatch_mouse_move(
-                self.imageViewer,
-                current_event_position)
+            self._select_image_viewer(obj)
+            if self.imageViewer is not None:
+                self.threePlaneView.dispatch_mouse_move(
+                    self.imageViewer,
+                    current_event_position)
 
     def MouseWheelForward(self, obj, event):
+        self._select_image_viewer(obj)
+        if self.imageViewer is None:
+            self.threePlaneView.dispatch_zoom_3d(1.1)
+            return
         slice = self.imageViewer.GetSlice() + 1
         if slice >= self.minSlice and slice <= self.maxSlice:
             self.threePlaneView.dispatch_slice_update(self.imageViewer, slice)
 
     def MouseWheelBackward(self, obj, event):
+        self._select_image_viewer(obj)
+        if self.imageViewer is None:
+            self.threePlaneView.dispatch_zoom_3d(1.0 / 1.1)
+            return
         slice = self.imageViewer.GetSlice() - 1
         if slice >= self.minSlice and slice <= self.maxSlice:
             self.threePlaneView.dispatch_slice_update(self.imageViewer, slice) 
 
 
+def rotation_about(axis, degrees):
+    ## Rodrigues' rotation matrix about a unit axis:
+    angle = np.radians(degrees)
+    crossMatrix = np.array([[0.0, -axis[2], axis[1]], [axis[2], 0.0, -axis[0]], [-axis[1], axis[0], 0.0]])
+    return np.identity(3) + np.sin(angle) * crossMatrix + (1.0 - np.cos(angle)) * crossMatrix @ crossMatrix
+
+
+def rotation_between(a, b):
+    ## Smallest rotation taking the unit vector a to the unit vector b:
+    cross = np.cross(a, b)
+    sine, cosine = np.linalg.norm(cross), np.dot(a, b)
+    if sine < 1e-9:
+        if cosine > 0.0:
+            return np.identity(3)
+        perpendicular = np.cross(a, (1.0, 0.0, 0.0) if abs(a[0]) < 0.9 else (0.0, 1.0, 0.0))
+        return rotation_about(perpendicular / np.linalg.norm(perpendicular), 180.0)
+    return rotation_about(cross / sine, np.degrees(np.arctan2(sine, cosine)))
+
+
+class ObliqueSlice:
+    """Oblique slice of the image, and mask, through the cursor for a view of ThreePlaneView.
+    Its plane has the rotated normal of the view, and in-plane axes turned the least from the 
+    view's, so rotations about the normal of a view leave that view as it is.
+
+    The image and the mask are resliced by a vtkImageReslice each, through the same reslice axes
+    matrix, so the mask stays aligned with the image. The output, a square of the image diagonal 
+    around the point of the plane closest to the image centre, is shown flattened into the plane 
+    of the view where the axis-aligned slice through the cursor would be. Only the pixels of the 
+    square inside the image are resliced.
+    """
+    def __init__(self, renderer, view_axes):
+        self.viewAxes = np.array(view_axes)  # Columns: in-plane axes and normal of the view
+        self.rotation = None
+        self.axes = self.viewAxes
+        self.planeOrigin = np.zeros(3)
+        self.displayOrigin = np.zeros(3)
+        self.imageCentre = np.zeros(3)
+        self.imageEdges = np.zeros((12, 2, 3))
+        self.outputGrid = (0.0, 1.0, 1)  # Origin, spacing and number of pixels of both output axes
+        #
+        self.resliceAxes = vtk.vtkMatrix4x4()   # Output to image coordinates
+        self.displayMatrix = vtk.vtkMatrix4x4()  # Output to view coordinates
+        for col in range(3):
+            for row in range(3):
+                self.displayMatrix.SetElement(row, col, self.viewAxes[row, col])
+        #
+        self.imageReslice = self._make_reslice()
+        self.imageReslice.SetInterpolationModeToLinear()
+        self.imageActor = vtk.vtkImageActor()
+        self.imageActor.GetMapper().SetInputConnection(self.imageReslice.GetOutputPort())
+        self.imageActor.SetUserMatrix(self.displayMatrix)
+        self.imageActor.VisibilityOff()
+        renderer.AddActor(self.imageActor)
+        #
+        self.maskReslice = self._make_reslice()
+        self.maskReslice.SetInterpolationModeToNearestNeighbor()
+        self.maskMapper = vtk.vtkImageMapToColors()
+        self.maskMapper.PassAlphaToOutputOn()
+        self.maskMapper.SetInputConnection(self.maskReslice.GetOutputPort())
+        self.maskActor = vtk.vtkImageActor()
+        self.maskActor.GetMapper().SetInputConnection(self.maskMapper.GetOutputPort())
+        self.maskActor.SetUserMatrix(self.displayMatrix)
+        self.maskActor.InterpolateOff()
+        self.maskActor.VisibilityOff()
+        self.hasMask = False
+        renderer.AddActor(self.maskActor)
+
+    def _make_reslice(self):
+        reslice = vtk.vtkImageReslice()
+        reslice.SetResliceAxes(self.resliceAxes)
+        reslice.SetOutputDimensionality(2)
+        reslice.SetEnableSMP(True)  # vtkSMPTools threads rather than vtkMultiThreader
+        return reslice
+
+    def set_image_data(self, image_data):
+        ## Output geometry, fixed for the image: a square of its diagonal at its finest spacing
+        bounds = image_data.GetBounds()
+        self.imageCentre = np.array([0.5 * (bounds[2 * i] + bounds[2 * i + 1]) for i in range(3)])
+        halfSize = 0.5 * np.sqrt(sum((bounds[2 * i + 1] - bounds[2 * i]) ** 2 for i in range(3)))
+        spacing = min(image_data.GetSpacing())
+        numberOfPixels = int(np.ceil(2.0 * halfSize / spacing)) + 1
+        for reslice in (self.imageReslice, self.maskReslice):
+            reslice.SetOutputSpacing(spacing, spacing, spacing)
+            reslice.SetOutputOrigin(-halfSize, -halfSize, 0.0)
+            reslice.SetOutputExtent(0, numberOfPixels - 1, 0, numberOfPixels - 1, 0, 0)
+        self.outputGrid = (-halfSize, spacing, numberOfPixels)
+        corners = np.array([[bounds[i], bounds[2 + j], bounds[4 + k]] for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        self.imageEdges = np.array([(corners[a], corners[b]) for a in range(8) for b in range(a + 1, 8) 
+                                    if np.count_nonzero(corners[a] != corners[b]) == 1])
+        self.imageReslice.SetInputData(image_data)
+        self.imageReslice.SetBackgroundLevel(image_data.GetScalarRange()[0])
+
+    def set_slab(self, mode, thickness):
+        ## Thick-slab projection ("max", "min", "mean" or None) of the image over thickness mm:
+        spacing = self.imageReslice.GetOutputSpacing()[2]
+        self.imageReslice.SetSlabNumberOfSlices(1 if mode is None else max(int(round(thickness / spacing)), 1))
+        if mode == "min":
+            self.imageReslice.SetSlabModeToMin()
+        elif mode == "mean":
+            self.imageReslice.SetSlabModeToMean()
+        else:
+            self.imageReslice.SetSlabModeToMax()
+
+    def set_mask_data(self, mask_data, lookup_table):
+        self.maskReslice.SetInputData(mask_data)
+        self.maskMapper.SetLookupTable(lookup_table)
+        self.hasMask = True
+
+    def update(self, rotation, cursor_position):
+        ## Axes only change with the rotation, the origins with the cursor:
+        if rotation is not self.rotation:
+            self.rotation = rotation
+            self.axes = rotation_between(self.viewAxes[:, 2], rotation @ self.viewAxes[:, 2]) @ self.viewAxes
+        normal, viewNormal = self.axes[:, 2], self.viewAxes[:, 2]
+        offset = np.asarray(cursor_position) - self.imageCentre
+        self.planeOrigin = self.imageCentre + np.dot(offset, normal) * normal
+        self.displayOrigin = self.imageCentre + np.dot(offset, viewNormal) * viewNormal
+        for row in range(3):
+            for col in range(3):
+                self.resliceAxes.SetElement(row, col, self.axes[row, col])  # Modified only if changed
+            self.resliceAxes.SetElement(row, 3, self.planeOrigin[row])
+            self.displayMatrix.SetElement(row, 3, self.displayOrigin[row])
+        self._crop_output()
+
+    def _crop_output(self):
+        ## Output extent around the intersection of the plane with the edges of the image:
+        normal = self.axes[:, 2]
+        starts, ends = self.imageEdges[:, 0], self.imageEdges[:, 1]
+        denominators = (ends - starts) @ normal
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = ((self.planeOrigin - starts) @ normal) / denominators
+        hits = (denominators != 0.0) & (t >= 0.0) & (t <= 1.0)
+        if not np.any(hits):
+            return
+        points = starts[hits] + t[hits, None] * (ends[hits] - starts[hits]) - self.planeOrigin
+        gridOrigin, spacing, numberOfPixels = self.outputGrid
+        extent = []
+        for inPlaneAxis in self.axes[:, :2].T:
+            coordinates = points @ inPlaneAxis
+            extent += [max(int(np.floor((coordinates.min() - gridOrigin) / spacing)), 0),
+                       min(int(np.ceil((coordinates.max() - gridOrigin) / spacing)), numberOfPixels - 1)]
+        for reslice in (self.imageReslice, self.maskReslice):
+            reslice.SetOutputExtent(extent + [0, 0])
+
+    def to_image_position(self, view_position):
+        ## A point of the view to the point of the image it shows:
+        offset = np.asarray(view_position) - self.displayOrigin
+        return self.planeOrigin + self.axes[:, :2] @ (self.viewAxes[:, :2].T @ offset)
+
+    def to_view_position(self, image_position):
+        ## A point of the plane to where it is shown in the view:
+        offset = np.asarray(image_position) - self.planeOrigin
+        return self.displayOrigin + self.viewAxes[:, :2] @ (self.axes[:, :2].T @ offset)
+
+    def set_visibility(self, visible):
+        self.imageActor.SetVisibility(visible)
+        self.maskActor.SetVisibility(visible and self.hasMask)
+
+
+class SlabProjector:
+    """Thick-slab projection ("max", "min" or "mean") of the slices of an image around the slice 
+    of a view, along its axis, shown in place of the slice.
+
+    The projection is updated incrementally as the slice scrolls: the mean keeps the sum of the 
+    slab and adds the slices entering it and subtracts those leaving it. The maximum and minimum 
+    combine cached projections of aligned blocks of about sqrt(thickness) slices, with the 
+    cumulative projections of the blocks at either end of the slab (van Herk/Gil-Werman), so 
+    scrolling reads each image slice about three times however thick the slab is. Jumps of more 
+    than a block, e.g. from cursor moves in another view, are projected directly.
+    """
+    def __init__(self, renderer, image_data, np_array, axis):
+        self.npArray = np_array  # (z, y, x)
+        self.axis = axis
+        self.numberOfSlices = image_data.GetDimensions()[axis]
+        self.imageOrigin = image_data.GetOrigin()
+        self.imageSpacing = image_data.GetSpacing()
+        self.mode = None
+        self.thickness = 1  # In slices
+        self._blocks = {}
+        self._blockSize = 1
+        self._sum = None
+        self._range = None
+        self._output = None
+        #
+        self.imageData = None
+        self.imageActor = vtk.vtkImageActor()
+        self.imageActor.VisibilityOff()
+        renderer.AddActor(self.imageActor)
+
+    def set_mode(self, mode, thickness):
+        ## Mode and thickness (in slices); the cached projections are dropped:
+        self.mode = mode
+        self.thickness = max(int(thickness), 1)
+        self._blocks = {}
+        self._blockSize = max(int(round(np.sqrt(self.thickness))), 1)
+        self._sum = None
+        self._range = None
+        dtype = np.float32 if mode == "mean" else self.npArray.dtype
+        if self._output is None or self._output.dtype != dtype:
+            shape = list(self.npArray.shape)
+            shape[2 - self.axis] = 1
+            self._output = np.zeros(shape, dtype=dtype)
+            self.imageData = numpy_to_image_data(self._output, self.imageSpacing)
+            self.imageActor.GetMapper().SetInputData(self.imageData)
+            self.imageActor.SetDisplayExtent(self.imageData.GetExtent())  # The orientation of the slice
+
+    def _get_slab(self, start, stop, contiguous=False):
+        ## Slices [start, stop) as a (slice, ...) view, or copy (NumPy reduces short strided axes slowly):
+        if self.axis == 0:
+            slab = np.moveaxis(self.npArray[:, :, start:stop], 2, 0)
+        elif self.axis == 1:
+            slab = np.moveaxis(self.npArray[:, start:stop, :], 1, 0)
+        else:
+            slab = self.npArray[start:stop]
+        return np.ascontiguousarray(slab) if contiguous else slab
+
+    def _block(self, block, part, combine):
+        """Projection of a block ("max"), or its cumulative projections from its first ("prefix")
+        or last ("suffix") slice, computed once.
+        """
+        parts = self._blocks.setdefault(block, {})
+        if part not in parts:
+            slab = self._get_slab(block * self._blockSize, (block + 1) * self._blockSize, contiguous=True)
+            if part == "max":
+                parts[part] = combine.reduce(slab, axis=0)
+            elif part == "prefix":
+                parts[part] = combine.accumulate(slab, axis=0)
+            else:
+                parts[part] = combine.accumulate(slab[::-1], axis=0)[::-1]
+        return parts[part]
+
+    def _get_range(self, slice_index):
+        ## Slices [start, stop) of the slab centred on slice_index, clipped to the image:
+        start = min(max(slice_index - self.thickness // 2, 0), self.numberOfSlices)
+        stop = min(max(slice_index - self.thickness // 2 + self.thickness, 1), self.numberOfSlices)
+        return start, stop
+
+    def _move_to(self, slice_index):
+        origin = list(self.imageOrigin)
+        origin[self.axis] += slice_index * self.imageSpacing[self.axis]
+        self.imageData.SetOrigin(origin)
+
+    def project(self, slice_index):
+        """Projection of the slab centred on slice_index, computed directly and without touching 
+        the incremental state, so it can be prepared on a worker thread (see show).
+        """
+        start, stop = self._get_range(slice_index)
+        slab = self._get_slab(start, stop, contiguous=self.axis != 2)
+        if self.mode == "mean":
+            return (slab.sum(axis=0, dtype=np.float64) / (stop - start)).astype(np.float32)
+        return (np.maximum if self.mode == "max" else np.minimum).reduce(slab, axis=0)
+
+    def show(self, slice_index, projection):
+        ## Shows a projection of project(slice_index); the incremental state restarts from it:
+        self._move_to(slice_index)
+        np.copyto(np.squeeze(self._output, axis=2 - self.axis), projection, casting="unsafe")
+        self._range = self._get_range(slice_index)
+        self._blocks = {}
+        self._sum = None
+        self.imageData.GetPointData().GetScalars().Modified()
+        self.imageData.Modified()
+
+    def update(self, slice_index):
+        """Projects the slab centred on slice_index (clipped to the image) and moves it onto the 
+        slice. Returns whether the projection changed.
+        """
+        self._move_to(slice_index)
+        start, stop = self._get_range(slice_index)
+        if (start, stop) == self._range:
+            return False
+        output = np.squeeze(self._output, axis=2 - self.axis)  # A view of the slice
+        if self.mode == "mean":
+            if self._sum is None or stop <= self._range[0] or start >= self._range[1]:
+                self._sum = self._get_slab(start, stop).sum(axis=0, dtype=np.float64)
+            else:  # Sliding window
+                oldStart, oldStop = self._range
+                if start < oldStart:
+                    self._sum += self._get_slab(start, oldStart).sum(axis=0, dtype=np.float64)
+                elif start > oldStart:
+                    self._sum -= self._get_slab(oldStart, start).sum(axis=0, dtype=np.float64)
+                if stop > oldStop:
+                    self._sum += self._get_slab(oldStop, stop).sum(axis=0, dtype=np.float64)
+                elif stop < oldStop:
+                    self._sum -= self._get_slab(stop, oldStop).sum(axis=0, dtype=np.float64)
+            np.divide(self._sum, stop - start, out=output, casting="unsafe")
+        else:
+            combine = np.maximum if self.mode == "max" else np.minimum
+            firstBlock, lastBlock = start // self._blockSize, (stop - 1) // self._blockSize
+            scrolled = self._range is not None and abs(start - self._range[0]) <= self._blockSize
+            if firstBlock == lastBlock or not scrolled:  # Jumps (e.g. cursor moves) are projected directly
+                output[...] = combine.reduce(self._get_slab(start, stop), axis=0)
+                self._blocks = {}
+            else:  # End of the first block, whole blocks, start of the last block
+                missing = [b for b in range(firstBlock + 1, lastBlock) if "max" not in self._blocks.get(b, {})]
+                if len(missing) > 1:  # In one pass over their slices
+                    slab = self._get_slab(missing[0] * self._blockSize, (missing[-1] + 1) * self._blockSize, contiguous=True)
+                    maxima = combine.reduce(slab.reshape((-1, self._blockSize) + slab.shape[1:]), axis=1)
+                    for block in range(missing[0], missing[-1] + 1):
+                        self._blocks.setdefault(block, {}).setdefault("max", maxima[block - missing[0]])
+                output[...] = self._block(firstBlock, "suffix", combine)[start - firstBlock * self._blockSize]
+                for block in range(firstBlock + 1, lastBlock):
+                    combine(output, self._block(block, "max", combine), out=output)
+                combine(output, self._block(lastBlock, "prefix", combine)[stop - 1 - lastBlock * self._blockSize], out=output)
+            ## Keep what a scroll of a slice either way could reuse:
+            for block in list(self._blocks):
+                parts = self._blocks[block]
+                if block < firstBlock - 1 or block > lastBlock + 1:
+                    del self._blocks[block]
+                    continue
+                if block not in (firstBlock - 1, firstBlock):
+                    parts.pop("suffix", None)
+                if block not in (lastBlock, lastBlock + 1):
+                    parts.pop("prefix", None)
+        self._range = (start, stop)
+        self.imageData.GetPointData().GetScalars().Modified()
+        self.imageData.Modified()
+        return True
+
+
+class VolumePane:
+    """Volume rendering of the image, with the mask labels as coloured surfaces and crosshairs 
+    through the cursor, in the 3D view of ThreePlaneView.
+
+    A vtkSmartVolumeMapper renders the image, on the GPU if it can or with CPU ray casting 
+    (render_mode "cpu"), with colour and opacity ramps across the window of the views. Its 
+    sample distances follow the desired update rate of the render window, so interactive 
+    renders are coarser.
+    """
+    def __init__(self, renderer, render_mode="smart"):
+        self.volumeMapper = vtk.vtkSmartVolumeMapper()
+        if render_mode == "cpu":
+            self.volumeMapper.SetRequestedRenderModeToRayCast()
+        self.volumeMapper.SetInteractiveUpdateRate(VOLUME_INTERACTIVE_UPDATE_RATE)
+        self.volumeMapper.AutoAdjustSampleDistancesOn()
+        #
+        self.colourFunction = vtk.vtkColorTransferFunction()
+        self.opacityFunction = vtk.vtkPiecewiseFunction()
+        self.volumeProperty = vtk.vtkVolumeProperty()
+        self.volumeProperty.SetColor(self.colourFunction)
+        self.volumeProperty.SetScalarOpacity(self.opacityFunction)
+        self.volumeProperty.SetInterpolationTypeToLinear()
+        self.volumeProperty.ShadeOff()
+        self.volume = vtk.vtkVolume()
+        self.volume.SetMapper(self.volumeMapper)
+        self.volume.SetProperty(self.volumeProperty)
+        self.volume.VisibilityOff()
+        renderer.AddVolume(self.volume)
+        self.windowLevel = None
+        #
+        self.labelSurfaces = vtk.vtkDiscreteFlyingEdges3D()
+        self.labelMapper = vtk.vtkPolyDataMapper()
+        self.labelMapper.SetInputConnection(self.labelSurfaces.GetOutputPort())
+        self.labelMapper.SetScalarModeToUsePointData()
+        self.labelMapper.SetColorModeToMapScalars()  # Labels of unsigned char masks are not colours
+        self.labelMapper.UseLookupTableScalarRangeOn()
+        self.labelActor = vtk.vtkActor()
+        self.labelActor.SetMapper(self.labelMapper)
+        self.labelActor.VisibilityOff()
+        renderer.AddActor(self.labelActor)
+        #
+        self.cursor = vtk.vtkCursor3D()
+        self.cursor.AllOff()
+        self.cursor.AxesOn()
+        self.cursor.TranslationModeOff()  # Axes span the image through the focal point
+        self.cursor.WrapOff()
+        cursorMapper = vtk.vtkPolyDataMapper()
+        cursorMapper.SetInputConnection(self.cursor.GetOutputPort())
+        self.cursorActor = vtk.vtkActor()
+        self.cursorActor.SetMapper(cursorMapper)
+        self.cursorActor.GetProperty().SetColor(0.0, 1.0, 0.0)
+        renderer.AddActor(self.cursorActor)
+
+    def set_image_data(self, image_data):
+        self.volumeMapper.SetInputData(image_data)
+        self.volumeProperty.SetScalarOpacityUnitDistance(min(image_data.GetSpacing()))
+        self.volume.SetVisibility(min(image_data.GetDimensions()) > 1)  # Not the placeholder
+        self.cursor.SetModelBounds(image_data.GetBounds())
+
+    def set_mask_data(self, mask_data, lookup_table):
+        ## Surfaces of the labels 1 to N of the lookup table, in their colours:
+        numberOfLabels = lookup_table.GetNumberOfTableValues() - 1
+        self.labelSurfaces.SetInputData(mask_data)
+        self.labelSurfaces.GenerateValues(numberOfLabels, 1, numberOfLabels)
+        self.labelMapper.SetLookupTable(lookup_table)
+        self.labelActor.VisibilityOn()
+
+    def set_window_level(self, level, width):
+        ## Grey and opacity ramps across the window:
+        if (level, width) == self.windowLevel:
+            return
+        self.windowLevel = (level, width)
+        low, high = level - 0.5 * width, level + 0.5 * width
+        self.colourFunction.RemoveAllPoints()
+        self.colourFunction.AddRGBPoint(low, 0.0, 0.0, 0.0)
+        self.colourFunction.AddRGBPoint(high, 1.0, 1.0, 1.0)
+        self.opacityFunction.RemoveAllPoints()
+        self.opacityFunction.AddPoint(low, 0.0)
+        self.opacityFunction.AddPoint(high, VOLUME_MAX_OPACITY)
+
+    def set_cursor(self, position, visible=True):
+        self.cursor.SetFocalPoint(position)
+        self.cursorActor.SetVisibility(visible)
+
+
 class ThreePlaneView():
-    def __init__(self, image_data, cursor_off=False):
+    """Axial, coronal and sagittal views of an image, linked by a cursor.
+
+    The "windows" layout shows each view in a window of its own; the "single" layout shows them,
+    and with view_3d a 3D view of their slices, as viewports of one render window with one 
+    interactor, so a linked update is one render pass. With volume_rendering ("smart" or "cpu", 
+    see VolumePane) the 3D view renders the volume instead of the slices.
+    """
+    def __init__(self, image_data, cursor_off=False, layout="windows", view_3d=False, volume_rendering=None):
+        if layout not in ("windows", "single") or (view_3d and layout != "single"):
+            raise Exception("Unknown layout \"{}\" (the 3D view needs the \"single\" layout)!".format(layout))
+        if volume_rendering not in (None, "smart", "cpu") or (volume_rendering is not None and not view_3d):
+            raise Exception("Unknown volume rendering \"{}\" (it needs the 3D view)!".format(volume_rendering))
         self._cursor_off = cursor_off
+        self._layout = layout
+        self._render_window = None
+        self._view_3d = vtk.vtkRenderer() if view_3d else None
         self._image_spacing = None
         self._image_dimensions = None
         self.lastImageCoordinates = [0, 0, 0]
@@ -254,6 +811,42 @@ class ThreePlaneView():
         self.initial_window_level = None
         self.current_window_width = None
         self.current_window_level = None
+        self._loaders = []
+        self._loader_timer = None
+        self._pyramid = []
+        self._level = 0
+        self._render_seconds = {}
+        self._refine_timer = None
+        self._mask_np_array = None
+        self._mask_label_names = {}
+        self._mask_overlap_policy = None
+        self._dirty_views = set()
+        self._interactive_render_pending = False
+        self._render_requested_at = None
+        self._render_timer = None
+        self._last_flush = 0.0
+        self._rendered_state = {}
+        self._frame_seconds = deque(maxlen=120)
+        self._render_latencies = deque(maxlen=120)
+        self._render_counts = {"requested": 0, "rendered": 0, "skipped": 0}
+        self.show_render_statistics = False
+        self._mask_data = None
+        self._mask_lookup_table = None
+        self._oblique_slices = None
+        self._oblique_rotation = np.identity(3)
+        self._oblique_active = False
+        self._slabs = None
+        self._slab_mode = None
+        self._slab_thickness = 10.0
+        self._volume_rendering = volume_rendering
+        self._volume_pane = None
+        self.cine_fps = CINE_FPS
+        self.cine_prefetch_slices = CINE_PREFETCH_SLICES
+        self._cine_view = None
+        self._cine_timer = None
+        self._cine_prefetcher = None
+        self._cine_last_tick = None
+        self._cine_counts = {"frames": 0, "dropped": 0, "late": 0}
 
         ## Create the three views: Axial Sagittal and Coronal
         self._view_x = vtk.vtkImageViewer2()
@@ -268,6 +861,11 @@ class ThreePlaneView():
         self._set_cursors()
         self._set_image_date()
         self._update_cameras()
+        if self._view_3d is not None:
+            self._set_3d_view()
+        self._render_window_interactor_x.AddObserver("TimerEvent", self._refine)
+        self._render_window_interactor_x.AddObserver("TimerEvent", self._flush_render)
+        self._render_window_interactor_x.AddObserver("TimerEvent", self._cine_tick)
         
         ## Mask Actors:
         self.maskActorX = None
@@ -296,8 +894,120 @@ class ThreePlaneView():
         #
         self._image_spacing    = self._image_data.GetSpacing()
         self._image_dimensions = self._image_data.GetDimensions()
+        self._image_np_array   = self._get_np_array(self._image_data)
+
+    def _get_np_array(self, image_data):
+        ## (z, y, x) view of the first component of the scalars, for voxel lookups without VTK:
+        np_array = vtk_numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+        return np_array.reshape(image_data.GetDimensions()[::-1] + (-1,))[..., 0]
+
+    def _update_readout(self, image_coordinate):
+        """Formats the readout at image_coordinate (x, y, z), or "--" for None, once and shows it 
+        in the three views: voxel index, value, position in mm, mean and standard deviation in 
+        the 3x3x3 neighbourhood and the mask label.
+        """
+        if image_coordinate is None:
+            readout = "--"
+        else:
+            x, y, z = image_coordinate
+            neighbourhood = self._image_np_array[max(z - 1, 0):z + 2, max(y - 1, 0):y + 2, max(x - 1, 0):x + 2]
+            neighbourhood = neighbourhood.astype(np.float64)
+            origin = self._image_data.GetOrigin()
+            readout = "({}/{} , {}/{} , {}/{})    {:g}\n({:.1f}, {:.1f}, {:.1f}) mm    3x3x3: {:.1f} +/- {:.1f}".format(
+                x + 1, self._image_dimensions[0], y + 1, self._image_dimensions[1], z + 1, self._image_dimensions[2],
+                float(self._image_np_array[z, y, x]),
+                origin[0] + x * self._image_spacing[0], origin[1] + y * self._image_spacing[1], origin[2] + z * self._image_spacing[2],
+                neighbourhood.mean(), neighbourhood.std())
+            if self._mask_np_array is not None:
+                label = int(self._mask_np_array[z, y, x])
+                if label != 0:
+                    readout += "\n{} ({})".format(self.get_mask_label_name(label), label)
+        self._text_prop_x.UpdateTextProp(readout)
+        self._text_prop_y.UpdateTextProp(readout)
+        self._text_prop_z.UpdateTextProp(readout)
+
+    def set_mask_label_names(self, label_names, overlap_policy=None):
+        """Names of the mask labels for the readout, e.g. from the JSON sidecar of an h5 
+        multimask converted by MHA_and_HDF5_to_Nifti.py: {label: name} (label as int or str). 
+        With the "bitmask" overlap policy labels are sums of bits, named by their bits.
+        """
+        self._mask_label_names = {int(label): name for label, name in label_names.items()}
+        self._mask_overlap_policy = overlap_policy
+
+    def get_mask_label_name(self, label):
+        if label in self._mask_label_names:
+            return self._mask_label_names[label]
+        if self._mask_overlap_policy == "bitmask":
+            bits = [1 << k for k in range(label.bit_length()) if label & (1 << k)]
+            if all(bit in self._mask_label_names for bit in bits):
+                return "+".join(self._mask_label_names[bit] for bit in bits)
+        return "label"
+
+    def get_image_data(self):
+        return self._image_data
+
+    def set_image_data(self, image_data):
+        ## Swap in a new image (e.g. the full image for the placeholder shown while loading):
+        self._image_data = image_data
+        self._clear_image_pyramid()
+        self._set_image_date()
+        if self._oblique_slices is not None:
+            for oblique_slice in self._oblique_slices:
+                oblique_slice.set_image_data(image_data)
+        if self._slabs is not None:
+            for view, slab in zip((self._view_x, self._view_y, self._view_z), self._slabs):
+                view.GetRenderer().RemoveActor(slab.imageActor)
+            self._slabs = None
+        self.set_slab(self._slab_mode)  # Also hides the image actors behind oblique slices and slabs
+        self.lastImageCoordinates = [0, 0, 0]
+        self.update_masks(self._view_z)
+        self.render()
+
+    def set_status_text(self, msg):
+        self._status_text_prop_x.UpdateTextProp(msg)
+        self._status_text_prop_y.UpdateTextProp(msg)
+        self._status_text_prop_z.UpdateTextProp(msg)
+
+    def follow_loader(self, loader, on_loaded=None, interval_ms=100):
+        """Polls a BackgroundImageLoader every interval_ms: shows its progress in the status text,
+        renders the slices of the displayed image loaded so far, and calls on_loaded(loader) on
+        this (the UI) thread once the loader is done.
+        """
+        self._loaders.append([loader, on_loaded, None])
+        if self._loader_timer is None:
+            self._loader_observer = self._render_window_interactor_x.AddObserver("TimerEvent", self._poll_loaders)
+            self._loader_timer = self._render_window_interactor_x.CreateRepeatingTimer(interval_ms)
+
+    def _poll_loaders(self, obj=None, event=None):
+        if obj is not None and obj.GetTimerEventId() != self._loader_timer:
+            return
+        changed = False
+        for entry in list(self._loaders):
+            loader, on_loaded, last_progress = entry
+            if loader.done or loader.progress != last_progress:
+                entry[2] = loader.progress
+                changed = True
+                if loader.image_data is self._image_data:  # Slices came in
+                    self._image_data.GetPointData().GetScalars().Modified()
+                    self._image_data.Modified()
+            if loader.done:
+                self._loaders.remove(entry)
+                if on_loaded is not None:
+                    on_loaded(loader)
+        if not changed:
+            return
+        self.set_status_text("  ".join("Loading {} ({}%)".format(os.path.basename(loader.file_name), int(100 * loader.progress)) 
+                                       for loader, on_loaded, last_progress in self._loaders))
+        if len(self._loaders) == 0:
+            self._render_window_interactor_x.DestroyTimer(self._loader_timer)
+            self._render_window_interactor_x.RemoveObserver(self._loader_observer)
+            self._loader_timer = None
+        self.render()
 
     def _set_render_window_interactors(self,):
+        if self._layout == "single":
+            self._set_single_render_window()
+            return
         ## Set Render Window Interactor
         self._render_window_interactor_x = vtk.vtkRenderWindowInteractor()
         self._render_window_interactor_y = vtk.vtkRenderWindowInteractor()
@@ -310,8 +1020,81 @@ class ThreePlaneView():
         self._view_x.SetupInteractor(self._render_window_interactor_x)
         self._view_y.SetupInteractor(self._render_window_interactor_y)
         self._view_z.SetupInteractor(self._render_window_interactor_z)
+        #
+        self._render_window_interactors = [
+            self._render_window_interactor_x, self._render_window_interactor_y, self._render_window_interactor_z]
+
+    def _set_single_render_window(self,):
+        ## One render window, with a viewport per view, and one interactor for all of them:
+        self._render_window = vtk.vtkRenderWindow()
+        self._render_window_interactor_x = vtk.vtkRenderWindowInteractor()
+        self._render_window_interactor_x.SetRenderWindow(self._render_window)
+        self._render_window_interactor_y = self._render_window_interactor_x
+        self._render_window_interactor_z = self._render_window_interactor_x
+        self._render_window_interactors = [self._render_window_interactor_x]
+        #
+        viewports = SINGLE_LAYOUT_VIEWPORTS if self._view_3d is None else SINGLE_LAYOUT_3D_VIEWPORTS
+        for view, viewport in zip((self._view_x, self._view_y, self._view_z), viewports):
+            view.SetRenderWindow(self._render_window)
+            view.GetRenderer().SetViewport(viewport)
+            view.SetupInteractor(self._render_window_interactor_x)
+        if self._view_3d is not None:
+            self._view_3d.SetViewport(viewports[3])
+            self._render_window.AddRenderer(self._view_3d)
+
+    def _set_3d_view(self,):
+        ## The slices of the three views and the outline of the image, in 3D:
+        self._planes_3d = []
+        for view in (self._view_x, self._view_y, self._view_z):
+            actor = vtk.vtkImageActor()
+            actor.GetMapper().StreamingOn()
+            self._view_3d.AddActor(actor)
+            self._planes_3d.append(actor)
+        #
+        self._outline_3d = vtk.vtkOutlineFilter()
+        outlineMapper = vtk.vtkPolyDataMapper()
+        outlineMapper.SetInputConnection(self._outline_3d.GetOutputPort())
+        outlineActor = vtk.vtkActor()
+        outlineActor.SetMapper(outlineMapper)
+        outlineActor.GetProperty().SetColor(0.0, 1.0, 0.0)
+        self._view_3d.AddActor(outlineActor)
+        if self._volume_rendering is not None:
+            self._volume_pane = VolumePane(self._view_3d, self._volume_rendering)
+            for actor in self._planes_3d:
+                actor.VisibilityOff()
+        self._update_3d_view()
+
+    def _update_3d_view(self,):
+        ## Follow the slices, window/level and interpolation of the views:
+        if self._outline_3d.GetInput() is not self._image_data:
+            self._outline_3d.SetInputData(self._image_data)
+            for actor in self._planes_3d:
+                actor.GetMapper().SetInputData(self._image_data)
+            if self._volume_pane is not None:
+                self._volume_pane.set_image_data(self._image_data)
+            bounds = self._image_data.GetBounds()
+            centre = [0.5 * (bounds[2 * i] + bounds[2 * i + 1]) for i in range(3)]
+            camera = self._view_3d.GetActiveCamera()
+            camera.SetFocalPoint(centre)
+            camera.SetPosition(centre[0] + 1.0, centre[1] + 1.0, centre[2] - 1.0)
+            camera.SetViewUp(0, 0, -1)
+            self._view_3d.ResetCamera()
+        for view, actor in zip((self._view_x, self._view_y, self._view_z), self._planes_3d):
+            actor.SetDisplayExtent(view.GetImageActor().GetDisplayExtent())
+            actor.GetProperty().SetColorWindow(view.GetColorWindow())
+            actor.GetProperty().SetColorLevel(view.GetColorLevel())
+            actor.GetProperty().SetInterpolationType(view.GetImageActor().GetProperty().GetInterpolationType())
+        if self._volume_pane is not None:
+            self._volume_pane.set_window_level(self._view_z.GetColorLevel(), self._view_z.GetColorWindow())
+            self._volume_pane.set_cursor(self.position, not self._cursor_off)
 
     def _set_custom_interactor_managers(self,):
+        if self._layout == "single":
+            self._interactor_mgr_x = CustomInteractorManager(self._render_window_interactor_x)
+            self._interactor_mgr_x.set_image_viewers(self, (self._view_x, self._view_y, self._view_z))
+            self._interactor_mgr_y = self._interactor_mgr_x
+            self._interactor_mgr_z = self._interactor_mgr_x
+            return
         ## Set Custom Interactors: 
         self._interactor_mgr_x = CustomInteractorManager(self._render_window_interactor_x)
         self._interactor_mgr_y = CustomInteractorManager(self._render_window_interactor_y)
@@ -349,6 +1132,13 @@ class ThreePlaneView():
         self._text_prop_x = TextProp(self._view_x)
         self._text_prop_y = TextProp(self._view_y)
         self._text_prop_z = TextProp(self._view_z)
+        for text_prop in (self._text_prop_x, self._text_prop_y, self._text_prop_z):
+            text_prop.sliceTextProp.SetVerticalJustificationToTop()  # Readout lines go down from the top
+        #
+        self._status_text_prop_x = TextProp(self._view_x, (0.01, 0.01))
+        self._status_text_prop_y = TextProp(self._view_y, (0.01, 0.01))
+        self._status_text_prop_z = TextProp(self._view_z, (0.01, 0.01))
+        self.set_status_text("")
 
     def _set_cursors(self,):
         ## Set Cursor:
@@ -362,11 +1152,19 @@ class ThreePlaneView():
             self._cursor_z = Cursor3D(self._view_z)
 
     def set_viewers_window_name(self,window_title=" ¯\\_(ツ)_/¯"):
+        if self._render_window is not None:
+            self._render_window.SetWindowName(window_title)
+            return
         self._view_x.GetRenderWindow().SetWindowName(" ".join([window_title,"(X)"]))
         self._view_y.GetRenderWindow().SetWindowName(" ".join([window_title,"(Y)"]))
         self._view_z.GetRenderWindow().SetWindowName(" ".join([window_title,"(Z)"]))
 
     def set_viewers_window_size(self, x_pixels=1024, y_pixels=1024):
+        ## Size of each view; the single window is a grid of views that size:
+        if self._render_window is not None:
+            columns, rows = (3, 1) if self._view_3d is None else (2, 2)
+            self._render_window.SetSize(columns * x_pixels, rows * y_pixels)
+            return
         self._render_window_interactor_x.GetRenderWindow().SetSize(x_pixels, y_pixels)
         self._render_window_interactor_y.GetRenderWindow().SetSize(x_pixels, y_pixels)
         self._render_window_interactor_z.GetRenderWindow().SetSize(x_pixels, y_pixels)
@@ -375,6 +1173,8 @@ class ThreePlaneView():
         self._view_x.GetRenderer().SetBackground(r, g, b)
         self._view_y.GetRenderer().SetBackground(r, g, b)
         self._view_z.GetRenderer().SetBackground(r, g, b)
+        if self._view_3d is not None:
+            self._view_3d.SetBackground(r, g, b)
 
     def set_viewers_window_level(self, level, width):
         if (width is not None) and (level is not None):
@@ -408,20 +1208,23 @@ class ThreePlaneView():
             self._view_x.GetImageActor().GetProperty().SetInterpolationTypeToNearest()
             self._view_y.GetImageActor().GetProperty().SetInterpolationTypeToNearest()
             self._view_z.GetImageActor().GetProperty().SetInterpolationTypeToNearest()
+        #
+        for level_data, actors in self._pyramid:
+            for view, actor in zip((self._view_x, self._view_y, self._view_z), actors):
+                actor.GetProperty().SetInterpolationType(view.GetImageActor().GetProperty().GetInterpolationType())
 
     def set_mask_data(self, mask_Data, colours_List):
-        maskLookUpTable = vtk.vtkLookupTable()
-        maskLookUpTable.SetNumberOfTableValues(len(colours_List) + 1)
-        maskLookUpTable.SetRange(0.0, float(1 + len(colours_List)))
-        maskLookUpTable.SetTableValue(0 , 0.0, 0.0, 0.0, 0.0);
-        if len(colours_List[0]) == 4:
-            for idx , c in enumerate(colours_List):
-                maskLookUpTable.SetTableValue(idx + 1, c[0], c[1], c[2], c[3])
-        elif len(colours_List[0]) == 5:
-            for c in colours_List:
-                maskLookUpTable.SetTableValue(c[0], c[1], c[2], c[3], c[4])
-        else:
+        maskLookUpTable = make_mask_lookup_table(colours_List)
+        if maskLookUpTable is None:
             return
+        self._mask_np_array = self._get_np_array(mask_Data)
+        self._mask_data = mask_Data
+        self._mask_lookup_table = maskLookUpTable
+        if self._oblique_slices is not None:
+            for oblique_slice in self._oblique_slices:
+                oblique_slice.set_mask_data(mask_Data, maskLookUpTable)
+        if self._volume_pane is not None:
+            self._volume_pane.set_mask_data(mask_Data, maskLookUpTable)
         ##
         maskMapperX = vtk.vtkImageMapToColors()
         maskMapperX.SetLookupTable(maskLookUpTable);
@@ -442,6 +1245,7 @@ class ThreePlaneView():
         self.maskActorX.GetMapper().SetInputConnection(maskMapperX.GetOutputPort())
         self.maskActorX.GetMapper().SliceFacesCameraOn()
         self.maskActorX.GetMapper().SliceAtFocalPointOn()
+        self.maskActorX.GetMapper().StreamingOn()  # Colour the displayed slice only
         self.maskActorX.InterpolateOff()
         self.maskActorX.Update()
         #
@@ -449,6 +1253,7 @@ class ThreePlaneView():
         self.maskActorY.GetMapper().SetInputConnection(maskMapperY.GetOutputPort())
         self.maskActorY.GetMapper().SliceFacesCameraOn()
         self.maskActorY.GetMapper().SliceAtFocalPointOn()
+        self.maskActorY.GetMapper().StreamingOn()  # Colour the displayed slice only
         self.maskActorY.InterpolateOff()
         self.maskActorY.Update()
         #
@@ -456,12 +1261,15 @@ class ThreePlaneView():
         self.maskActorZ.GetMapper().SetInputConnection(maskMapperZ.GetOutputPort())
         self.maskActorZ.GetMapper().SliceFacesCameraOn()
         self.maskActorZ.GetMapper().SliceAtFocalPointOn()
+        self.maskActorZ.GetMapper().StreamingOn()  # Colour the displayed slice only
         self.maskActorZ.InterpolateOff()
         self.maskActorZ.Update()
         ##
         self._view_x.GetRenderer().AddActor(self.maskActorX)
         self._view_y.GetRenderer().AddActor(self.maskActorY)
         self._view_z.GetRenderer().AddActor(self.maskActorZ)
+        for maskActor in (self.maskActorX, self.maskActorY, self.maskActorZ):
+            maskActor.SetVisibility(not self._oblique_active)
         #
         self.render()
 
@@ -478,6 +1286,9 @@ class ThreePlaneView():
             self.maskActorZ.Update()
 
     def dispatch_mouse_move(self, imViewer, eventPos):
+        if self._oblique_active:
+            self._dispatch_oblique_mouse_move(imViewer, eventPos)
+            return
         if imViewer == self._view_x:
             self.pickerX.Pick(eventPos[0], eventPos[1], 0, self._view_x.GetRenderer())
             if self.pickerX.GetPath():
@@ -523,24 +1334,14 @@ class ThreePlaneView():
         else:
             print("ERROR: Unspecified vtkImageViewer!")
             return
+        #
+        if list(image_coordinate) == self.lastImageCoordinates:
+            return  # Same voxel: nothing to update
         # 
         if image_coordinate[0] >= 0 and image_coordinate[0] < self._image_dimensions[0] and\
            image_coordinate[1] >= 0 and image_coordinate[1] < self._image_dimensions[1] and\
            image_coordinate[2] >= 0 and image_coordinate[2] < self._image_dimensions[2]:
-            voxVal = self._view_x.GetInput().GetScalarComponentAsDouble(
-                image_coordinate[0] , image_coordinate[1] , image_coordinate[2] , 0)
-            self._text_prop_x.UpdateTextProp("".join(
-                [ "(" , str(image_coordinate[0]+1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                        str(image_coordinate[1]+1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                        str(image_coordinate[2]+1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
-            self._text_prop_y.UpdateTextProp("".join(
-                [ "(" , str(image_coordinate[0]+1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                        str(image_coordinate[1]+1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                        str(image_coordinate[2]+1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
-            self._text_prop_z.UpdateTextProp("".join(
-                [ "(" , str(image_coordinate[0]+1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                        str(image_coordinate[1]+1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                        str(image_coordinate[2]+1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
+            self._update_readout(image_coordinate)
             #
             self.lastImageCoordinates = list(image_coordinate)
             #
@@ -549,12 +1350,10 @@ class ThreePlaneView():
                 self._cursor_y.update_cursor_position(self.position)
                 self._cursor_z.update_cursor_position(self.position)
         else:
-            self._text_prop_x.UpdateTextProp("--")
-            self._text_prop_y.UpdateTextProp("--")
-            self._text_prop_z.UpdateTextProp("--")
+            self._update_readout(None)
         #
         self.update_masks(imViewer)
-        self.render()
+        self.request_render(interactive=True)
 
     def dispatch_arrow_key_update(self, imViewer, move=(0, 0)):
         if imViewer == self._view_x:
@@ -580,23 +1379,7 @@ class ThreePlaneView():
         self.position[1] = self._view_y.GetSlice() * self._image_spacing[1]
         self.position[2] = self._view_z.GetSlice() * self._image_spacing[2]
         #
-        voxVal = self._view_x.GetInput().GetScalarComponentAsDouble(
-            self.lastImageCoordinates[0], 
-            self.lastImageCoordinates[1], 
-            self.lastImageCoordinates[2], 
-            0)
-        self._text_prop_x.UpdateTextProp("".join(
-            [ "(" , str(self.lastImageCoordinates[0] + 1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                    str(self.lastImageCoordinates[1] + 1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                    str(self.lastImageCoordinates[2] + 1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
-        self._text_prop_y.UpdateTextProp("".join(
-            [ "(" , str(self.lastImageCoordinates[0] + 1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                    str(self.lastImageCoordinates[1] + 1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                    str(self.lastImageCoordinates[2] + 1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
-        self._text_prop_z.UpdateTextProp("".join(
-            [ "(" , str(self.lastImageCoordinates[0] + 1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                    str(self.lastImageCoordinates[1] + 1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                    str(self.lastImageCoordinates[2] + 1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
+        self._update_readout(self.lastImageCoordinates)
         #
         if not self._cursor_off:
             self._cursor_x.update_cursor_position(self.position)
@@ -604,9 +1387,15 @@ class ThreePlaneView():
             self._cursor_z.update_cursor_position(self.position)
         #
         self.update_masks(imViewer)
-        self.render()    
+        self.request_render(interactive=True)
 
     def dispatch_slice_update(self, imViewer, slice):
+        if self._oblique_active:  # Move along the normal of the oblique plane
+            axis = (self._view_x, self._view_y, self._view_z).index(imViewer)
+            normal = self._oblique_slices[axis].axes[:, 2]
+            self._move_oblique_cursor(np.array(self.position) + 
+                (slice - imViewer.GetSlice()) * self._image_spacing[axis] * normal)
+            return
         if imViewer == self._view_x:
             self._view_x.SetSlice(slice)
             self.lastImageCoordinates[0] = slice - self._view_x.GetSliceMin()
@@ -623,20 +1412,7 @@ class ThreePlaneView():
             print("ERROR: Unspecified vtkImageViewer!")
             return
         #
-        voxVal = self._view_x.GetInput().GetScalarComponentAsDouble(
-            self.lastImageCoordinates[0] , self.lastImageCoordinates[1] , self.lastImageCoordinates[2] , 0)
-        self._text_prop_x.UpdateTextProp("".join(
-            [ "(" , str(self.lastImageCoordinates[0] + 1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                    str(self.lastImageCoordinates[1] + 1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                    str(self.lastImageCoordinates[2] + 1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
-        self._text_prop_y.UpdateTextProp("".join(
-            [ "(" , str(self.lastImageCoordinates[0] + 1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                    str(self.lastImageCoordinates[1] + 1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                    str(self.lastImageCoordinates[2] + 1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
-        self._text_prop_z.UpdateTextProp("".join(
-            [ "(" , str(self.lastImageCoordinates[0] + 1) , "/" , str(self._image_dimensions[0]) , " , " ,\
-                    str(self.lastImageCoordinates[1] + 1) , "/" , str(self._image_dimensions[1]) , " , " ,\
-                    str(self.lastImageCoordinates[2] + 1) , "/" , str(self._image_dimensions[2]) , ")    " , str(voxVal) ]))
+        self._update_readout(self.lastImageCoordinates)
         #
         if not self._cursor_off:
             self._cursor_x.update_cursor_position(self.position)
@@ -644,7 +1420,7 @@ class ThreePlaneView():
             self._cursor_z.update_cursor_position(self.position)
         #
         self.update_masks(imViewer)
-        self.render()
+        self.request_render(interactive=True)
 
     def refresh_current_window_level(self):
         self.current_window_level = self._view_x.GetColorLevel()
@@ -666,7 +1442,7 @@ class ThreePlaneView():
         self._view_y.SetColorWindow(width)
         self._view_z.SetColorWindow(width)
         #
-        self.render()
+        self.request_render(interactive=True)
 
     def dispatch_window_level_reset(self,reset_window,reset_level):
         if reset_window:
@@ -683,6 +1459,19 @@ class ThreePlaneView():
         self.render()
 
     def take_screenshots(self,):
+        if self._render_window is not None:
+            ## One screenshot of the single window:
+            screenshot = vtk.vtkWindowToImageFilter()
+            screenshot.SetInput(self._render_window)
+            screenshot.SetScale(3, 3)
+            screenshot.SetInputBufferTypeToRGBA()
+            screenshot.Update()
+            screenshotImageWRiter = vtk.vtkPNGWriter()
+            screenshotImageWRiter.SetFileName("./{}__X-{}_Y-{}_Z-{}.png".format(self._render_window.GetWindowName(), 
+                self._view_x.GetSlice(), self._view_y.GetSlice(), self._view_z.GetSlice()))
+            screenshotImageWRiter.SetInputConnection(screenshot.GetOutputPort())
+            screenshotImageWRiter.Write()
+            return
         ## Screenshot PNGImageWriter and WindowToImageFilter:
         screenshotImageWRiterX = vtk.vtkPNGWriter()
         screenshotImageWRiterY = vtk.vtkPNGWriter()
@@ -741,44 +1530,982 @@ class ThreePlaneView():
             self._cursor_z.cursor_visibility()
         self.render()
 
+    def rotate_oblique_planes(self, imViewer, degrees):
+        """Rotates the planes of the other two views about the normal of the plane of imViewer,
+        through the cursor. Rotations in two views make double-oblique planes.
+        """
+        if self._oblique_slices is None:
+            self._oblique_slices = []
+            for view, view_axes in zip((self._view_x, self._view_y, self._view_z), VIEW_AXES):
+                oblique_slice = ObliqueSlice(view.GetRenderer(), view_axes)
+                oblique_slice.set_image_data(self._image_data)
+                oblique_slice.set_slab(self._slab_mode, self._slab_thickness)
+                if self._mask_data is not None:
+                    oblique_slice.set_mask_data(self._mask_data, self._mask_lookup_table)
+                self._oblique_slices.append(oblique_slice)
+        axis = (self._view_x, self._view_y, self._view_z).index(imViewer)
+        normal = self._oblique_rotation @ np.array(VIEW_AXES[axis])[:, 2]
+        self._set_oblique_rotation(rotation_about(normal, degrees) @ self._oblique_rotation)
+
+    def reset_oblique_planes(self):
+        self._set_oblique_rotation(np.identity(3))
+
+    def _set_oblique_rotation(self, rotation):
+        self._oblique_rotation = rotation
+        self._oblique_active = not np.allclose(rotation, np.identity(3))
+        self._update_display_actors()
+        self._start_cine_prefetcher()
+        if not self._cursor_off:
+            for cursor in (self._cursor_x, self._cursor_y, self._cursor_z):
+                cursor.update_cursor_position(self.position)
+        self.request_render(interactive=True)
+
+    def _update_display_actors(self):
+        ## The image is shown by the oblique slices, else the slab projections, else the image actors:
+        slab = self._slab_mode is not None and not self._oblique_active
+        for axis, view in enumerate((self._view_x, self._view_y, self._view_z)):
+            view.GetImageActor().SetVisibility(not self._oblique_active and not slab)
+            if self._oblique_slices is not None:
+                self._oblique_slices[axis].set_visibility(self._oblique_active)
+            if self._slabs is not None:
+                self._slabs[axis].imageActor.SetVisibility(slab)
+            for level_data, actors in self._pyramid:
+                actors[axis].VisibilityOff()
+        self._level = 0
+        if self.maskActorX is not None:
+            for maskActor in (self.maskActorX, self.maskActorY, self.maskActorZ):
+                maskActor.SetVisibility(not self._oblique_active)
+
+    def set_slab(self, mode, thickness=None):
+        """Thick-slab projection of the views: mode "max", "min", "mean" or None (single slices), 
+        over thickness mm around their slices (default: the current thickness).
+        """
+        if thickness is not None:
+            self._slab_thickness = max(thickness, 0.0)
+        self._slab_mode = mode
+        if mode is not None and self._slabs is None:
+            self._slabs = [SlabProjector(view.GetRenderer(), self._image_data, self._image_np_array, axis) 
+                           for axis, view in enumerate((self._view_x, self._view_y, self._view_z))]
+        if mode is not None:
+            for axis, slab in enumerate(self._slabs):
+                slab.set_mode(mode, round(self._slab_thickness / self._image_spacing[axis]))
+        if self._oblique_slices is not None:
+            for oblique_slice in self._oblique_slices:
+                oblique_slice.set_slab(mode, self._slab_thickness)
+        self._update_display_actors()
+        self._start_cine_prefetcher()  # Prepare the new projections, if playing
+        self.set_status_text("" if mode is None else "Slab: {} {:g} mm".format(mode, self._slab_thickness))
+        self.request_render()
+
+    def cycle_slab_mode(self):
+        self.set_slab(SLAB_MODES[(SLAB_MODES.index(self._slab_mode) + 1) % len(SLAB_MODES)])
+
+    def change_slab_thickness(self, change):
+        self.set_slab(self._slab_mode, self._slab_thickness + change)
+
+    def _update_slabs(self):
+        for axis, view in enumerate((self._view_x, self._view_y, self._view_z)):
+            slab = self._slabs[axis]
+            slab.update(view.GetSlice() - view.GetSliceMin())
+            slab.imageActor.GetProperty().SetColorWindow(view.GetColorWindow())
+            slab.imageActor.GetProperty().SetColorLevel(view.GetColorLevel())
+            slab.imageActor.GetProperty().SetInterpolationType(view.GetImageActor().GetProperty().GetInterpolationType())
+
+    def _update_oblique_slices(self):
+        ## Planes through the cursor, their window/level and the cursor where they show it:
+        for axis, view in enumerate((self._view_x, self._view_y, self._view_z)):
+            oblique_slice = self._oblique_slices[axis]
+            oblique_slice.update(self._oblique_rotation, self.position)
+            oblique_slice.imageActor.GetProperty().SetColorWindow(view.GetColorWindow())
+            oblique_slice.imageActor.GetProperty().SetColorLevel(view.GetColorLevel())
+            oblique_slice.imageActor.GetProperty().SetInterpolationType(view.GetImageActor().GetProperty().GetInterpolationType())
+            if not self._cursor_off:
+                (self._cursor_x, self._cursor_y, self._cursor_z)[axis].update_cursor_position(
+                    oblique_slice.to_view_position(self.position))
+
+    def _move_oblique_cursor(self, position):
+        ## Cursor to position (clamped to the image), the views' slices to its voxel:
+        upper = [(d - 1) * s for d, s in zip(self._image_dimensions, self._image_spacing)]
+        self.position = [min(max(p, 0.0), u) for p, u in zip(position, upper)]
+        image_coordinate = [int(round(p / s)) for p, s in zip(self.position, self._image_spacing)]
+        for axis, view in enumerate((self._view_x, self._view_y, self._view_z)):
+            view.SetSlice(view.GetSliceMin() + image_coordinate[axis])
+        self.lastImageCoordinates = image_coordinate
+        self._update_readout(image_coordinate)
+        self.request_render(interactive=True)
+
+    def _dispatch_oblique_mouse_move(self, imViewer, eventPos):
+        axis = (self._view_x, self._view_y, self._view_z).index(imViewer)
+        picker = (self.pickerX, self.pickerY, self.pickerZ)[axis]
+        picker.Pick(eventPos[0], eventPos[1], 0, imViewer.GetRenderer())
+        if not picker.GetPath():
+            return
+        position = self._oblique_slices[axis].to_image_position(picker.GetPickPosition())
+        if all(0.0 <= p <= (d - 1) * s for p, d, s in zip(position, self._image_dimensions, self._image_spacing)):
+            self._move_oblique_cursor(position)
+
+    def dispatch_rotate_3d(self, current_event_position, last_event_position):
+        camera = self._view_3d.GetActiveCamera()
+        camera.Azimuth(0.5 * (last_event_position[0] - current_event_position[0]))
+        camera.Elevation(0.5 * (last_event_position[1] - current_event_position[1]))
+        camera.OrthogonalizeViewUp()
+        self._view_3d.ResetCameraClippingRange()
+        self.request_render(views=[self._view_3d], interactive=True)
+
+    def dispatch_zoom_3d(self, factor):
+        self._view_3d.GetActiveCamera().Dolly(factor)
+        self._view_3d.ResetCameraClippingRange()
+        self.request_render(views=[self._view_3d], interactive=True)
+
+    def toggle_cine(self, imViewer):
+        if self._cine_view is imViewer:
+            self.stop_cine()
+        else:
+            self.start_cine(imViewer)
+
+    def start_cine(self, imViewer, fps=None):
+        """Plays through the slices of imViewer at fps (default: cine_fps) frames per second, 
+        looping at the last slice. A SlicePrefetcher prepares the next cine_prefetch_slices 
+        slices while the frames show. Frames are not skipped when rendering falls behind: the 
+        timer periods without a new frame are counted as dropped, and frames whose slice was 
+        not prepared in time as late.
+        """
+        self.stop_cine()
+        if fps is not None:
+            self.cine_fps = fps
+        self._cine_view = imViewer
+        self._cine_counts = {"frames": 0, "dropped": 0, "late": 0}
+        self._cine_last_tick = None
+        self._start_cine_prefetcher()
+        self._cine_timer = self._render_window_interactor_x.CreateRepeatingTimer(max(1, int(1000.0 / self.cine_fps)))
+
+    def _start_cine_prefetcher(self):
+        ## Oblique planes are resliced on the UI thread, so there is nothing to prepare for them:
+        if self._cine_prefetcher is not None:
+            self._cine_prefetcher.stop()
+            self._cine_prefetcher = None
+        if self._cine_view is None or self._oblique_active:
+            return
+        axis = (self._view_x, self._view_y, self._view_z).index(self._cine_view)
+        slab = None if self._slab_mode is None else self._slabs[axis]
+        self._cine_prefetcher = SlicePrefetcher(self._image_np_array, axis, self.cine_prefetch_slices, slab)
+        self._cine_prefetcher.request(self._get_next_cine_slice() - self._cine_view.GetSliceMin())
+        self._cine_prefetcher.start()
+
+    def stop_cine(self):
+        if self._cine_view is None:
+            return
+        self._render_window_interactor_x.DestroyTimer(self._cine_timer)
+        if self._cine_prefetcher is not None:
+            self._cine_prefetcher.stop()
+        self._cine_view = None
+        self._cine_timer = None
+        self._cine_prefetcher = None
+        print("Cine: {frames} frames, {dropped} dropped, {late} late".format(**self._cine_counts))
+        self.set_status_text("")
+
+    def get_cine_statistics(self):
+        return dict(self._cine_counts)
+
+    def _get_next_cine_slice(self):
+        slice = self._cine_view.GetSlice() + 1
+        return slice if slice <= self._cine_view.GetSliceMax() else self._cine_view.GetSliceMin()
+
+    def _cine_tick(self, obj, event):
+        if obj.GetTimerEventId() != self._cine_timer:
+            return
+        now = time.time()
+        if self._cine_last_tick is not None:  # Timer periods spent rendering earlier frames
+            self._cine_counts["dropped"] += max(int((now - self._cine_last_tick) * self.cine_fps + 0.5) - 1, 0)
+        self._cine_last_tick = now
+        #
+        imViewer = self._cine_view
+        slice = self._get_next_cine_slice()
+        if self._cine_prefetcher is not None:
+            index = slice - imViewer.GetSliceMin()
+            prepared = self._cine_prefetcher.get(index)
+            if prepared is None:
+                self._cine_counts["late"] += 1
+            elif self._cine_prefetcher.slab is not None:
+                self._cine_prefetcher.slab.show(index, prepared)
+            self._cine_prefetcher.request((index + 1) % (imViewer.GetSliceMax() - imViewer.GetSliceMin() + 1))
+        self._cine_counts["frames"] += 1
+        self.dispatch_slice_update(imViewer, slice)
+        self.set_status_text("Cine {:g} fps: {}/{}, {} dropped".format(self.cine_fps, 
+            slice - imViewer.GetSliceMin() + 1, imViewer.GetSliceMax() - imViewer.GetSliceMin() + 1, 
+            self._cine_counts["dropped"]))
 
     def initialize(self):
-        self._render_window_interactor_x.Initialize()
-        self._render_window_interactor_y.Initialize()
-        self._render_window_interactor_z.Initialize()
+        for render_window_interactor in self._render_window_interactors:
+            render_window_interactor.Initialize()
+
+    def set_image_pyramid(self, levels):
+        """Adds the downsampled levels of the image, a list of vtkImageData from fine to coarse 
+        (see ImagePyramidBuilder), shown in place of the image while interaction is slow.
+        """
+        self._clear_image_pyramid()
+        for level_data in levels:
+            actors = []
+            for view in (self._view_x, self._view_y, self._view_z):
+                actor = vtk.vtkImageActor()
+                actor.GetMapper().SetInputData(level_data)
+                actor.GetMapper().StreamingOn()
+                actor.GetProperty().SetInterpolationType(view.GetImageActor().GetProperty().GetInterpolationType())
+                actor.VisibilityOff()
+                view.GetRenderer().AddActor(actor)
+                actors.append(actor)
+            self._pyramid.append((level_data, actors))
+        self._render_seconds = {}
+
+    def _clear_image_pyramid(self):
+        for level_data, actors in self._pyramid:
+            for view, actor in zip((self._view_x, self._view_y, self._view_z), actors):
+                view.GetRenderer().RemoveActor(actor)
+        self._pyramid = []
+        self._level = 0
+        for view in (self._view_x, self._view_y, self._view_z):
+            view.GetImageActor().VisibilityOn()
+
+    def _show_level(self, level):
+        ## Level 0 is the image, the others the pyramid levels at the slices of the views:
+        self._level = level
+        for axis, view in enumerate((self._view_x, self._view_y, self._view_z)):
+            view.GetImageActor().SetVisibility(level == 0)
+            for pyramid_level, (level_data, actors) in enumerate(self._pyramid, start=1):
+                actors[axis].SetVisibility(pyramid_level == level)
+            if level == 0:
+                continue
+            level_data, actors = self._pyramid[level - 1]
+            ## The slice of the level closest to the slice of the view, moved onto it:
+            position = self._image_data.GetOrigin()[axis] + view.GetSlice() * self._image_spacing[axis]
+            level_dimensions = level_data.GetDimensions()
+            level_slice = round((position - level_data.GetOrigin()[axis]) / level_data.GetSpacing()[axis])
+            level_slice = min(max(level_slice, 0), level_dimensions[axis] - 1)
+            extent = [0, level_dimensions[0] - 1, 0, level_dimensions[1] - 1, 0, level_dimensions[2] - 1]
+            extent[2 * axis] = extent[2 * axis + 1] = level_slice
+            offset = [0.0, 0.0, 0.0]
+            offset[axis] = position - (level_data.GetOrigin()[axis] + level_slice * level_data.GetSpacing()[axis])
+            actors[axis].SetDisplayExtent(extent)
+            actors[axis].SetPosition(offset)
+            actors[axis].GetProperty().SetColorWindow(view.GetColorWindow())
+            actors[axis].GetProperty().SetColorLevel(view.GetColorLevel())
+
+    def _refine(self, obj, event):
+        if obj.GetTimerEventId() != self._refine_timer:
+            return
+        self._refine_timer = None
+        self.render()
 
-    def render(self):
-        self._view_x.Render()
-        self._view_y.Render()
-        self._view_z.Render()
+    def request_render(self, views=None, interactive=False):
+        """Marks views (default: all three) for rendering at the next frame, RENDER_INTERVAL_MS after
+        the previous one, so a burst of events renders each view at most once. Views whose slice,
+        cursor, text and window/level have not changed since they were last rendered are skipped.
+        """
+        self._dirty_views.update(views if views is not None else self._get_all_views())
+        self._interactive_render_pending = self._interactive_render_pending or interactive
+        self._render_counts["requested"] += 1
+        if self._render_requested_at is None:
+            self._render_requested_at = time.time()
+        if self._render_timer is None:
+            delay_ms = RENDER_INTERVAL_MS - 1000.0 * (time.time() - self._last_flush)
+            self._render_timer = self._render_window_interactor_x.CreateOneShotTimer(max(1, int(delay_ms)))
+
+    def _flush_render(self, obj, event):
+        if obj.GetTimerEventId() != self._render_timer:
+            return
+        self._render_timer = None
+        views, self._dirty_views = self._dirty_views, set()
+        interactive, self._interactive_render_pending = self._interactive_render_pending, False
+        if self.show_render_statistics:
+            statistics = self.get_render_statistics()
+            self.set_status_text("{:.1f} fps, {:.1f} ms latency".format(statistics["fps"], statistics["mean_latency_ms"]))
+        self.render(interactive=interactive, views=views)
+        #
+        now = time.time()
+        self._frame_seconds.append(now - self._last_flush)
+        self._render_latencies.append(now - self._render_requested_at)
+        self._last_flush = now
+        self._render_requested_at = None
+
+    def _get_all_views(self):
+        ## The three views, and the 3D view (a vtkRenderer) of the "single" layout:
+        views = (self._view_x, self._view_y, self._view_z)
+        return views if self._view_3d is None else views + (self._view_3d,)
+
+    def _get_view_state(self, view):
+        ## What a view shows, to skip views that would render the same image:
+        if view is self._view_3d:
+            camera = view.GetActiveCamera()
+            return (camera.GetPosition(), camera.GetFocalPoint(), camera.GetViewUp(), tuple(self.position),
+                    tuple(self._get_view_state(v)[:3] for v in (self._view_x, self._view_y, self._view_z)))
+        cursor = {self._view_x: self._cursor_x, self._view_y: self._cursor_y, self._view_z: self._cursor_z}[view]
+        text = {self._view_x: self._text_prop_x, self._view_y: self._text_prop_y, self._view_z: self._text_prop_z}[view]
+        oblique = None
+        if self._oblique_active:
+            oblique_slice = self._oblique_slices[(self._view_x, self._view_y, self._view_z).index(view)]
+            oblique = (oblique_slice.resliceAxes.GetMTime(), oblique_slice.displayMatrix.GetMTime())
+        return (view.GetSlice(), view.GetColorWindow(), view.GetColorLevel(), self._level, text.sliceTextMapper.GetInput(),
+                None if cursor is None else (cursor.cursor.GetFocalPoint(), cursor.state), oblique,
+                self._slab_mode, self._slab_thickness)
+
+    def get_render_statistics(self):
+        """Frame rate and latency (from the first request to the end of its render) over the 
+        last 120 frames, and the counts of requested, rendered and skipped view renders.
+        """
+        frame_seconds = list(self._frame_seconds)[1:] if len(self._frame_seconds) > 1 else [0.0]
+        latencies = list(self._render_latencies) or [0.0]
+        return dict(self._render_counts,
+            fps=1.0 / max(np.median(frame_seconds), 1e-6) if frame_seconds != [0.0] else 0.0,
+            mean_latency_ms=1000.0 * float(np.mean(latencies)),
+            max_latency_ms=1000.0 * float(np.max(latencies)),
+            mean_render_ms={level: 1000.0 * seconds for level, seconds in self._render_seconds.items()})
+
+    def render(self, interactive=False, views=None):
+        """Renders the views (default: all of them, regardless of their state). Interactive renders 
+        (of the dispatch methods) show the finest pyramid level that renders within 
+        INTERACTIVE_RENDER_SECONDS, and full resolution is rendered REFINE_DELAY_MS after the 
+        last of them. In the "single" layout, the window is rendered once if any view changed.
+        The volume of the 3D view is sampled coarser in interactive renders, and refined likewise.
+        """
+        all_views = self._get_all_views()
+        skip_unchanged = views is not None
+        if self._oblique_active:  # Reslicing is quick enough without the pyramid
+            self._update_oblique_slices()
+        elif self._slab_mode is not None:  # So are the incremental slab updates
+            self._update_slabs()
+        elif len(self._pyramid) > 0:
+            level = 0
+            if interactive:
+                while level < len(self._pyramid) and self._render_seconds.get(level, 0.0) > INTERACTIVE_RENDER_SECONDS:
+                    level += 1
+            if level != self._level:
+                views = all_views
+            self._show_level(level)
+        if interactive and (len(self._pyramid) > 0 or self._volume_pane is not None):
+            if self._refine_timer is not None:
+                self._render_window_interactor_x.DestroyTimer(self._refine_timer)
+            self._refine_timer = self._render_window_interactor_x.CreateOneShotTimer(REFINE_DELAY_MS)
+        if self._volume_pane is not None:
+            self._render_window.SetDesiredUpdateRate(VOLUME_INTERACTIVE_UPDATE_RATE if interactive else VOLUME_STILL_UPDATE_RATE)
+        tic = time.time()
+        rendered = 0
+        for view in all_views:
+            if views is not None and view not in views:
+                continue
+            state = self._get_view_state(view)
+            if skip_unchanged and self._rendered_state.get(view) == state:
+                self._render_counts["skipped"] += 1
+                continue
+            if self._render_window is None:
+                view.Render()
+            elif view is not self._view_3d and view not in self._rendered_state:
+                view.Render()  # vtkImageViewer2 sets its camera up on its first render
+            self._rendered_state[view] = state
+            rendered += 1
+        if self._render_window is not None and rendered > 0:
+            if self._view_3d is not None:
+                self._update_3d_view()
+            self._render_window.Render()  # Every viewport in one pass
+        self._render_counts["rendered"] += rendered
+        if rendered > 0:
+            self._render_seconds[self._level] = (time.time() - tic) * (
+                len(all_views) / rendered if self._render_window is None else 1.0)
 
     def start(self):
-        self._render_window_interactor_x.Start()
-        self._render_window_interactor_y.Start()
-        self._render_window_interactor_z.Start()
+        for render_window_interactor in self._render_window_interactors:
+            render_window_interactor.Start()
         
     def finalize(self):
-        self._render_window_interactor_x.GetRenderWindow().Finalize()
-        self._render_window_interactor_y.GetRenderWindow().Finalize()
-        self._render_window_interactor_z.GetRenderWindow().Finalize()
+        for render_window_interactor in self._render_window_interactors:
+            render_window_interactor.GetRenderWindow().Finalize()
 
     def terminate_app(self):
-        self._render_window_interactor_x.TerminateApp()
-        self._render_window_interactor_y.TerminateApp()
-        self._render_window_interactor_z.TerminateApp()
+        for render_window_interactor in self._render_window_interactors:
+            render_window_interactor.TerminateApp()
         #
         quit()
 
 
+def numpy_to_image_data(np_array, spacing, origin=(0.0, 0.0, 0.0)):
+    """Wraps a C-contiguous (z, y, x) array as the scalars of a vtkImageData, without copying.
+    The VTK array keeps a reference to np_array (a memmap stays open as long as the image).
+    """
+    image_data = vtk.vtkImageData()
+    image_data.SetDimensions(np_array.shape[2], np_array.shape[1], np_array.shape[0])
+    image_data.SetSpacing(spacing)
+    image_data.SetOrigin(origin)
+    image_data.GetPointData().SetScalars(vtk_numpy_support.numpy_to_vtk(np_array.reshape(-1), deep=False))
+    return image_data
+
+
+def read_nifti_header(file_name):
+    """Reads the header of a NIFTI-1 or NIFTI-2 file, gzipped or not, in either byte order.
+
+    Returns:
+        A dictionary with the (z, y, x) "shape", the "dtype" in the byte order of the file, the 
+        "spacing", "qfac" and "vox_offset", or None if the file is not a 3D NIFTI of a supported 
+        data type.
+    """
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(file_name, "rb") as file:
+        header = file.read(NIFTI2_HEADER_SIZE)
+    for header_format, header_size, byte_order in [(header_format, header_size, byte_order) 
+            for header_format, header_size in ((NIFTI1_HEADER_FORMAT, NIFTI1_HEADER_SIZE), (NIFTI2_HEADER_FORMAT, NIFTI2_HEADER_SIZE))
+            for byte_order in "<>"]:
+        if len(header) >= header_size and struct.unpack(byte_order + "i", header[:4])[0] == header_size:
+            fields = struct.unpack(byte_order + header_format[1:], header[:header_size])
+            break
+    else:
+        return None
+    if header_size == NIFTI1_HEADER_SIZE:
+        dim, datatype, pixdim, vox_offset = fields[7:15], fields[19], fields[22:30], int(fields[30])
+    else:
+        dim, datatype, pixdim, vox_offset = fields[4:12], fields[2], fields[15:23], fields[23]
+    dtypes = {code: dtype for dtype, code in NIFTI_DATATYPES.items()}
+    if datatype not in dtypes or not 1 <= dim[0] <= 7 or any(d > 1 for d in dim[4:dim[0] + 1]):
+        return None
+    shape = tuple(max(d, 1) if i < dim[0] else 1 for i, d in enumerate(dim[1:4]))
+    return {
+        "shape":      shape[::-1],
+        "dtype":      dtypes[datatype].newbyteorder(byte_order),
+        "spacing":    [abs(p) if p != 0 else 1.0 for p in pixdim[1:4]],
+        "qfac":       -1 if pixdim[0] < 0 else 1,
+        "vox_offset": vox_offset,
+    }
+
+
+def memory_map_nifti(file_name):
+    """Memory maps the voxels of an uncompressed NIFTI-1 or NIFTI-2 file as vtkNIFTIImageReader 
+    would read them, so only the pages that are displayed are read from disk. Returns None for the
+    files that have to be read: compressed, more than 3 dimensions, non-native byte order, 
+    unsupported data type or qfac < 0 (the reader reverses the slices).
+    """
+    header = None if file_name.endswith(".gz") else read_nifti_header(file_name)
+    if header is None or header["qfac"] < 0 or not header["dtype"].isnative:
+        return None
+    if os.path.getsize(file_name) < header["vox_offset"] + np.prod(header["shape"]) * header["dtype"].itemsize:
+        return None
+    np_array = np.memmap(file_name, dtype=header["dtype"], mode="r", offset=header["vox_offset"], shape=header["shape"])
+    return numpy_to_image_data(np_array, header["spacing"])
+
+
+def memory_map_nrrd(file_name):
+    """Memory maps the voxels of a 3D NRRD file with raw encoding (attached or detached data file).
+    Returns None for the files that have to be read by vtkNrrdReader.
+    """
+    fields = {}
+    with open(file_name, "rb") as file:
+        if not file.readline().startswith(b"NRRD"):
+            return None
+        for line in file:
+            line = line.decode("latin-1").rstrip("\r\n")
+            if line == "":
+                break
+            if line.startswith("#") or ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            fields[key.strip().lower()] = value.lstrip("=").strip()
+        data_offset = file.tell()
+    if fields.get("encoding") != "raw" or fields.get("dimension") != "3" or fields.get("type") not in NRRD_TYPES or \
+       int(fields.get("line skip", fields.get("lineskip", "0"))) != 0:
+        return None
+    dtype = np.dtype(NRRD_TYPES[fields["type"]])
+    if dtype.itemsize > 1 and fields.get("endian", sys.byteorder) != sys.byteorder:
+        return None
+    shape = tuple(int(size) for size in fields["sizes"].split())[::-1]
+    data_file = fields.get("data file", fields.get("datafile"))
+    if data_file is not None:
+        if len(data_file.split()) != 1:
+            return None  # A list of data files
+        data_file, data_offset = os.path.join(os.path.dirname(file_name), data_file), 0
+    else:
+        data_file = file_name
+    byte_skip = int(fields.get("byte skip", fields.get("byteskip", "0")))
+    data_bytes = int(np.prod(shape)) * dtype.itemsize
+    data_offset = os.path.getsize(data_file) - data_bytes if byte_skip == -1 else data_offset + byte_skip
+    if data_offset < 0 or os.path.getsize(data_file) < data_offset + data_bytes:
+        return None
+    if "spacings" in fields:
+        spacing = [float(s) if s.lower() != "nan" else 1.0 for s in fields["spacings"].split()]
+    elif "space directions" in fields:
+        spacing = [float(np.linalg.norm([float(v) for v in d.strip("()").split(",")])) 
+                   for d in fields["space directions"].split()]
+    else:
+        spacing = [1.0, 1.0, 1.0]
+    np_array = np.memmap(data_file, dtype=dtype, mode="r", offset=data_offset, shape=shape)
+    return numpy_to_image_data(np_array, spacing)
+
+
+def read_image_data(file_name, memory_map=True):
+    """Reads a NIFTI, VTI or NRRD image. Uncompressed NIFTI and raw NRRD files are memory mapped,
+    unless memory_map is False; everything else is read (decompressed into memory) by VTK.
+    """
+    if not os.path.isfile(file_name):
+        print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
+            bashColours.BOLDRED, bashColours.BOLDBLACK, file_name, bashColours.BOLDRED, bashColours.RESET))
+        quit()
+    if file_name.split(".")[-1] == "vti":
+        imageReader = vtk.vtkXMLImageDataReader()
+    elif file_name.split(".")[-1] == "nrrd":
+        imageData = memory_map_nrrd(file_name) if memory_map else None
+        if imageData is not None:
+            return imageData
+        imageReader = vtk.vtkNrrdReader()
+    elif file_name.split(".")[-1] == "nii" or file_name.split(".")[-2] == "nii":
+        imageData = memory_map_nifti(file_name) if memory_map else None
+        if imageData is not None:
+            return imageData
+        imageReader = vtk.vtkNIFTIImageReader()
+    else:
+        raise Exception(f"\"{file_name}\" does not have the expected extension!")
+    imageReader.SetFileName(file_name)
+    try:
+        imageReader.Update()
+        return imageReader.GetOutput()
+    except:
+        print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, file_name, bashColours.BOLDRED, " file!\nAborting...", bashColours.RESET)
+        quit()
+
+
+def mask_to_labels(mask_np_array, number_of_labels):
+    """Rounds mask values to the nearest label and zeros the values outside [1, number_of_labels].
+    Integer masks already in range are returned as they are, anything else is converted slab by 
+    slab into a uint8 array, so the mask is never copied as a whole in floating point.
+    """
+    flat_mask = mask_np_array.reshape(-1)
+    if np.issubdtype(flat_mask.dtype, np.integer):
+        in_range = True
+        for start in range(0, flat_mask.size, MASK_SLAB_VOXELS):
+            slab = flat_mask[start:start + MASK_SLAB_VOXELS]
+            if slab.min() < 0 or slab.max() > number_of_labels:
+                in_range = False
+                break
+        if in_range:
+            return mask_np_array
+    labels = np.empty(flat_mask.shape, dtype=np.uint8)
+    for start in range(0, flat_mask.size, MASK_SLAB_VOXELS):
+        slab = flat_mask[start:start + MASK_SLAB_VOXELS]
+        if not np.issubdtype(slab.dtype, np.integer):
+            slab = np.rint(slab)
+        labels[start:start + MASK_SLAB_VOXELS] = np.where((slab > 0) & (slab <= number_of_labels), slab, 0)
+    return labels.reshape(mask_np_array.shape)
+
+
+def set_mask_labels(mask_data, number_of_labels):
+    """Replaces the scalars of mask_data with labels in [0, number_of_labels], see mask_to_labels.
+    """
+    ## Use numpy to process the mask:
+    dimension = mask_data.GetDimensions()
+    mask_np_array = vtk_numpy_support.vtk_to_numpy(mask_data.GetPointData().GetScalars())
+    mask_np_array = mask_np_array.reshape(dimension[::-1])
+
+    ## This is specific to Artrya masks: 
+    if not True:
+        print(f"Transposing Mask array: {mask_np_array.shape} --> ", end="")
+        mask_np_array = mask_np_array.transpose(2, 1, 0)
+        mask_np_array = np.flip(mask_np_array, axis=2)
+        print(f"{mask_np_array.shape}")
+
+    ## Make sure that voxel values are consistent with the number of colors:
+    label_np_array = mask_to_labels(mask_np_array, number_of_labels)
+    mask_data.GetPointData().SetScalars(vtk_numpy_support.numpy_to_vtk(
+        num_array=np.ascontiguousarray(label_np_array).reshape(-1), deep=False))
+
+
+class BackgroundImageLoader(threading.Thread):
+    """Loads an image on a worker thread, so the viewer can be shown while it loads.
+
+    Uncompressed NIFTI and raw NRRD files are memory mapped and available right away. Other NIFTI
+    files (gzipped, qfac < 0 or non-native byte order) are allocated up front and decompressed 
+    into the image slab by slab: image_data is the final image from the start and progress tells
+    how many slices are in. Everything else is read by VTK and image_data is only set when done.
+    The VTK objects are only touched by the thread until done is set, except for the scalars 
+    filled in the NIFTI case, which the viewer may render (and mark modified) as they come in.
+
+    Masks are given their number_of_labels: they are converted to labels (set_mask_labels) on 
+    the thread, and then only available when done.
+    """
+    def __init__(self, file_name, memory_map=True, number_of_labels=None, slab_bytes=LOADER_SLAB_BYTES):
+        super().__init__(daemon=True)
+        self.file_name  = file_name
+        self.slab_bytes = slab_bytes
+        self.number_of_labels = number_of_labels
+        self.image_data = None
+        self.progress   = 0.0
+        self.done       = False
+        self.error      = None
+        self._nifti_header = None
+        self._np_array     = None
+        #
+        is_nifti = file_name.split(".")[-1] == "nii" or file_name.split(".")[-2] == "nii"
+        if memory_map and is_nifti:
+            self.image_data = memory_map_nifti(file_name)
+        elif memory_map and file_name.split(".")[-1] == "nrrd":
+            self.image_data = memory_map_nrrd(file_name)
+        if self.image_data is not None and number_of_labels is None:
+            self.progress = 1.0
+            self.done = True
+        elif self.image_data is None and is_nifti:
+            self._nifti_header = read_nifti_header(file_name)
+            if self._nifti_header is not None:
+                self._np_array = np.zeros(self._nifti_header["shape"], dtype=self._nifti_header["dtype"].newbyteorder("="))
+                self.image_data = numpy_to_image_data(self._np_array, self._nifti_header["spacing"])
+
+    def run(self):
+        if self.done:
+            return
+        try:
+            if self._nifti_header is not None:
+                self._read_nifti_slabs()
+            elif self.image_data is None:
+                self.image_data = read_image_data(self.file_name, memory_map=False)
+            if self.number_of_labels is not None:
+                set_mask_labels(self.image_data, self.number_of_labels)
+        except (Exception, SystemExit) as e:  # read_image_data quits on errors
+            self.error = e
+        self.progress = 1.0
+        self.done = True
+
+    def _read_nifti_slabs(self):
+        header = self._nifti_header
+        number_of_slices = header["shape"][0]
+        slab_slices = max(1, self.slab_bytes // (self._np_array[0].size * header["dtype"].itemsize))
+        opener = gzip.open if self.file_name.endswith(".gz") else open
+        with opener(self.file_name, "rb") as file:
+            file.seek(header["vox_offset"])
+            for start in range(0, number_of_slices, slab_slices):
+                stop = min(start + slab_slices, number_of_slices)
+                slab = np.empty((stop - start,) + header["shape"][1:], dtype=header["dtype"])
+                if file.readinto(memoryview(slab).cast("B")) != slab.nbytes:
+                    raise Exception("\"{}\" is truncated!".format(self.file_name))
+                if header["qfac"] < 0:  # As vtkNIFTIImageReader, reverse the slices
+                    self._np_array[number_of_slices - stop:number_of_slices - start] = slab[::-1]
+                else:
+                    self._np_array[start:stop] = slab  # Swaps the bytes if needed
+                self.progress = stop / number_of_slices
+
+
+def downsample_by_2(np_array, slab_slices=32):
+    """Means of 2x2x2 blocks (2x2 along the axes longer than 1), computed slab by slab so a memory 
+    mapped array is read once, in order. Trailing odd slices, rows and columns are dropped.
+    """
+    factors = [2 if n > 1 else 1 for n in np_array.shape]
+    shape = [n // f for n, f in zip(np_array.shape, factors)]
+    downsampled = np.empty(shape, dtype=np_array.dtype)
+    for start in range(0, shape[0], slab_slices):
+        stop = min(start + slab_slices, shape[0])
+        slab = np.asarray(np_array[start * factors[0]:stop * factors[0], :shape[1] * factors[1], :shape[2] * factors[2]], dtype=np.float32)
+        slab = slab.reshape(stop - start, factors[0], shape[1], factors[1], shape[2], factors[2]).mean(axis=(1, 3, 5))
+        downsampled[start:stop] = np.rint(slab) if np.issubdtype(np_array.dtype, np.integer) else slab
+    return downsampled, factors
+
+
+class ImagePyramidBuilder(threading.Thread):
+    """Builds the 2x and 4x (PYRAMID_LEVELS halvings) downsampled levels of an image on a worker
+    thread, with the progress and done attributes of BackgroundImageLoader. The levels are cached
+    next to the image ("<image>.pyramid_x2.npy", ...) and memory mapped from there while they are
+    newer than the image; they are only kept in memory if the directory is not writable.
+    """
+    def __init__(self, image_data, image_file_name, number_of_levels=PYRAMID_LEVELS):
+        super().__init__(daemon=True)
+        self.file_name        = image_file_name + ".pyramid"
+        self.image_file_name  = image_file_name
+        self.number_of_levels = number_of_levels
+        self.levels           = []  # vtkImageData, fine to coarse
+        self.image_data       = None
+        self.progress         = 0.0
+        self.done             = False
+        self.error            = None
+        self._np_array = vtk_numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+        self._np_array = self._np_array.reshape(image_data.GetDimensions()[::-1])
+        self._spacing  = image_data.GetSpacing()
+        self._origin   = image_data.GetOrigin()
+
+    def run(self):
+        try:
+            np_array = self._np_array
+            level_factors = [1, 1, 1]  # (x, y, z)
+            for idx in range(self.number_of_levels):
+                cache_file_name = "{}.pyramid_x{}.npy".format(self.image_file_name, 2**(idx + 1))
+                step_factors = [2 if n > 1 else 1 for n in np_array.shape]
+                cached = None
+                if os.path.isfile(cache_file_name) and os.path.getmtime(cache_file_name) >= os.path.getmtime(self.image_file_name):
+                    cached = np.load(cache_file_name, mmap_mode="r")
+                if cached is not None and cached.shape == tuple(n // f for n, f in zip(np_array.shape, step_factors)):
+                    np_array = cached
+                else:
+                    np_array, step_factors = downsample_by_2(np_array)
+                    try:
+                        np.save(cache_file_name + ".tmp.npy", np_array)
+                        os.replace(cache_file_name + ".tmp.npy", cache_file_name)
+                        np_array = np.load(cache_file_name, mmap_mode="r")
+                    except OSError:
+                        pass  # Keep the level in memory
+                level_factors = [f * s for f, s in zip(level_factors, step_factors[::-1])]
+                # Block means sit at the centres of the blocks:
+                spacing = [s * f for s, f in zip(self._spacing, level_factors)]
+                origin = [o + (f - 1) * s / 2.0 for o, s, f in zip(self._origin, self._spacing, level_factors)]
+                self.levels.append(numpy_to_image_data(np_array, spacing, origin))
+                self.progress = (idx + 1) / self.number_of_levels
+        except Exception as e:
+            self.error = e
+        self.progress = 1.0
+        self.done = True
+
+
+
+class SlicePrefetcher(threading.Thread):
+    """Prepares the slices that cine playback along an axis will show next, on a worker thread: 
+    the look_ahead slices from the one last requested, wrapping around the end of the image.
+
+    Slices are read from the (z, y, x) array into contiguous copies, which pages memory-mapped 
+    images in ahead of the render, or projected by a SlabProjector (its project method) in slab 
+    mode, so the UI thread only shows them (SlabProjector.show). get pops a prepared slice, or 
+    returns None if it was not ready in time. stop ends the thread.
+    """
+    def __init__(self, np_array, axis, look_ahead=CINE_PREFETCH_SLICES, slab=None):
+        super().__init__(daemon=True)
+        self.axis       = axis
+        self.look_ahead = max(int(look_ahead), 1)
+        self.slab       = slab
+        self.done       = False
+        self.error      = None
+        self._np_array  = np_array
+        self._number_of_slices = np_array.shape[2 - axis]
+        self._slices    = {}  # Slice index: prepared slice
+        self._next      = None
+        self._condition = threading.Condition()
+
+    def _get_window(self):
+        return [(self._next + k) % self._number_of_slices for k in range(min(self.look_ahead, self._number_of_slices))]
+
+    def request(self, slice_index):
+        ## Slices from slice_index on are needed next; those behind it are dropped:
+        with self._condition:
+            self._next = slice_index
+            window = self._get_window()
+            for index in list(self._slices):
+                if index not in window:
+                    del self._slices[index]
+            self._condition.notify()
+
+    def get(self, slice_index):
+        with self._condition:
+            return self._slices.pop(slice_index, None)
+
+    def stop(self):
+        with self._condition:
+            self.done = True
+            self._condition.notify()
+
+    def _prepare(self, slice_index):
+        if self.slab is not None:
+            return self.slab.project(slice_index)
+        return np.array(np.take(self._np_array, slice_index, axis=2 - self.axis))
+
+    def run(self):
+        try:
+            while True:
+                with self._condition:
+                    missing = None
+                    while not self.done and missing is None:
+                        if self._next is not None:
+                            missing = next((i for i in self._get_window() if i not in self._slices), None)
+                        if missing is None:
+                            self._condition.wait()
+                    if self.done:
+                        return
+                prepared = self._prepare(missing)  # NumPy lets the UI thread run meanwhile
+                with self._condition:
+                    if missing in self._get_window():
+                        self._slices[missing] = prepared
+        except Exception as e:
+            self.error = e
+        self.done = True
+
+
+
+def auto_window_level(image_data, max_samples=2**20):
+    """Window level and width spanning the 1st to 99th percentiles of the image, from a strided 
+    sample of at most about max_samples voxels.
+    """
+    np_array = vtk_numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars())
+    np_array = np_array.reshape(image_data.GetDimensions()[::-1] + (-1,))[..., 0]
+    stride = max(1, int(round((np_array.size / max_samples) ** (1.0 / 3.0))))
+    low, high = np.percentile(np_array[::stride, ::stride, ::stride], (1.0, 99.0))
+    return 0.5 * (low + high), max(high - low, 1.0)
+
+
+class OffscreenSliceRenderer:
+    """Renders slices of images, with an optional mask overlay, to PNG files without a display.
+
+    One offscreen render window, image and mask actors, window-to-image filter and PNG writer 
+    are reused for every image and slice. The cameras look at the slices as in ThreePlaneView.
+    """
+    # Orientation: (axis, camera direction, view up), as in ThreePlaneView._update_cameras
+    ORIENTATIONS = {
+        "x": (0, (1.0, 0.0, 0.0), (0.0, 0.0, -1.0)),
+        "y": (1, (0.0, 1.0, 0.0), (0.0, 0.0, -1.0)),
+        "z": (2, (0.0, 0.0, 1.0), (0.0, 1.0, 0.0)),
+    }
+
+    def __init__(self, size=512, background=(0.0, 0.0, 0.25), interpolation="Nearest"):
+        self.renderWindow = vtk.vtkRenderWindow()
+        self.renderWindow.SetOffScreenRendering(1)
+        self.renderWindow.SetSize(size, size)
+        self.renderer = vtk.vtkRenderer()
+        self.renderer.SetBackground(*background)
+        self.renderer.GetActiveCamera().ParallelProjectionOn()
+        self.renderWindow.AddRenderer(self.renderer)
+        #
+        self.imageActor = vtk.vtkImageActor()
+        self.imageActor.GetMapper().StreamingOn()
+        if interpolation == "Cubic":
+            self.imageActor.GetProperty().SetInterpolationTypeToCubic()
+        elif interpolation == "Linear":
+            self.imageActor.GetProperty().SetInterpolationTypeToLinear()
+        else:
+            self.imageActor.GetProperty().SetInterpolationTypeToNearest()
+        self.renderer.AddActor(self.imageActor)
+        #
+        self.maskMapper = vtk.vtkImageMapToColors()
+        self.maskMapper.PassAlphaToOutputOn()
+        self.maskActor = vtk.vtkImageActor()
+        self.maskActor.GetMapper().SetInputConnection(self.maskMapper.GetOutputPort())
+        self.maskActor.GetMapper().StreamingOn()
+        self.maskActor.InterpolateOff()
+        self.maskActor.VisibilityOff()
+        self.renderer.AddActor(self.maskActor)
+        #
+        self.windowToImage = vtk.vtkWindowToImageFilter()
+        self.windowToImage.SetInput(self.renderWindow)
+        self.windowToImage.SetInputBufferTypeToRGB()
+        self.windowToImage.ReadFrontBufferOff()
+        self.pngWriter = vtk.vtkPNGWriter()
+        #
+        self.imageData = None
+
+    def set_image_data(self, image_data, mask_data=None, colours_list=None, level=None, width=None):
+        ## Window level and width default to auto_window_level:
+        self.imageData = image_data
+        self.imageActor.GetMapper().SetInputData(image_data)
+        if level is None or width is None:
+            level, width = auto_window_level(image_data)
+        self.imageActor.GetProperty().SetColorLevel(level)
+        self.imageActor.GetProperty().SetColorWindow(width)
+        lookupTable = None if mask_data is None else make_mask_lookup_table(colours_list)
+        if lookupTable is not None:
+            self.maskMapper.SetLookupTable(lookupTable)
+            self.maskMapper.SetInputData(mask_data)
+        self.maskActor.SetVisibility(lookupTable is not None)
+
+    def render_slice(self, orientation, slice_index):
+        """Renders a slice ("x", "y" or "z" orientation) and returns it as an RGB (rows, columns, 3)
+        array, top row first.
+        """
+        axis, direction, viewUp = self.ORIENTATIONS[orientation]
+        dimensions = self.imageData.GetDimensions()
+        extent = [0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, dimensions[2] - 1]
+        extent[2 * axis] = extent[2 * axis + 1] = min(max(slice_index, 0), dimensions[axis] - 1)
+        self.imageActor.SetDisplayExtent(extent)
+        if self.maskActor.GetVisibility():
+            self.maskActor.SetDisplayExtent(extent)
+            # Just in front of the image, towards the camera:
+            self.maskActor.SetPosition([0.01 * self.imageData.GetSpacing()[axis] * d for d in direction])
+        #
+        bounds = self.imageActor.GetBounds()
+        centre = [0.5 * (bounds[2 * i] + bounds[2 * i + 1]) for i in range(3)]
+        camera = self.renderer.GetActiveCamera()
+        camera.SetFocalPoint(centre)
+        camera.SetPosition([c + d for c, d in zip(centre, direction)])
+        camera.SetViewUp(viewUp)
+        self.renderer.ResetCamera(bounds)
+        halfSizes = [0.5 * (bounds[2 * i + 1] - bounds[2 * i]) for i in range(3) if i != axis]
+        camera.SetParallelScale(max(halfSizes + [1e-3]))
+        self.renderWindow.Render()
+        #
+        self.windowToImage.Modified()
+        self.windowToImage.Update()
+        output = self.windowToImage.GetOutput()
+        columns, rows, _ = output.GetDimensions()
+        rgb = vtk_numpy_support.vtk_to_numpy(output.GetPointData().GetScalars()).reshape(rows, columns, -1)
+        return rgb[::-1, :, :3].copy()
+
+    def write_png(self, rgb, file_name):
+        ## Writes an RGB (rows, columns, 3) array, top row first:
+        pngImage = numpy_to_image_data(np.ascontiguousarray(rgb[::-1]).reshape(1, rgb.shape[0], rgb.shape[1] * 3), (1.0, 1.0, 1.0))
+        pngImage.SetDimensions(rgb.shape[1], rgb.shape[0], 1)
+        pngImage.GetPointData().GetScalars().SetNumberOfComponents(3)
+        self.pngWriter.SetInputData(pngImage)
+        self.pngWriter.SetFileName(file_name)
+        self.pngWriter.Write()
+
+
+def write_screenshots(args):
+    """Headless mode: renders the slices of every image (and mask) given on the command line to
+    PNG files in args.screenshot_dir, with one OffscreenSliceRenderer for all of them.
+    """
+    if len(args.mask) not in (0, len(args.image)):
+        raise Exception("Give either no mask or one mask per image ({} images, {} masks)!".format(len(args.image), len(args.mask)))
+    os.makedirs(args.screenshot_dir, exist_ok=True)
+    renderer = OffscreenSliceRenderer(args.screenshot_size, args.background, args.interpolation)
+    coloursList = args.color_map if len(args.color_map) > 0 else [list(c) for c in DEFAULT_MASK_COLOURS]
+    for idx, imageFileName in enumerate(args.image):
+        tic = time.time()
+        imageData = read_image_data(imageFileName, memory_map=not args.no_memory_map)
+        imageData.SetOrigin((0.0, 0.0, 0.0))
+        maskData = None
+        if len(args.mask) > 0:
+            maskData = read_image_data(args.mask[idx], memory_map=not args.no_memory_map)
+            if maskData.GetDimensions() != imageData.GetDimensions():
+                print("{}WARNING:{} Skipping the mask of \"{}\": dimensions {} != {}".format(bashColours.BOLDRED, bashColours.RESET,
+                    imageFileName, maskData.GetDimensions(), imageData.GetDimensions()))
+                maskData = None
+            else:
+                if len(args.color_map) == 0:
+                    set_mask_labels(maskData, len(coloursList))
+                maskData.SetOrigin(imageData.GetOrigin())
+                maskData.SetSpacing(imageData.GetSpacing())
+        renderer.set_image_data(imageData, maskData, coloursList, args.window_level, args.window_width)
+        #
+        name = os.path.basename(imageFileName)
+        for extension in (".gz", ".nii", ".nrrd", ".vti"):
+            name = name[:-len(extension)] if name.endswith(extension) else name
+        rows = []
+        for orientation in args.screenshot_orientations:
+            axis = OffscreenSliceRenderer.ORIENTATIONS[orientation][0]
+            numberOfSlices = imageData.GetDimensions()[axis]
+            if args.screenshot_every is not None:
+                slices = list(range(0, numberOfSlices, args.screenshot_every))
+            else:
+                slices = sorted(set(int(round(p * (numberOfSlices - 1))) for p in args.screenshot_positions))
+            row = []
+            for sliceIndex in slices:
+                rgb = renderer.render_slice(orientation, sliceIndex)
+                if args.montage:
+                    row.append(rgb)
+                else:
+                    renderer.write_png(rgb, os.path.join(args.screenshot_dir, "{}__{}-{}.png".format(name, orientation.upper(), sliceIndex)))
+            rows.append(row)
+        if args.montage:
+            columns = max(len(row) for row in rows)
+            blank = np.zeros_like(rows[0][0])
+            montage = np.vstack([np.hstack(row + [blank] * (columns - len(row))) for row in rows])
+            renderer.write_png(montage, os.path.join(args.screenshot_dir, "{}__montage.png".format(name)))
+        print("{} ({}{}{} s.)".format(imageFileName, bashColours.BOLDGREEN, round(time.time() - tic, 3), bashColours.RESET))
+
+
 def main():
     # Parse arguments:
     parser = argparse.ArgumentParser(description="VTK MPR Viewer")
     #
     required_args = parser.add_argument_group("Required Arguments")
-    required_args.add_argument("-i", "--image", "--IMAGE", help="NIFTI, VTI or NNRD Image", required=True)
+    required_args.add_argument("-i", "--image", "--IMAGE", 
+        help="NIFTI, VTI or NNRD Image (several with --screenshot-dir)", nargs="+", required=True)
     #
     optional_args = parser.add_argument_group("Optional Arguments")
-    optional_args.add_argument("-m", "--mask", "--MASK", help="NIFTI, VTI or NNRD Mask", default="")
+    optional_args.add_argument("-m", "--mask", "--MASK", 
+        help="NIFTI, VTI or NNRD Mask (one per image with --screenshot-dir)", nargs="*", default=[])
     optional_args.add_argument("-c", "--color-map", "--COLOR-MAP", help="Color map for mask", default=[])
     optional_args.add_argument("--window-level", "--wl", "--WL", help="Window center", default=None, type=float)
     optional_args.add_argument("--window-width", "--ww", "--WW", help="Window width", default=None, type=float)
@@ -788,56 +2515,99 @@ def main():
         help="Background RGB color", default=[0.0, 0.0, 0.25], type=list)
     optional_args.add_argument("--interpolation", 
         help="Interpolation (\"Nearest\", \"Linear\", or \"Cubic\")", default="Nearest")
+    optional_args.add_argument("--layout", "--LAYOUT", 
+        help="\"windows\" (a window per view) or \"single\" (the views side by side in one window)", 
+        choices=["windows", "single"], default="windows")
+    optional_args.add_argument("--slab-mode", "--SLAB-MODE", 
+        help="Show thick-slab projections (\"m\" cycles them, \"+\"/\"-\" change the thickness)", 
+        choices=["max", "min", "mean"], default=None)
+    optional_args.add_argument("--slab-thickness", "--SLAB-THICKNESS", 
+        help="Slab thickness in mm", type=float, default=10.0)
+    optional_args.add_argument("--view-3d", "--VIEW-3D", 
+        help="Add a 3D view of the slices (implies --layout single)", 
+        action="store_true", default=False)
+    optional_args.add_argument("--volume-rendering", "--VOLUME-RENDERING", 
+        help="Render the volume, and the mask labels, in the 3D view: on the GPU if available (\"smart\") " 
+             "or by CPU ray casting (\"cpu\"). Implies --view-3d", 
+        choices=["smart", "cpu"], default=None)
+    optional_args.add_argument("--cine-fps", "--CINE-FPS", 
+        help="Frame rate of cine playback (space plays or stops the slices of the view under the mouse)", 
+        type=float, default=CINE_FPS)
+    optional_args.add_argument("--cine-prefetch", "--CINE-PREFETCH", 
+        help="Number of slices prepared ahead of cine playback on a worker thread", 
+        type=int, default=CINE_PREFETCH_SLICES)
+    optional_args.add_argument("--no-memory-map", "--NO-MEMORY-MAP", 
+        help="Read uncompressed NIFTI and raw NRRD files into memory instead of memory mapping them", 
+        action="store_true", default=False)
+    optional_args.add_argument("--no-pyramid", "--NO-PYRAMID", 
+        help="Do not build (or use the cached) 2x and 4x downsampled levels shown while navigation is slow", 
+        action="store_true", default=False)
+    optional_args.add_argument("--show-fps", "--SHOW-FPS", 
+        help="Show the frame rate and render latency in the views (\"p\" prints them)", 
+        action="store_true", default=False)
+    optional_args.add_argument("--masked-npy", "--MASKED-NPY", 
+        help="Save the image voxels inside the mask (-1024 elsewhere) to this NumPy file, e.g. ./masked_image.npy", 
+        default=None)
+    screenshot_args = parser.add_argument_group("Headless Screenshots")
+    screenshot_args.add_argument("--screenshot-dir", "--SCREENSHOT-DIR", 
+        help="Render slices of the images to PNG files in this directory, offscreen, instead of opening the viewer", 
+        default=None)
+    screenshot_args.add_argument("--screenshot-orientations", "--SCREENSHOT-ORIENTATIONS", 
+        help="Slice orientations, any of \"x\", \"y\" and \"z\" (default: xyz)", default="xyz")
+    screenshot_args.add_argument("--screenshot-positions", "--SCREENSHOT-POSITIONS", 
+        help="Slice positions, as fractions of each axis (default: 0.5)", nargs="+", type=float, default=[0.5])
+    screenshot_args.add_argument("--screenshot-every", "--SCREENSHOT-EVERY", 
+        help="Render every Nth slice instead of --screenshot-positions", type=int, default=None)
+    screenshot_args.add_argument("--screenshot-size", "--SCREENSHOT-SIZE", 
+        help="Size of the screenshots in pixels", type=int, default=512)
+    screenshot_args.add_argument("--montage", "--MONTAGE", 
+        help="Write one montage per image (a row per orientation) instead of one PNG per slice", 
+        action="store_true", default=False)
     args = parser.parse_args()
 
+    # Headless screenshots:
+    if args.screenshot_dir is not None:
+        write_screenshots(args)
+        return
+    if len(args.image) != 1 or len(args.mask) > 1:
+        raise Exception("The viewer shows one image and at most one mask!")
+    args.image = args.image[0]
+    args.mask = args.mask[0] if len(args.mask) > 0 else ""
+
     # Print arguments:
     print("Arguments:\n", json.dumps(vars(args), indent=4), end="\n\n\n")
 
 
-    # Load image data:
-    imageData = None
-    if args.image.split(".")[-1] == "vti":
-        if not os.path.isfile(args.image):
-            print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
-                bashColours.BOLDRED, bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, bashColours.RESET))
-            quit()
-        imageReader = vtk.vtkXMLImageDataReader()
-        imageReader.SetFileName(args.image)
-        try:
-            imageReader.Update()
-            imageData = imageReader.GetOutput()
-        except:
-            print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, " file!\nAborting...", bashColours.RESET)
-            quit()
-    elif args.image.split(".")[-1] == "nrrd":
-        if not os.path.isfile(args.image):
-            print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
-                bashColours.BOLDRED, bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, bashColours.RESET))
-            quit()
-        imageReader = vtk.vtkNrrdReader()
-        imageReader.SetFileName(args.image)
-        try:
-            imageReader.Update()
-            imageData = imageReader.GetOutput()
-        except:
-            print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, " file!\nAborting...", bashColours.RESET)
-            quit()
-    elif args.image.split(".")[-1] == "nii" or args.image.split(".")[-2] == "nii":
-        if not os.path.isfile(args.image):
+    # Mask colours:
+    maskColoursList = args.color_map
+    maskNumberOfLabels = None
+    if args.mask != "" and len(maskColoursList) == 0:
+        ## Set colors:
+        maskColoursList.extend([list(c) for c in DEFAULT_MASK_COLOURS])
+        ## Make sure that voxel values are consistent with the number of colors:
+        maskNumberOfLabels = len(maskColoursList)
+
+    # Load image and mask data in the background, the views are shown while they load:
+    for file_name in (args.image, args.mask):
+        if file_name != "" and not os.path.isfile(file_name):
             print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
-                bashColours.BOLDRED, bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, bashColours.RESET))
+                bashColours.BOLDRED, bashColours.BOLDBLACK, file_name, bashColours.BOLDRED, bashColours.RESET))
             quit()
-        imageReader = vtk.vtkNIFTIImageReader()
-        imageReader.SetFileName(args.image)
-        try:
-            imageReader.Update()
-            imageData = imageReader.GetOutput()
-            # print(f"***NIFTI IMAGE***\n{imageData}\n\n")
-        except:
-            print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, " file!\nAborting...", bashColours.RESET)
-            quit()
-    else:
-        raise Exception(f"\"{args.image}\" does not have the expected extension!")
+    imageLoader = BackgroundImageLoader(args.image, memory_map=not args.no_memory_map)
+    imageLoader.start()
+    maskLoader = None
+    if args.mask != "":
+        maskLoader = BackgroundImageLoader(args.mask, memory_map=not args.no_memory_map, number_of_labels=maskNumberOfLabels)
+        maskLoader.start()
+    if args.masked_npy is not None:  # The export needs the whole image and mask
+        imageLoader.join()
+        if maskLoader is not None:
+            maskLoader.join()
+
+    # Image shown until the image is available (it is right away for NIFTI and NRRD):
+    imageData = imageLoader.image_data
+    if imageData is None:
+        imageData = numpy_to_image_data(np.zeros((1, 1, 1), dtype=np.int16), (1.0, 1.0, 1.0))
 
     # Correct Image origin and other stuff:
     if True:
@@ -847,103 +2617,27 @@ def main():
         #     1.0, 0.0, 0.0,
         #     0.0, 1.0, 0.0,
         #     0.0, 0.0, 1.0))
-        print(imageData)
 
     # Instantiate MPR viewer:
-    mpr = ThreePlaneView(imageData, cursor_off=False)
-
-    # Load Mask Data, if mask file is specified:
-    maskData  = None
-    if args.mask != "":
-        if args.mask.split(".")[-1] == "vti":
-            if not os.path.isfile(args.mask):
-                print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
-                    bashColours.BOLDRED, bashColours.BOLDBLACK, vtiMaskFileName, bashColours.BOLDRED, bashColours.RESET))
-                quit()
-            maskReader = vtk.vtkXMLImageDataReader()
-            maskReader.SetFileName(vtiMaskFileName)
-            try:
-                maskReader.Update()
-                maskData = maskReader.GetOutput()
-            except:
-                print(bashColours.BOLDRED , "ERROR reading the " , bashColours.BOLDBLACK , vtiMaskFileName , bashColours.BOLDRED , " file!\nAborting..." , bashColours.RESET)
-                quit()
-        elif args.mask.split(".")[-1] == "nii" or args.mask.split(".")[-2] == "nii":
-            if not os.path.isfile(args.mask):
-                print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
-                    bashColours.BOLDRED,bashColours.BOLDBLACK,args.mask,bashColours.BOLDRED,bashColours.RESET))
-                quit()
-            maskReader = vtk.vtkNIFTIImageReader()
-            maskReader.SetFileName(args.mask)
-            try:
-                maskReader.Update()
-                maskData = maskReader.GetOutput()
-                # print(f"***NIFTI MASK***\n{maskData}\n\n")
-            except:
-                print(bashColours.BOLDRED , "ERROR reading the " , bashColours.BOLDBLACK , args.mask , bashColours.BOLDRED , " file!\nAborting..." , bashColours.RESET)
-                quit()
-        elif args.mask.split(".")[-1] == "nrrd":
-            if not os.path.isfile(args.mask):
-                print("{}ERROR: \"{}{}{}\" does not exist!{}".format(
-                    bashColours.BOLDRED, bashColours.BOLDBLACK, args.mask, bashColours.BOLDRED, bashColours.RESET))
-                quit()
-            maskReader = vtk.vtkNrrdReader()
-            maskReader.SetFileName(args.mask)
-            try:
-                maskReader.Update()
-                maskData = maskReader.GetOutput()
-            except:
-                print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, args.mask, bashColours.BOLDRED, " file!\nAborting...", bashColours.RESET)
-                quit()
-        else:
-            raise Exception(f"\"{args.mask}\" does not have the expected extension!")
-
-    # Set mask colors if there is mask:
-    if maskData is not None:
+    view3D = args.view_3d or args.volume_rendering is not None
+    mpr = ThreePlaneView(imageData, cursor_off=False, layout="single" if view3D else args.layout, 
+        view_3d=view3D, volume_rendering=args.volume_rendering)
+    mpr.show_render_statistics = args.show_fps
+    mpr.cine_fps = args.cine_fps
+    mpr.cine_prefetch_slices = args.cine_prefetch
+    mpr.set_slab(args.slab_mode, args.slab_thickness)
+
+    def set_mask():
+        # Called once both the image and the mask are loaded:
+        if mpr.maskActorX is not None:
+            return
+        imageData = imageLoader.image_data
+        maskData = maskLoader.image_data
         if maskData.GetDimensions() != imageData.GetDimensions():
             print(bashColours.BOLDRED , "ERROR: Inconsistent number of dimensions between image " , bashColours.BOLDBLACK , imageData.GetDimensions() , bashColours.BOLDRED , " and mask" ,\
                 bashColours.BOLDBLACK , maskData.GetDimensions()  , bashColours.BOLDRED , "!\nAborting..." , bashColours.RESET)
-            quit()
-
-        maskColoursList = args.color_map
-        if len(maskColoursList) == 0:
-            ## Set colors:
-            alpha = 0.85
-            maskColoursList.append([ 1.0, 0.0, 0.0, alpha])  #  1 - Red 
-            maskColoursList.append([ 0.0, 1.0, 0.0, alpha])  #  2 - Green
-            maskColoursList.append([ 0.0, 0.0, 1.0, alpha])  #  3 - Blue  
-            maskColoursList.append([ 1.0, 1.0, 0.0, alpha])  #  4 - Yellow 
-            maskColoursList.append([ 1.0, 0.0, 1.0, alpha])  #  5 - Magenta  
-            maskColoursList.append([ 0.0, 1.0, 1.0, alpha])  #  6 - Cyan 
-            maskColoursList.append([ 0.6, 0.6, 1.0, alpha])  #  7 - Light Purple 
-            maskColoursList.append([ 1.0, 0.4, 0.0, alpha])  #  8 - Orange 
-            maskColoursList.append([ 0.0, 0.0, 0.5, alpha])  #  9 - Navy 
-            maskColoursList.append([ 0.5, 0.0, 0.0, alpha])  # 10 - Dark Red
-            maskColoursList.append([ 0.0, 0.5, 0.0, alpha])  # 11 - Dark Green
-            maskColoursList.append([ 1.0, 0.8, 0.6, alpha])  # 12 - Khaky
-            maskColoursList.append([ 1.0, 0.6, 0.8, alpha])  # 13 - Pink 
-
-            ## Use numpy to process the mask:
-            dimension = maskData.GetDimensions()
-            mask_flat_np_array = vtk_numpy_support.vtk_to_numpy(maskData.GetPointData().GetScalars())
-            mask_flat_np_array = mask_flat_np_array.reshape(dimension)
-
-            ## This is specific to Artrya masks: 
-            if not True:
-                print(f"Transposing Mask array: {mask_flat_np_array.shape} --> ", end="")
-                mask_flat_np_array = mask_flat_np_array.transpose(2, 1, 0)
-                mask_flat_np_array = np.flip(mask_flat_np_array, axis=2)
-                print(f"{mask_flat_np_array.shape}")
-
-            ## Make sure that voxel values are consistent with the number of colors:
-            mask_flat_np_array = np.round(mask_flat_np_array)
-            mask_flat_np_array = np.where(mask_flat_np_array <= 0, 0.0, mask_flat_np_array)
-            mask_flat_np_array = np.where(mask_flat_np_array > 13, 0.0, mask_flat_np_array)
-            vtk_data = vtk_numpy_support.numpy_to_vtk(
-                num_array=mask_flat_np_array.flatten(), 
-                deep=True, 
-                array_type=vtk.VTK_FLOAT)
-            maskData.GetPointData().SetScalars(vtk_data)
+            mpr.finalize()
+            mpr.terminate_app()
 
         # Correct mask origin and other stuff:
         if True:
@@ -952,6 +2646,13 @@ def main():
             # maskData.SetDirectionMatrix(imageData.GetDirectionMatrix())
             print(maskData)
 
+        ## Label names for the readout, from the JSON sidecar of the mask (see MHA_and_HDF5_to_Nifti.py):
+        sidecarFileName = get_label_sidecar_filename(args.mask)
+        if os.path.isfile(sidecarFileName):
+            with open(sidecarFileName, "r") as file:
+                sidecar = json.load(file)
+            mpr.set_mask_label_names(sidecar.get("labels", {}), sidecar.get("overlap_policy"))
+
         mpr.set_mask_data(maskData, maskColoursList)
         
         if maskData.GetSpacing() != imageData.GetSpacing():
@@ -959,35 +2660,69 @@ def main():
             print(f"{imageData.GetSpacing()} != {maskData.GetSpacing()}")
             print("Using image spacing...")
             maskData.SetSpacing(imageData.GetSpacing())
-        
-    # Export 
-    export_masked_image_to_npy = True
-    if export_masked_image_to_npy and maskData is not None:
-        #
-        ## Check dimensions:
-        image_dims = imageData.GetDimensions()
-        mask_dims = maskData.GetDimensions()
-        assert(image_dims == mask_dims)
-        #
-        ## Get image and mask as numpy arrays
-        image_flat_np_array = vtk_numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
-        image_np_array = image_flat_np_array.reshape(image_dims)
-        mask_flat_np_array = vtk_numpy_support.vtk_to_numpy(maskData.GetPointData().GetScalars())
-        mask_np_array = mask_flat_np_array.reshape(mask_dims)
-        #
-        ## Mask image and export to NumPy file:
-        masked_image = np.where(mask_np_array > 0, image_np_array, -1024.0)
-        np.save("./masked_image.npy", masked_image)
-        #
-        ## Clean up:
-        image_np_array = None
-        image_flat_np_array = None
-        mask_np_array = None
-        mask_flat_np_array = None
-        masked_image = None
+
+        # Export 
+        if args.masked_npy is not None:
+            #
+            ## Check dimensions:
+            image_dims = imageData.GetDimensions()
+            mask_dims = maskData.GetDimensions()
+            assert(image_dims == mask_dims)
+            #
+            ## Get image and mask as numpy arrays
+            image_flat_np_array = vtk_numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+            image_np_array = image_flat_np_array.reshape(image_dims)
+            mask_flat_np_array = vtk_numpy_support.vtk_to_numpy(maskData.GetPointData().GetScalars())
+            mask_np_array = mask_flat_np_array.reshape(mask_dims)
+            #
+            ## Mask image and export to NumPy file:
+            masked_image = np.where(mask_np_array > 0, image_np_array, -1024.0)
+            np.save(args.masked_npy, masked_image)
+            #
+            ## Clean up:
+            image_np_array = None
+            image_flat_np_array = None
+            mask_np_array = None
+            mask_flat_np_array = None
+            masked_image = None
+
+    def on_image_loaded(loader):
+        if loader.error is not None:
+            print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, args.image, bashColours.BOLDRED, " file!", loader.error, bashColours.RESET)
+            return
+        if loader.image_data is not mpr.get_image_data():  # Read by VTK: swap the full image in
+            loader.image_data.SetOrigin((0.0, 0.0, 0.0))
+            mpr.set_image_data(loader.image_data)
+        print(loader.image_data)
+        if not args.no_pyramid:
+            pyramidBuilder = ImagePyramidBuilder(loader.image_data, args.image)
+            pyramidBuilder.start()
+            mpr.follow_loader(pyramidBuilder, on_pyramid_built)
+        if maskLoader is not None and maskLoader.done and maskLoader.error is None:
+            set_mask()
+
+    def on_pyramid_built(builder):
+        if builder.error is not None:
+            print("{}WARNING:{} No downsampled levels for smooth navigation: {}".format(
+                bashColours.BOLDRED, bashColours.RESET, builder.error))
+            return
+        mpr.set_image_pyramid(builder.levels)
+
+    def on_mask_loaded(loader):
+        if loader.error is not None:
+            print(bashColours.BOLDRED, "ERROR reading the ", bashColours.BOLDBLACK, args.mask, bashColours.BOLDRED, " file!", loader.error, bashColours.RESET)
+            return
+        if imageLoader.done and imageLoader.error is None:
+            set_mask()
+
+    mpr.follow_loader(imageLoader, on_image_loaded)
+    if maskLoader is not None:
+        mpr.follow_loader(maskLoader, on_mask_loaded)
 
     # Set window level:
-    if args.window_size == []:
+    if args.window_size == [] and (args.layout == "single" or view3D):
+        mpr.set_viewers_window_size(512, 512)
+    elif args.window_size == []:
         mpr.set_viewers_window_size()
     elif len(args.window_size) == 1:
         mpr.set_viewers_window_size(args.window_size[0], args.window_size[0])
@@ -0,0 +1,123 @@
+""" Guards the startup latency of the converter CLIs: times `--help` and a DICOM `--dry-run` in
+fresh interpreters and checks which heavy modules each of them imported.
+
+Exits with status 1 if a command is slower than its limit or imports a module it should not.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import argparse
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, SCRIPT_DIR)
+from DICOM_to_Nifti import BashColours
+
+HEAVY_MODULES = ("itk", "scipy", "pandas", "h5py", "pydicom", "vtk")
+
+# Runs a CLI as __main__ and reports the heavy modules it left in sys.modules:
+RUNNER = """
+import sys, json, runpy
+sys.argv = {argv!r}
+sys.path.insert(0, {script_dir!r})
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+finally:
+    sys.stdout.flush()
+    sys.stderr.write("\\n" + json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)) + "\\n")
+"""
+
+
+def write_synthetic_series(directory, slices=20, rows=64, columns=64):
+    """Writes a small uncompressed CT series to directory.
+    """
+    rng = np.random.default_rng(0)
+    studyUID, seriesUID = generate_uid(), generate_uid()
+    for idx in range(slices):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.PatientID = "BENCHMARK"
+        ds.StudyInstanceUID = studyUID
+        ds.SeriesInstanceUID = seriesUID
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.SliceThickness = 1.0
+        ds.SliceLocation = float(idx)
+        ds.ImagePositionPatient = [0.0, 0.0, float(idx)]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope = 1.0
+        ds.RescaleIntercept = -1024.0
+        ds.PixelData = rng.integers(0, 2**12, size=(rows, columns), dtype=np.uint16).tobytes()
+        ds.save_as(os.path.join(directory, "IM{:04d}.dcm".format(idx)), enforce_file_format=True)
+
+
+def time_command(argv, repeats):
+    """Runs the CLI in fresh interpreters; returns the fastest wall time and the heavy modules it imported.
+    """
+    code = RUNNER.format(argv=argv, script_dir=SCRIPT_DIR, heavy=HEAVY_MODULES)
+    best = None
+    for _ in range(repeats):
+        tic = time.time()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        toc = time.time()
+        best = toc - tic if best is None else min(best, toc - tic)
+    return best, json.loads(result.stderr.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Startup latency of the converter CLIs')
+    parser.add_argument("-r", "--repeats", help="Runs per command (the fastest is reported)", type=int, default=3)
+    parser.add_argument("--max-help-seconds", help="Limit for --help", type=float, default=1.0)
+    parser.add_argument("--max-dry-run-seconds", help="Limit for a DICOM --dry-run", type=float, default=2.0)
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dicom_dir = os.path.join(tmp_dir, "dicom")
+        os.makedirs(dicom_dir)
+        write_synthetic_series(dicom_dir)
+        # (name, argv, limit, modules allowed to be imported)
+        commands = [
+            ("DICOM_to_Nifti --help", [os.path.join(SCRIPT_DIR, "DICOM_to_Nifti.py"), "--help"],
+                args.max_help_seconds, ()),
+            ("MHA_and_HDF5_to_Nifti --help", [os.path.join(SCRIPT_DIR, "MHA_and_HDF5_to_Nifti.py"), "--help"],
+                args.max_help_seconds, ()),
+            ("Batch_to_Nifti --help", [os.path.join(SCRIPT_DIR, "Batch_to_Nifti.py"), "--help"],
+                args.max_help_seconds, ()),
+            ("DICOM_to_Nifti --dry-run", [os.path.join(SCRIPT_DIR, "DICOM_to_Nifti.py"), "-d", dicom_dir,
+                "-n", os.path.join(tmp_dir, "dry_run.nii.gz"), "--dry-run", "--no-cache"],
+                args.max_dry_run_seconds, ("pydicom",)),
+        ]
+        for name, argv, limit, allowed in commands:
+            seconds, imported = time_command(argv, args.repeats)
+            unexpected = [m for m in imported if m not in allowed]
+            failed = seconds > limit or len(unexpected) > 0
+            failures += failed
+            print("{:<30} {}{:.3f}{} s (limit {} s), heavy imports: {}{}{}".format(name,
+                BashColours.BOLDRED if seconds > limit else BashColours.BOLDGREEN, seconds, BashColours.RESET, limit,
+                BashColours.BOLDRED if unexpected else BashColours.BOLDGREEN, ", ".join(imported) or "none", BashColours.RESET))
+
+    if failures:
+        print("{}FAILED{} {} command(s) over their limit or importing heavy modules".format(
+            BashColours.BOLDRED, BashColours.RESET, failures))
+        sys.exit(1)
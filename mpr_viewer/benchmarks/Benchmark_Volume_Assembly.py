@@ -0,0 +1,82 @@
+""" Measures the peak RSS of assembling a synthetic CT series with GetImageVolume
+and writing it with WriteNumpyToNifti.
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import argparse
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DICOM_to_Nifti import BashColours, GetImageVolume, WriteNumpyToNifti
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (ru_maxrss is in kB on Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def make_synthetic_series(slices, rows, columns, bits_stored=12):
+    """Builds an in-memory series dictionary (slice_z keys, dataset values) of uncompressed CT slices.
+    """
+    rng = np.random.default_rng(0)
+    dicom_series = {}
+    for idx in range(slices):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.PixelSpacing = [0.7, 0.7]
+        ds.SliceThickness = 1.0
+        ds.ImagePositionPatient = [0.0, 0.0, float(idx)]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = bits_stored
+        ds.HighBit = bits_stored - 1
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope = 1.0
+        ds.RescaleIntercept = -1024.0
+        ds.PixelData = rng.integers(0, 2**bits_stored, size=(rows, columns), dtype=np.uint16).tobytes()
+        dicom_series[float(idx)] = ds
+    return dicom_series
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Peak RSS of DICOM volume assembly')
+    parser.add_argument("-z", "--slices", help="Number of slices", type=int, default=500)
+    parser.add_argument("-r", "--rows", help="Rows (and columns) per slice", type=int, default=512)
+    parser.add_argument("--bits-stored", help="BitsStored of the synthetic slices (16 forces float32)", type=int, default=12)
+    parser.add_argument("--write", help="Also write the volume to a temporary NIFTI file", action="store_true", default=False)
+    args = parser.parse_args()
+
+    dicom_series = make_synthetic_series(args.slices, args.rows, args.rows, bits_stored=args.bits_stored)
+    for ds in dicom_series.values():
+        ds.pixel_array  # Decode up front, as ReadDICOMPixels does
+    baseline = peak_rss_mb()
+
+    tic = time.time()
+    image_data_array, spacing = GetImageVolume(dicom_series)
+    toc = time.time()
+    assembly_peak = peak_rss_mb()
+    print("GetImageVolume:    {}{}{} s, volume {} {} ({:.1f} MB), peak RSS +{}{:.1f}{} MB".format(
+        BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET,
+        image_data_array.dtype, image_data_array.shape, image_data_array.nbytes / 2**20,
+        BashColours.BOLDBLUE, assembly_peak - baseline, BashColours.RESET))
+
+    if args.write:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tic = time.time()
+            WriteNumpyToNifti(image_data_array, spacing, os.path.join(tmp_dir, "benchmark.nii.gz"))
+            toc = time.time()
+        print("WriteNumpyToNifti: {}{}{} s, peak RSS +{}{:.1f}{} MB".format(
+            BashColours.BOLDGREEN, round(toc - tic, 3), BashColours.RESET,
+            BashColours.BOLDBLUE, peak_rss_mb() - baseline, BashColours.RESET))
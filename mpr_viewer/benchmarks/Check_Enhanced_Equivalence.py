@@ -0,0 +1,153 @@
+""" Checks that multi-frame (enhanced) copies of single-frame CT series convert to the same NIFTI
+files as the originals: same voxels, and the same header up to rounding of the geometry. The
+voxels of the originals are checked against their stored pixels rescaled slice by slice.
+
+The series are axial and oblique, with a slope and intercept that vary from slice to slice (per
+frame in the enhanced copies), stored raw and RLE compressed, and converted whole and streamed.
+Exits with status 1 if any conversion differs.
+"""
+
+import os
+import sys
+import copy
+import gzip
+import struct
+import tempfile
+import argparse
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, CTImageStorage, EnhancedCTImageStorage, generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from DICOM_to_Nifti import BashColours, ReadDICOMSeries, ExportDICOMSeries
+from Nifti_Writer import NIFTI1_HEADER_FORMAT, NIFTI1_VOX_OFFSET
+
+# (slope, intercept) of the slices, cycled; integral ones would be written as int16
+SLICE_RESCALES = ((1.0, -1024.0), (0.75, -1024.0), (1.25, -1000.0), (1.5, -1024.0), (1.75, -1024.0))
+
+
+def write_synthetic_series(directory, slices=9, rows=12, columns=10, orientation=(1, 0, 0, 0, 1, 0)):
+    """Writes an uncompressed CT series with SLICE_RESCALES to directory. Returns its rescaled 
+    (z, y, x) volume, slices in the order of their positions.
+    """
+    rng = np.random.default_rng(0)
+    studyUID, seriesUID = generate_uid(), generate_uid()
+    normal = np.cross(orientation[:3], orientation[3:])
+    volume = []
+    for idx in range(slices):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.PatientID = "CHECK"
+        ds.StudyInstanceUID = studyUID
+        ds.SeriesInstanceUID = seriesUID
+        ds.Modality = "CT"
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.PixelSpacing = [0.7, 0.8]
+        ds.SliceThickness = 2.5
+        ds.ImageOrientationPatient = [float(v) for v in orientation]
+        ds.ImagePositionPatient = [float(v) for v in np.array([-10.0, -20.0, 5.0]) + 2.5 * idx * normal]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope, ds.RescaleIntercept = SLICE_RESCALES[idx % len(SLICE_RESCALES)]
+        pixels = rng.integers(0, 2**12, size=(rows, columns), dtype=np.uint16)
+        ds.PixelData = pixels.tobytes()
+        ds.save_as(os.path.join(directory, "IM{:04d}.dcm".format(idx)), enforce_file_format=True)
+        volume.append(pixels * ds.RescaleSlope + ds.RescaleIntercept)
+    return np.stack(volume)
+
+
+def write_enhanced_copy(src_dir, dst_dir, compress=False):
+    """Writes the slices of src_dir, shuffled, as the frames of one Enhanced CT object: orientation and
+    pixel measures in the shared functional groups, position and rescale in the per-frame ones.
+    """
+    datasets = [pydicom.dcmread(os.path.join(src_dir, f)) for f in sorted(os.listdir(src_dir))]
+    datasets = [datasets[idx] for idx in np.random.default_rng(1).permutation(len(datasets))]
+    mf = copy.deepcopy(datasets[0])
+    for keyword in ("ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing", "SliceThickness",
+                    "RescaleSlope", "RescaleIntercept"):
+        delattr(mf, keyword)
+    mf.SOPClassUID = EnhancedCTImageStorage
+    mf.file_meta.MediaStorageSOPClassUID = EnhancedCTImageStorage
+    mf.NumberOfFrames = len(datasets)
+    orientation, measures, shared = Dataset(), Dataset(), Dataset()
+    orientation.ImageOrientationPatient = datasets[0].ImageOrientationPatient
+    measures.PixelSpacing = datasets[0].PixelSpacing
+    measures.SliceThickness = datasets[0].SliceThickness
+    shared.PlaneOrientationSequence = Sequence([orientation])
+    shared.PixelMeasuresSequence = Sequence([measures])
+    mf.SharedFunctionalGroupsSequence = Sequence([shared])
+    perFrame = []
+    for ds in datasets:
+        position, rescale, frame = Dataset(), Dataset(), Dataset()
+        position.ImagePositionPatient = ds.ImagePositionPatient
+        rescale.RescaleSlope, rescale.RescaleIntercept, rescale.RescaleType = ds.RescaleSlope, ds.RescaleIntercept, "HU"
+        frame.PlanePositionSequence = Sequence([position])
+        frame.PixelValueTransformationSequence = Sequence([rescale])
+        perFrame.append(frame)
+    mf.PerFrameFunctionalGroupsSequence = Sequence(perFrame)
+    mf.PixelData = b"".join(ds.pixel_array.tobytes() for ds in datasets)
+    if compress:
+        mf.compress(RLELossless, generate_instance_uid=False)
+    mf.save_as(os.path.join(dst_dir, "ENHANCED.dcm"))
+
+
+def convert(dicom_dir, output_filename, slab_size=None):
+    ExportDICOMSeries(ReadDICOMSeries(dicom_dir, only_read_header=True), output_filename, slab_size=slab_size)
+    with gzip.open(output_filename, "rb") as file:
+        data = file.read()
+    return struct.unpack(NIFTI1_HEADER_FORMAT, data[:struct.calcsize(NIFTI1_HEADER_FORMAT)]), data[NIFTI1_VOX_OFFSET:]
+
+
+def same_header(header, reference, tolerance=1e-4):
+    return all(abs(a - b) <= tolerance if isinstance(a, float) else a == b for a, b in zip(header, reference))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Enhanced (multi-frame) vs single-frame DICOM conversion')
+    parser.add_argument("-z", "--slices", help="Number of slices", type=int, default=9)
+    parser.add_argument("--slab-size", help="Slices per slab of the streamed conversions", type=int, default=2)
+    args = parser.parse_args()
+
+    c, s = np.cos(0.4), np.sin(0.4)
+    orientations = {"axial": (1, 0, 0, 0, 1, 0), "oblique": (c, s, 0.0, -s * c, c * c, s)}
+    failures = 0
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, orientation in orientations.items():
+            single_dir = os.path.join(tmp_dir, name)
+            os.makedirs(single_dir)
+            volume = write_synthetic_series(single_dir, slices=args.slices, orientation=orientation)
+            expected = volume[::-1, ::-1].astype(np.float32).tobytes()  # As written: slices and rows flipped
+            for compress in (False, True):
+                enhanced_dir = os.path.join(tmp_dir, "{}_enhanced_{}".format(name, "rle" if compress else "raw"))
+                os.makedirs(enhanced_dir)
+                write_enhanced_copy(single_dir, enhanced_dir, compress=compress)
+                for slab_size in (None, args.slab_size):
+                    reference = convert(single_dir, os.path.join(tmp_dir, "reference.nii.gz"), slab_size)
+                    converted = convert(enhanced_dir, os.path.join(tmp_dir, "enhanced.nii.gz"), slab_size)
+                    failed = reference[1] != expected or converted[1] != reference[1] or \
+                             not same_header(converted[0], reference[0])
+                    failures += failed
+                    results.append((failed, "{:<8} {} {:<12}".format(name, "rle" if compress else "raw",
+                        "whole" if slab_size is None else "slabs of {}".format(slab_size))))
+
+    for failed, description in results:
+        print("{}{}{} {}".format(BashColours.BOLDRED if failed else BashColours.BOLDGREEN,
+            "FAILED" if failed else "OK    ", BashColours.RESET, description))
+    if failures:
+        print("{}FAILED{} {} conversion(s) differ from their single-frame series or its rescaled pixels".format(
+            BashColours.BOLDRED, BashColours.RESET, failures))
+        sys.exit(1)
@@ -0,0 +1,104 @@
+""" Checks the h5 to NIFTI conversion of MHA_and_HDF5_to_Nifti.py against the whole arrays: streamed
+3D images and multimasks (summed and as label maps) read whole and in slabs, and images that are
+not 3D (a 4D multichannel and a 2D one), which are written whole by ITK.
+
+Exits with status 1 if any conversion differs from its array, or fails.
+"""
+
+import os
+import sys
+import gzip
+import struct
+import tempfile
+import argparse
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from MHA_and_HDF5_to_Nifti import (BashColours, stream_h5_to_nifti, convert_multimask_bool_to_int,
+                                   encode_multimask_labels)
+from Nifti_Writer import NIFTI1_HEADER_FORMAT, NIFTI_DATATYPES
+
+# Fields of the unpacked NIFTI-1 header
+DIM, DATATYPE, VOX_OFFSET = slice(7, 15), 19, 30
+
+
+def read_nifti1(filename):
+    """Returns the dimensions of a .nii.gz file, (x, y, z, ...) as in its header, and its voxels.
+    """
+    with gzip.open(filename, "rb") as file:
+        data = file.read()
+    header = struct.unpack(NIFTI1_HEADER_FORMAT, data[:struct.calcsize(NIFTI1_HEADER_FORMAT)])
+    dim = header[DIM]
+    dtype = {code: dtype for dtype, code in NIFTI_DATATYPES.items()}[header[DATATYPE]]
+    return tuple(dim[1:dim[0] + 1]), np.frombuffer(data[int(header[VOX_OFFSET]):], dtype=dtype.newbyteorder("<"))
+
+
+def written_as(array):
+    """The voxels of array as WriteNumpyToNifti writes them: slices and rows flipped.
+    """
+    return np.ascontiguousarray(array[::-1, ::-1]).ravel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='h5 to NIFTI conversion vs the whole arrays')
+    parser.add_argument("--slab-size", help="Slices per slab of the streamed conversions", type=int, default=2)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = rng.normal(size=(9, 12, 10)).astype(np.float32)
+    multimask = rng.random((9, 12, 10, 3)) < 0.3
+    multimask[..., 0] &= ~multimask[..., 1]  # Overlaps of masks 1 and 2 only, "first" and "last" differ
+    # (name, dataset, chunks, stream_h5_to_nifti options, expected voxels)
+    cases = [
+        ("float32 3D", image, (2, 12, 10), {}, written_as(image)),
+        ("int16 3D", (image * 100).astype(np.int16), (3, 6, 5), {}, written_as((image * 100).astype(np.int16))),
+        ("multimask sum", multimask, (2, 12, 10, 3), {"bool_multimask_to_int": True},
+            written_as(convert_multimask_bool_to_int(multimask))),
+        ("multimask first", multimask, None, {"label_overlap_policy": "first"},
+            written_as(encode_multimask_labels(multimask, "first"))),
+        ("multimask bitmask", multimask, None, {"label_overlap_policy": "bitmask"},
+            written_as(encode_multimask_labels(multimask, "bitmask"))),
+        ("float32 4D", image[..., np.newaxis] * [1.0, -1.0], None, {},
+            written_as((image[..., np.newaxis] * [1.0, -1.0]).astype(np.float32))),
+        ("float32 2D", image[0], None, {}, written_as(image[0])),
+    ]
+    failures = 0
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        h5_file = os.path.join(tmp_dir, "check.h5")
+        with h5py.File(h5_file, "w") as file:
+            for name, array, chunks, options, expected in cases:
+                file.create_dataset(name, data=array, chunks=chunks)
+        for name, array, chunks, options, expected in cases:
+            for slab_size in (None, args.slab_size):
+                nifti_file = os.path.join(tmp_dir, "check.nii.gz")
+                description = "{:<18} {:<12}".format(name, "whole" if slab_size is None else "slabs of {}".format(slab_size))
+                try:
+                    stream_h5_to_nifti(h5_file, name, nifti_file, (1.0, 1.0, 1.0), slab_size=slab_size, **options)
+                    dim, voxels = read_nifti1(nifti_file)
+                    shape = array.shape[:-1] if options else array.shape
+                    failed = dim != shape[::-1] or voxels.dtype != expected.dtype or not np.array_equal(voxels, expected)
+                except Exception as e:
+                    failed, description = True, "{} ({}: {})".format(description, type(e).__name__, e)
+                failures += failed
+                results.append((failed, description))
+
+        # A multimask option on a dataset that is not 4D fails with a clear error:
+        try:
+            stream_h5_to_nifti(h5_file, "float32 3D", os.path.join(tmp_dir, "multimask.nii.gz"), (1.0, 1.0, 1.0),
+                bool_multimask_to_int=True)
+            failed, description = True, "3D multimask        did not raise"
+        except Exception as e:
+            failed, description = "4D" not in str(e), "3D multimask        raises: {}".format(e)
+        failures += failed
+        results.append((failed, description))
+
+    for failed, description in results:
+        print("{}{}{} {}".format(BashColours.BOLDRED if failed else BashColours.BOLDGREEN,
+            "FAILED" if failed else "OK    ", BashColours.RESET, description))
+    if failures:
+        print("{}FAILED{} {} h5 conversion(s) differ from their arrays".format(
+            BashColours.BOLDRED, BashColours.RESET, failures))
+        sys.exit(1)